@@ -9,6 +9,8 @@ app.config_from_object("django.conf:settings", namespace="CELERY")
 # So all tasks in any corgi.tasks submodule are automatically discovered
 # And no config changes are needed when a new submodule is added
 app.autodiscover_tasks()
+# Tag tasks with the source that sent them in every process, even ones which never import a task
+import corgi.tasks.fairshare  # noqa: E402, F401
 
 log_common = 'task_name=%(name)s, task_id=%(id)s, task_args="%(args)s", task_kwargs="%(kwargs)s"'
 
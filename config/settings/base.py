@@ -330,15 +330,14 @@ STATICFILES_STORAGE = "django.contrib.staticfiles.storage.ManifestStaticFilesSto
 # Celery config
 CELERY_BROKER_URL = os.getenv("CORGI_REDIS_URL", "redis://redis:6379")
 
-CELERY_RESULT_BACKEND = "django-db"
-# Retry tasks due to Postgres failures instead of immediately re-raising exceptions
+# Task results are only needed briefly, e.g. by chords, so keep them in Redis.
+# The history of task runs used by our own code is in corgi.core.models.TaskRun instead,
+# see corgi/tasks/runs.py
+CELERY_RESULT_BACKEND = CELERY_BROKER_URL
+# Retry tasks due to Redis failures instead of immediately re-raising exceptions
 # See https://docs.celeryproject.org/en/stable/userguide/configuration.html for details
-# See also a django-celery-results decorator for individual tasks:
-# https://django-celery-results.readthedocs.io/en/latest/reference/django_celery_results.managers.html
 CELERY_RESULT_BACKEND_ALWAYS_RETRY = True
 CELERY_RESULT_BACKEND_MAX_RETRIES = 2
-# Store the task name and args / kwargs
-CELERY_RESULT_EXTENDED = True
 
 # Set a global 15-minute task timeout. Override this on individual tasks by decorating them with:
 # @app.task(soft_time_limit=<TIME_IN_SECONDS>)
@@ -358,22 +357,21 @@ CELERY_WORKER_PREFETCH_MULTIPLIER = 1
 # Send task-related events, so that tasks can be monitored using tools like Flower
 CELERY_WORKER_SEND_TASK_EVENTS = True
 
-# Store the return values of each task in the TaskResult.result attribute; can be used for
-# informational logging.
+# Store the return values of each task in the result backend, until they expire below.
+# Return values are also stored as the TaskRun.summary, for informational logging.
 CELERY_TASK_IGNORE_RESULT = False
 
-# Track the start time of each task by creating its TaskResult as soon as it enters the STARTED
-# state. This allows us to measure task execution time of each task by `date_done - date_created`.
-CELERY_TASK_TRACK_STARTED = True
+# The start time of each task is recorded in its TaskRun, not in the result backend
+CELERY_TASK_TRACK_STARTED = False
 
 # Do not acknowledge task until completion
 # Otherwise tasks may be lost when nodes evict Celery worker pods
 CELERY_TASK_ACKS_LATE = True
 
-# Disable task result expiration:
+# Expire task results in Redis after a day:
 # https://docs.celeryproject.org/en/latest/userguide/configuration.html#std-setting-result_expires
-# By default, this job is enabled and runs daily at 4am. Disable to keep UMB-triggered task results
-CELERY_RESULT_EXPIRES = None
+# Task runs are kept for 30 days in the TaskRun table, see expire_task_results
+CELERY_RESULT_EXPIRES = 86400
 
 # Support setting custom priorities in our queues
 # so more important tasks can jump ahead of less important ones
@@ -397,6 +395,22 @@ CELERY_TASK_ROUTES = (
     ],
 )
 
+# Tasks are tagged with the source that sent them (umb, periodic, backfill or manual).
+# In the below queues, once a source has more than its budget of tasks queued or running,
+# its extra tasks are sent with the overflow priority, so UMB events (which have no budget)
+# don't wait behind a whole backfill. See corgi/tasks/fairshare.py
+FAIR_SHARE_QUEUES = tuple(
+    queue for queue in os.getenv("CORGI_FAIR_SHARE_QUEUES", "slow").split(",") if queue
+)
+FAIR_SHARE_BUDGETS = {
+    "periodic": int(os.getenv("CORGI_FAIR_SHARE_BUDGET_PERIODIC", "200")),
+    "backfill": int(os.getenv("CORGI_FAIR_SHARE_BUDGET_BACKFILL", "20")),
+    "manual": int(os.getenv("CORGI_FAIR_SHARE_BUDGET_MANUAL", "50")),
+}
+FAIR_SHARE_OVERFLOW_PRIORITY = 9
+# Seconds to wait for Redis when counting tasks, before giving up and sending the task anyway
+FAIR_SHARE_REDIS_TIMEOUT = float(os.getenv("CORGI_FAIR_SHARE_REDIS_TIMEOUT", "2"))
+
 
 # Django REST Framework
 # https://www.django-rest-framework.org/
@@ -431,6 +445,25 @@ UMB_CONSUMER = f"{UMB_CONSUMER_ID}.{UMB_SUBSCRIPTION_ID}"
 
 UMB_BROKER_URL = os.getenv("CORGI_UMB_BROKER_URL")
 
+# Seconds to collect UMB messages for, before sending one task for all the messages about the same
+# build or erratum. Set to 0 to send a task for each message right away
+UMB_BATCH_WINDOW = float(os.getenv("CORGI_UMB_BATCH_WINDOW", "5"))
+# Send the tasks early if this many builds / errata have messages waiting
+UMB_BATCH_MAX_SIZE = int(os.getenv("CORGI_UMB_BATCH_MAX_SIZE", "500"))
+# Tasks for UMB messages are written to this SQLite file before the messages are accepted, and
+# removed once they're sent to Celery, so they're sent later if Redis is down or the consumer
+# restarts. Put it on a persistent volume to keep it across pod restarts. Set to "" to send tasks
+# directly, and only accept each message once its task was sent
+UMB_SPOOL_PATH = os.getenv("CORGI_UMB_SPOOL_PATH", "/tmp/corgi-umb-spool.sqlite3")
+# Messages each UMB receiver may have in flight before we ask for more (AMQP link credit)
+UMB_PREFETCH = int(os.getenv("CORGI_UMB_PREFETCH", "100"))
+# Stop asking for more messages while the spool or the slow queue hold this many tasks.
+# Set either to 0 to ignore it
+UMB_SPOOL_MAX_DEPTH = int(os.getenv("CORGI_UMB_SPOOL_MAX_DEPTH", "5000"))
+UMB_QUEUE_MAX_DEPTH = int(os.getenv("CORGI_UMB_QUEUE_MAX_DEPTH", "20000"))
+# Seconds between checks whether we can ask for more messages, or retry sending spooled tasks
+UMB_FLOW_CHECK_INTERVAL = float(os.getenv("CORGI_UMB_FLOW_CHECK_INTERVAL", "30"))
+
 # Set to False to turn off the brew umb listener.
 # True values are y, yes, t, true, on and 1; false values are n, no, f, false, off and 0
 # https://docs.python.org/3/distutils/apiref.html#distutils.util.strtobool
@@ -440,6 +473,15 @@ UMB_BREW_MONITOR_ENABLED = strtobool(os.getenv("CORGI_UMB_BREW_MONITOR_ENABLED",
 BREW_URL = os.getenv("CORGI_BREW_URL")
 BREW_WEB_URL = os.getenv("CORGI_BREW_WEB_URL")
 BREW_DOWNLOAD_ROOT_URL = os.getenv("CORGI_BREW_DOWNLOAD_ROOT_URL")
+# Max number of koji calls to send in a single multicall
+BREW_MULTICALL_BATCH_SIZE = int(os.getenv("CORGI_BREW_MULTICALL_BATCH_SIZE", "100"))
+# Max number of listTagged calls to send in a single multicall, since each can return many builds
+BREW_TAG_MULTICALL_BATCH_SIZE = int(os.getenv("CORGI_BREW_TAG_MULTICALL_BATCH_SIZE", "10"))
+# Max number of builds to fetch in a single task, when fetching many builds for relations / errata
+BUILD_FETCH_CHUNK_SIZE = int(os.getenv("CORGI_BUILD_FETCH_CHUNK_SIZE", "25"))
+# Max number of remote-source.json files to download at once, in total and from each host
+REMOTE_SOURCE_FETCH_WORKERS = int(os.getenv("CORGI_REMOTE_SOURCE_FETCH_WORKERS", "8"))
+REMOTE_SOURCE_FETCH_MAX_PER_HOST = int(os.getenv("CORGI_REMOTE_SOURCE_FETCH_MAX_PER_HOST", "4"))
 
 CENTOS_URL = os.getenv("CORGI_CENTOS_URL")
 CENTOS_DOWNLOAD_ROOT_URL = os.getenv("CORGI_CENTOS_DOWNLOAD_ROOT_URL")
@@ -452,6 +494,10 @@ ERRATA_TOOL_URL = os.getenv("CORGI_ERRATA_TOOL_URL")
 
 # Pulp
 PULP_URL = os.getenv("CORGI_PULP_URL")
+# Max number of pages of Pulp repo content to fetch at once
+PULP_FETCH_WORKERS = int(os.getenv("CORGI_PULP_FETCH_WORKERS", "8"))
+# Max number of Yum repos to read repodata from at once
+YUM_FETCH_WORKERS = int(os.getenv("CORGI_YUM_FETCH_WORKERS", "4"))
 
 # App-Interface
 APP_INTERFACE_URL = os.getenv("CORGI_APP_INTERFACE_URL", "")
@@ -500,3 +546,59 @@ OPTIMISE_REST_API_COUNT = False
 ALLOWED_MIDDLEWARE_MANIFEST_STREAMS = os.environ.get(
     "CORGI_ALLOWED_MIDDLEWARE_MANIFEST_STREAMS", ""
 ).split(",")
+
+# Write stream manifests as compact JSON, instead of pretty-printing them with indent=4
+# Pre-compressed .gz and .zst copies of each manifest are written either way
+MANIFEST_COMPACT_JSON = strtobool(os.getenv("CORGI_MANIFEST_COMPACT_JSON", "false"))
+
+# Rendered component manifests are cached on disk, keyed by the component's UUID and a fingerprint
+# of its linked provides / upstreams, so each manifest is only rendered and validated once
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "manifests": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": os.getenv("CORGI_MANIFEST_CACHE_DIR", "/tmp/corgi-manifest-cache"),
+        # A changed fingerprint gives a new key, so old entries only need to expire eventually
+        "TIMEOUT": 60 * 60 * 24 * 7,
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    },
+    # Responses to koji calls which never change for completed builds, like listRPMs
+    # Keyed by a hash of the method and its arguments, so entries never need to be invalidated
+    # Set CORGI_BREW_CACHE_BACKEND to django.core.cache.backends.dummy.DummyCache to disable
+    "koji": {
+        "BACKEND": os.getenv(
+            "CORGI_BREW_CACHE_BACKEND", "django.core.cache.backends.filebased.FileBasedCache"
+        ),
+        "LOCATION": os.getenv("CORGI_BREW_CACHE_DIR", "/tmp/corgi-koji-cache"),
+        "TIMEOUT": None,
+        "OPTIONS": {"MAX_ENTRIES": int(os.getenv("CORGI_BREW_CACHE_MAX_ENTRIES", "100000"))},
+    },
+    # Packages and modules parsed from Yum repodata, keyed by each file's checksum in repomd.xml
+    "yum": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": os.getenv("CORGI_YUM_CACHE_DIR", "/tmp/corgi-yum-cache"),
+        # A changed file gives a new key, so old entries only need to expire eventually
+        "TIMEOUT": 60 * 60 * 24 * 7,
+        "OPTIONS": {"MAX_ENTRIES": 1000},
+    },
+}
+
+# Manifests are checked with a fast, linear-time validator for the rules they are likely to break
+# The full spdx-tools validator is much slower, so only run it on a fraction of component manifests
+# and on a nightly sample of stream manifests
+MANIFEST_FULL_VALIDATION_SAMPLE_RATE = float(
+    os.getenv("CORGI_MANIFEST_FULL_VALIDATION_SAMPLE_RATE", "0.01")
+)
+MANIFEST_FULL_VALIDATION_SAMPLE_SIZE = int(
+    os.getenv("CORGI_MANIFEST_FULL_VALIDATION_SAMPLE_SIZE", "10")
+)
+
+# Builds and streams whose taxonomy needs saving are queued, and only processed after they haven't
+# been queued again for TAXONOMY_QUEUE_QUIET_PERIOD seconds, or after waiting MAX_DELAY seconds
+# in total. Set TAXONOMY_QUEUE_QUIET_PERIOD to 0 to save each taxonomy right away instead
+TAXONOMY_QUEUE_QUIET_PERIOD = int(os.getenv("CORGI_TAXONOMY_QUEUE_QUIET_PERIOD", "300"))
+TAXONOMY_QUEUE_MAX_DELAY = int(os.getenv("CORGI_TAXONOMY_QUEUE_MAX_DELAY", "3600"))
+# Max number of builds / streams to process each time the taxonomy queue is drained
+TAXONOMY_QUEUE_BATCH_SIZE = int(os.getenv("CORGI_TAXONOMY_QUEUE_BATCH_SIZE", "500"))
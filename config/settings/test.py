@@ -22,3 +22,33 @@ TEMPLATES[0]["OPTIONS"]["debug"] = True  # noqa: F405
 # always disable corgi.api.paginate.FasterPageNumberPagination when running tests
 # as the database will not have 'primed' pg_class table with reltuples
 OPTIMISE_REST_API_COUNT = False
+
+# Don't share cached manifests between test runs
+CACHES["manifests"] = {  # noqa: F405
+    "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    "LOCATION": "manifests",
+}
+CACHES["koji"] = {  # noqa: F405
+    "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    "LOCATION": "koji",
+}
+CACHES["yum"] = {  # noqa: F405
+    "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    "LOCATION": "yum",
+}
+
+# Always run the full SPDX validator in tests, in addition to the fast one
+MANIFEST_FULL_VALIDATION_SAMPLE_RATE = 1.0
+
+# Save taxonomies right away, tests for the taxonomy queue enable it themselves
+TAXONOMY_QUEUE_QUIET_PERIOD = 0
+
+# Don't count in-flight tasks in Redis, tests for fair-share scheduling enable it themselves
+FAIR_SHARE_QUEUES = ()
+
+# Send a task for each UMB message right away, tests for batching enable it themselves
+UMB_BATCH_WINDOW = 0
+
+# Don't spool UMB tasks or check the Celery queue's length, tests for the spool enable it themselves
+UMB_SPOOL_PATH = ""
+UMB_QUEUE_MAX_DEPTH = 0
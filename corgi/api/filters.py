@@ -13,6 +13,7 @@ from corgi.core.models import (
     ComponentQuerySet,
     Product,
     ProductStream,
+    ProductStreamComponent,
     ProductVariant,
     ProductVersion,
     SoftwareBuild,
@@ -210,6 +211,15 @@ class ComponentFilter(IncludeFieldsFilterSet):
     re_upstreams_name = CharFilter(
         field_name="upstreams", lookup_expr="name__iregex", distinct=True
     )
+    # Aggregate provides / upstreams of the latest root components in some stream
+    stream_provides = CharFilter(
+        method="filter_stream_aggregate_components",
+        label="Show only provides of the latest root components in a product stream",
+    )
+    stream_upstreams = CharFilter(
+        method="filter_stream_aggregate_components",
+        label="Show only upstreams of the latest root components in a product stream",
+    )
     el_match = CharFilter(label="RHEL version for layered products", lookup_expr="icontains")
     released_components = BooleanFilter(
         method="filter_released_components", label="Show only released components"
@@ -292,6 +302,26 @@ class ComponentFilter(IncludeFieldsFilterSet):
             lookup_expr = f"{name}__name"
         return queryset.filter(**{lookup_expr: value})
 
+    @staticmethod
+    def filter_stream_aggregate_components(
+        queryset: ComponentQuerySet, name: str, value: str
+    ) -> QuerySet[Component]:
+        """Filter by the stored provides / upstreams of a stream, given its ofuri or name"""
+        if value in EMPTY_VALUES:
+            return queryset
+        aggregate_type = (
+            ProductStreamComponent.Type.PROVIDES
+            if name == "stream_provides"
+            else ProductStreamComponent.Type.UPSTREAM
+        )
+        lookup_expr = (
+            "productstream__ofuri" if value.startswith("o:redhat:") else "productstream__name"
+        )
+        aggregate_pks = ProductStreamComponent.objects.filter(
+            type=aggregate_type, **{lookup_expr: value}
+        ).values("component_id")
+        return queryset.filter(pk__in=aggregate_pks)
+
     @staticmethod
     def filter_released_components(
         queryset: ComponentQuerySet, _name: str, value: bool
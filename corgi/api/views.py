@@ -1,11 +1,14 @@
 import logging
+from pathlib import Path
 from typing import Any, Type, Union
 
 import django_filters.rest_framework
+from django.conf import settings
 from django.db import connections
 from django.db.models import QuerySet
-from django.http import Http404, HttpResponse, JsonResponse
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse
 from django.utils import timezone
+from django.utils.cache import patch_vary_headers
 from drf_spectacular.types import OpenApiTypes
 from drf_spectacular.utils import OpenApiParameter, extend_schema, extend_schema_view
 from mptt.templatetags.mptt_tags import cache_tree_children
@@ -31,8 +34,14 @@ from corgi.core.models import (
     ProductVersion,
     SoftwareBuild,
 )
+from corgi.tasks.fairshare import get_fair_share_stats
 
-from ..core.files import ComponentManifestFile, ProductManifestFile
+from ..core.files import (
+    MANIFEST_CONTENT_ENCODINGS,
+    ComponentManifestFile,
+    ProductManifestFile,
+    get_accepted_manifest_encoding,
+)
 from .constants import CORGI_API_VERSION
 from .filters import (
     ChannelFilter,
@@ -148,6 +157,23 @@ class StatusViewSet(GenericViewSet):
                         "type": "object",
                         "properties": {"count": {"type": "integer"}},
                     },
+                    "task_queues": {
+                        "type": "object",
+                        "description": "Tasks in flight and queue wait times, per task source",
+                        "additionalProperties": {
+                            "type": "object",
+                            "additionalProperties": {
+                                "type": "object",
+                                "properties": {
+                                    "in_flight": {"type": "integer"},
+                                    "budget": {"type": "integer"},
+                                    "tasks_started": {"type": "integer"},
+                                    "avg_wait_seconds": {"type": "number"},
+                                    "last_wait_seconds": {"type": "number"},
+                                },
+                            },
+                        },
+                    },
                 },
             }
         },
@@ -203,6 +229,7 @@ class StatusViewSet(GenericViewSet):
                 "channels": {
                     "count": Channel.objects.db_manager("read_only").count(),
                 },
+                "task_queues": get_fair_share_stats(),
             }
         )
 
@@ -248,6 +275,23 @@ class TokenAuthTestView(APIView):
         return Response({"user": str(request.user)})
 
 
+def get_manifest_file_response(manifest_path: Path, accept_encoding: str) -> FileResponse:
+    """Stream a pre-generated manifest file, or one of its compressed copies if accepted"""
+    encoding = get_accepted_manifest_encoding(accept_encoding)
+    encoded_path = Path(f"{manifest_path}{MANIFEST_CONTENT_ENCODINGS.get(encoding, '')}")
+    if not encoding or not encoded_path.is_file():
+        encoding = ""
+        encoded_path = manifest_path
+    # Set the content type explicitly, otherwise Django guesses e.g. application/gzip
+    response = FileResponse(
+        encoded_path.open("rb"), content_type="application/json", filename=manifest_path.name
+    )
+    if encoding:
+        response["Content-Encoding"] = encoding
+    patch_vary_headers(response, ("Accept-Encoding",))
+    return response
+
+
 # A dict with string keys and string or tuple values
 # The tuples recursively contain taxonomy dicts
 taxonomy_dict_type = dict[str, Union[str, tuple["taxonomy_dict_type", ...]]]
@@ -438,10 +482,16 @@ class ProductStreamViewSet(ProductDataViewSet):
             raise Http404
 
     @action(methods=["get"], detail=True)
-    def manifest(self, request: Request, pk: str = "") -> HttpResponse:
+    def manifest(self, request: Request, pk: str = "") -> Union[FileResponse, HttpResponse]:
         obj = self.queryset.filter(pk=pk).first()
         if not obj:
             return Response(status=status.HTTP_404_NOT_FOUND)
+        manifest_path = Path(f"{settings.STATIC_ROOT}/{obj.name}.json")
+        if manifest_path.is_file():
+            # Serve the pre-generated manifest, pre-compressed if the client accepts it
+            return get_manifest_file_response(
+                manifest_path, request.headers.get("Accept-Encoding", "")
+            )
         manifest = ProductManifestFile(obj).render_content()
         return JsonResponse(manifest)
 
@@ -546,8 +596,8 @@ class ComponentViewSet(ReadOnlyModelViewSet):  # TODO: TagViewMixin disabled unt
             return HttpResponse(status=status.HTTP_404_NOT_FOUND)
         if not obj.software_build:
             return HttpResponse(status=status.HTTP_204_NO_CONTENT)
-        manifest = ComponentManifestFile(obj).render_content()
-        return JsonResponse(manifest)
+        manifest_json = ComponentManifestFile(obj).render_cached_json()
+        return HttpResponse(manifest_json, content_type="application/json")
 
     @action(
         methods=["put"],
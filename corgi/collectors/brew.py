@@ -1,7 +1,9 @@
+import hashlib
 import json
 import logging
 import os
 import re
+import time
 from datetime import datetime
 from types import SimpleNamespace
 from typing import Any, Generator, Iterable, Optional, Union
@@ -11,7 +13,10 @@ import koji
 import requests
 import yaml
 from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
 
+from corgi.collectors.fetcher import ConcurrentFetcher
 from corgi.collectors.models import CollectorRhelModule, CollectorRPM, CollectorSRPM
 from corgi.core.constants import CONTAINER_REPOSITORY
 from corgi.core.models import Component, SoftwareBuild
@@ -20,6 +25,12 @@ logger = logging.getLogger(__name__)
 
 ADVISORY_REGEX = re.compile(r"RH[BES]A-[12]\d{3}:\d{4,}")
 
+# Bump this whenever Brew.get_component_data() changes what it collects or how it parses it,
+# so that builds which were already ingested are fully processed again
+COLLECTOR_VERSION = 1
+# Build info which can change without changing the build's components
+FINGERPRINT_EXCLUDED_KEYS = ("tags", "errata_tags", "released_errata_tags")
+
 
 class BrewBuildTypeNotFound(Exception):
     pass
@@ -41,6 +52,203 @@ class BrewBuildNotFound(Exception):
     pass
 
 
+class KojiCall:
+    """A single call in a KojiMultiCall, whose result is available once the multicall has run"""
+
+    def __init__(self, method: str, args: tuple, kwargs: dict[str, Any]) -> None:
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.done = False
+        self.cached = False
+        self._result: Any = None
+        self._exception: Optional[Exception] = None
+
+    def set_result(self, result: Any) -> None:
+        self._result = result
+        self.done = True
+
+    def set_exception(self, exception: Exception) -> None:
+        self._exception = exception
+        self.done = True
+
+    @property
+    def cache_key(self) -> str:
+        """Content-addressed key for this call, from the method name and all its arguments"""
+        arguments = json.dumps([self.args, self.kwargs], sort_keys=True, default=str)
+        return f"koji:{self.method}:{hashlib.sha256(arguments.encode()).hexdigest()}"
+
+    @property
+    def result(self) -> Any:
+        if not self.done:
+            raise ValueError(f"Koji call {self.method} has not run yet")
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+class KojiMultiCall:
+    """Collect koji calls, then send them in koji multicalls of at most batch_size calls each.
+    Used like koji's own ClientSession.multicall(), but only the calls which failed with a
+    transient error are retried, instead of failing or repeating the whole multicall.
+
+    with KojiMultiCall(koji_session) as m:
+        calls = [m.listRPMs(imageID=archive_id) for archive_id in archive_ids]
+    rpms = [call.result for call in calls]
+
+    Responses to IMMUTABLE_METHODS are stored in the "koji" cache, so reprocessing the same builds
+    doesn't fetch them from Brew again.
+    """
+
+    # Methods whose responses never change, once the build they're about has completed
+    # Never add methods whose responses can change like getBuild (build state), listTags or
+    # listTagged (builds are tagged and untagged), or getLatestBuilds
+    IMMUTABLE_METHODS = frozenset(
+        (
+            "getBuildType",
+            "getRPM",
+            "getRPMHeaders",
+            "getTaskRequest",
+            "listArchives",
+            "listRPMs",
+        )
+    )
+
+    # Errors raised for a whole multicall, or for single calls within it, which are worth retrying
+    RETRYABLE_ERRORS = (
+        koji.ServerOffline,  # type: ignore[attr-defined]
+        koji.RetryError,  # type: ignore[attr-defined]
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+    )
+    MAX_RETRIES = 3
+    RETRY_DELAY = 5  # seconds, doubled after each retry
+
+    def __init__(self, koji_session: koji.ClientSession, batch_size: int = 0) -> None:
+        self.koji_session = koji_session
+        self.batch_size = batch_size or settings.BREW_MULTICALL_BATCH_SIZE
+        self.calls: list[KojiCall] = []
+
+    def __enter__(self) -> "KojiMultiCall":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.call_all()
+
+    def __getattr__(self, method: str):
+        def add_call(*args, **kwargs) -> KojiCall:
+            call = KojiCall(method, args, kwargs)
+            self.calls.append(call)
+            return call
+
+        return add_call
+
+    def call_all(self) -> None:
+        """Run all calls which haven't run yet, retrying any calls which failed transiently"""
+        pending = self._get_cached([call for call in self.calls if not call.done])
+        for attempt in range(self.MAX_RETRIES + 1):
+            failed: list[tuple[KojiCall, Exception]] = []
+            for start in range(0, len(pending), self.batch_size):
+                failed.extend(self._call_batch(pending[start : start + self.batch_size]))
+            if not failed:
+                break
+            pending = [call for call, _ in failed]
+            if attempt < self.MAX_RETRIES:
+                logger.warning(
+                    "Retrying %s of %s koji calls after error: %s",
+                    len(failed),
+                    len(self.calls),
+                    failed[0][1],
+                )
+                time.sleep(self.RETRY_DELAY * 2**attempt)
+        else:
+            # Out of retries, so raise the last error when each failed call's result is accessed
+            for call, exception in failed:
+                call.set_exception(exception)
+        self._set_cached()
+
+    def _get_cached(self, calls: list[KojiCall]) -> list[KojiCall]:
+        """Fill in the results of cached calls, and return the calls which still need to run"""
+        keys = {call.cache_key: call for call in calls if call.method in self.IMMUTABLE_METHODS}
+        if not keys:
+            return calls
+        for key, result in caches["koji"].get_many(keys).items():
+            keys[key].set_result(result)
+            keys[key].cached = True
+        return [call for call in calls if not call.done]
+
+    def _set_cached(self) -> None:
+        """Cache the results of immutable calls which just ran successfully"""
+        results = {
+            call.cache_key: call._result
+            for call in self.calls
+            if call.method in self.IMMUTABLE_METHODS and not call.cached and call._exception is None
+            # Empty results might only mean the data doesn't exist in Brew yet, so don't cache them
+            and call._result
+        }
+        if results:
+            caches["koji"].set_many(results)
+
+    def _call_batch(self, batch: list[KojiCall]) -> list[tuple[KojiCall, Exception]]:
+        """Send one koji multicall, and return any calls which failed with a retryable error"""
+        try:
+            with self.koji_session.multicall(strict=False) as multicall:
+                virtual_calls = [
+                    getattr(multicall, call.method)(*call.args, **call.kwargs) for call in batch
+                ]
+        except self.RETRYABLE_ERRORS as exc:
+            return [(call, exc) for call in batch]
+
+        failed = []
+        for call, virtual_call in zip(batch, virtual_calls):
+            try:
+                call.set_result(virtual_call.result)
+            except self.RETRYABLE_ERRORS as exc:
+                failed.append((call, exc))
+            except Exception as exc:
+                # Other faults, like a build which doesn't exist, won't be fixed by retrying
+                call.set_exception(exc)
+        return failed
+
+
+# Shared by all Brew collectors in this process, so connections to Brew / Cachito are reused
+remote_source_fetcher = ConcurrentFetcher(
+    max_workers=settings.REMOTE_SOURCE_FETCH_WORKERS,
+    max_per_host=settings.REMOTE_SOURCE_FETCH_MAX_PER_HOST,
+)
+
+
+def get_build_fingerprint(component: dict[str, Any]) -> str:
+    """Return a hash of everything Brew.get_component_data() collected for a build that affects
+    its components: the build state, RPM and archive checksums (which aren't saved anywhere else),
+    remote sources and their packages, and the collector version. Tags and errata are excluded,
+    since they're saved separately without rewriting the build's components"""
+    build_info = component["build_meta"]["build_info"]
+    content = {
+        "collector_version": COLLECTOR_VERSION,
+        "state": build_info.get("state"),
+        "component": {
+            **component,
+            "build_meta": {
+                **component["build_meta"],
+                "build_info": {
+                    key: value
+                    for key, value in build_info.items()
+                    if key not in FINGERPRINT_EXCLUDED_KEYS
+                },
+            },
+        },
+    }
+    # Sets like nested_builds are unordered, so sort them for a stable hash
+    serialized = json.dumps(
+        content,
+        sort_keys=True,
+        default=lambda value: sorted(value) if isinstance(value, (set, frozenset)) else str(value),
+    )
+    return hashlib.sha256(serialized.encode()).hexdigest()
+
+
 class Brew:
     """Interface to the Brew API for build data collection.
 
@@ -90,6 +298,8 @@ class Brew:
 
     KOJI_LISTARCHIVES_SRC = "koji.listArchives"
     RHCOS_BUILDER = "coreos-assembler"
+    # Max number of RPMs in a module to save using each set of bulk queries
+    PERSIST_MODULES_CHUNK_SIZE = 1000
 
     koji_session: koji.ClientSession = None
 
@@ -105,13 +315,29 @@ class Brew:
         else:
             raise ValueError(f"Tried to create Brew collector with invalid type: {source}")
 
-    def get_source_of_build(self, build_info: dict[str, Any]) -> str:
-        """Find the source used to build the Koji build."""
+    def multicall(self, batch_size: int = 0) -> KojiMultiCall:
+        """Batch koji calls together, see KojiMultiCall"""
+        return KojiMultiCall(self.koji_session, batch_size=batch_size)
+
+    def call(self, method: str, *args: Any, **kwargs: Any) -> Any:
+        """Make a single koji call, which may be answered from the cache, see KojiMultiCall"""
+        with self.multicall() as m:
+            koji_call = getattr(m, method)(*args, **kwargs)
+        return koji_call.result
+
+    def get_source_of_build(
+        self, build_info: dict[str, Any], task_request_call: Optional[KojiCall] = None
+    ) -> str:
+        """Find the source used to build the Koji build.
+        The getTaskRequest call may already have been made as part of a multicall"""
         no_source_msg = f'Build {build_info["id"]} has no associated source URL'
         if build_info.get("task_id") is None:
             raise BrewBuildSourceNotFound(no_source_msg)
 
-        task_request = self.koji_session.getTaskRequest(build_info["task_id"])
+        if task_request_call is None:
+            with self.multicall() as m:
+                task_request_call = m.getTaskRequest(build_info["task_id"])
+        task_request = task_request_call.result
         if not isinstance(task_request, list):
             raise BrewBuildSourceNotFound(no_source_msg)
 
@@ -301,7 +527,7 @@ class Brew:
         # List of child RPM components
         rpm_components = []
 
-        rpm_infos = self.koji_session.listRPMs(build_id)
+        rpm_infos = self.call("listRPMs", build_id)
 
         for rpm_info, call in self.brew_rpm_headers_lookup(rpm_infos):
             rpm_id = rpm_info["id"]
@@ -355,6 +581,11 @@ class Brew:
 
         # RPM components are children of the SRPM component
         srpm_component["components"] = rpm_components
+        # Only used for the build's fingerprint, see get_build_fingerprint()
+        srpm_component["checksums"] = {
+            f"{rpm_info['nvr']}.{rpm_info['arch']}": rpm_info.get("payloadhash", "")
+            for rpm_info in rpm_infos
+        }
 
         # TODO: list all components used as build requirements
         return srpm_component
@@ -420,11 +651,18 @@ class Brew:
         return url
 
     @staticmethod
-    def _get_remote_source(build_archive_url: str) -> SimpleNamespace:
-        response = requests.get(build_archive_url)
-        response.raise_for_status()
+    def _parse_remote_source(response: requests.Response) -> SimpleNamespace:
         return json.loads(response.text, object_hook=lambda d: SimpleNamespace(**d))
 
+    @classmethod
+    def _get_remote_source(cls, build_archive_url: str) -> SimpleNamespace:
+        return remote_source_fetcher.get(build_archive_url, cls._parse_remote_source)
+
+    @classmethod
+    def _get_remote_sources(cls, build_archive_urls: Iterable[str]) -> list[SimpleNamespace]:
+        """Download many remote-source.json files at once, and return them in the same order"""
+        return remote_source_fetcher.get_all(build_archive_urls, cls._parse_remote_source)
+
     @staticmethod
     def _create_image_component(
         build_id: int,
@@ -563,7 +801,15 @@ class Brew:
                 component["meta"]["arch"] = build_info["extra"]["typeinfo"]["image"]["arch"]
 
         child_image_components: list[dict[str, Any]] = []
-        archives = self.koji_session.listArchives(build_id)
+        archives = self.call("listArchives", build_id)
+
+        # List the RPMs in every image archive using a single multicall, instead of one call each
+        with self.multicall() as m:
+            list_rpms_calls = {
+                archive["id"]: m.listRPMs(imageID=archive["id"])
+                for archive in archives
+                if self._is_image_archive(archive, is_rhcos_build)
+            }
 
         # Extract the list of embedded rpms
         noarch_rpms_by_id: dict[int, dict[str, Any]] = {}
@@ -574,7 +820,12 @@ class Brew:
             # source code
             if archive["btype"] == "image" and archive["type_name"] == "tar" and not is_rhcos_build:
                 noarch_rpms_by_id, child_image_component = self._extract_image_components(
-                    archive, build_id, build_info["nvr"], noarch_rpms_by_id, rpm_build_ids
+                    archive,
+                    list_rpms_calls[archive["id"]].result,
+                    build_id,
+                    build_info["nvr"],
+                    noarch_rpms_by_id,
+                    rpm_build_ids,
                 )
                 child_image_components.append(child_image_component)
             if archive["btype"] == "remote-sources":
@@ -592,7 +843,11 @@ class Brew:
                         self.update_remote_sources(archive, build_info, remote_sources)
             if is_rhcos_build and archive["filename"] == "commitmeta.json":
                 noarch_rpms_by_id = self._extract_rhcos_image_components(
-                    archive, component, noarch_rpms_by_id, rpm_build_ids
+                    archive,
+                    list_rpms_calls[archive["id"]].result,
+                    component,
+                    noarch_rpms_by_id,
+                    rpm_build_ids,
                 )
 
         source_components = self._extract_remote_sources(go_stdlib_version, remote_sources)
@@ -601,6 +856,10 @@ class Brew:
         component["sources"] = source_components
         component["image_components"] = child_image_components
         component["components"] = list(noarch_rpms_by_id.values())
+        # Only used for the build's fingerprint, see get_build_fingerprint()
+        component["checksums"] = {
+            archive["filename"]: archive.get("checksum", "") for archive in archives
+        }
 
         # During Brew collection we are only able to inspect docker config labels on attached arch
         # specific archives. We do this loop here to save values from those labels onto the root
@@ -636,8 +895,11 @@ class Brew:
         Each top-level .package has a "components" key with all the child
         .dependencies of that package (e.g. .packages[index].dependencies in JQ)"""
         source_components: list[dict[str, Any]] = []
-        for build_loc, coords in remote_sources.items():
-            remote_source = cls._get_remote_source(coords[0])
+        # Large containers can have 10+ remote sources, so download them all at once
+        remote_source_jsons = cls._get_remote_sources(
+            coords[0] for coords in remote_sources.values()
+        )
+        for (build_loc, coords), remote_source in zip(remote_sources.items(), remote_source_jsons):
             remote_source_name, remote_source_type = cls._parse_remote_source_url(
                 remote_source.repo
             )
@@ -721,9 +983,17 @@ class Brew:
         without_prefix = filename.removeprefix("remote-source-")
         return without_prefix.split(".", 1)[0]
 
+    @staticmethod
+    def _is_image_archive(archive: dict[str, Any], is_rhcos_build: bool) -> bool:
+        """Check if an archive is an image, which has RPMs listed in Brew"""
+        if is_rhcos_build:
+            return archive["filename"] == "commitmeta.json"
+        return archive["btype"] == "image" and archive["type_name"] == "tar"
+
     def _extract_image_components(
         self,
         archive: dict[str, Any],
+        rpms: list[dict[str, Any]],
         build_id: int,
         build_nvr: str,
         noarch_rpms_by_id: dict[int, dict[str, Any]],
@@ -743,7 +1013,6 @@ class Brew:
         child_component["meta"]["brew_archive_id"] = archive["id"]
         child_component["meta"]["digests"] = archive["extra"]["docker"]["digests"]
         child_component["meta"]["source"] = [self.KOJI_LISTARCHIVES_SRC]
-        rpms = self.koji_session.listRPMs(imageID=archive["id"])
         arch_specific_rpms = []
         for rpm in rpms:
             rpm_component = self._create_rpm_component_definition(rpm)
@@ -758,6 +1027,7 @@ class Brew:
     def _extract_rhcos_image_components(
         self,
         archive: dict[str, Any],
+        rpms: list[dict[str, Any]],
         component: dict[str, Any],
         noarch_rpms_by_id: dict[int, dict[str, Any]],
         rpm_build_ids: set[int],
@@ -766,7 +1036,6 @@ class Brew:
         component["meta"]["filename"] = archive["filename"]
         component["meta"]["brew_archive_id"] = archive["id"]
         component["meta"]["source"] = [self.KOJI_LISTARCHIVES_SRC]
-        rpms = self.koji_session.listRPMs(imageID=archive["id"])
         for rpm in rpms:
             rpm_component = self._create_rpm_component_definition(rpm)
             rpm_build_ids.add(rpm["build_id"])
@@ -1057,10 +1326,33 @@ class Brew:
         return module
 
     # Force clients to call this using an int build_id
-    def get_component_data(self, build_id: int) -> dict[str, Any]:
+    def get_builds(self, build_ids: Iterable[int]) -> dict[int, dict[str, Any]]:
+        """Look up many builds at once in a single multicall, for tasks which fetch builds in chunks
+        Builds which don't exist or couldn't be looked up are left out, so that
+        get_component_data() looks them up again and raises the right error"""
+        with self.multicall() as m:
+            calls = {build_id: m.getBuild(build_id) for build_id in build_ids}
+        builds = {}
+        for build_id, call in calls.items():
+            try:
+                build = call.result
+            except KojiMultiCall.RETRYABLE_ERRORS:
+                continue
+            except koji.GenericError:  # type: ignore[attr-defined]
+                continue
+            if build:
+                builds[build_id] = build
+        return builds
+
+    def get_component_data(
+        self, build_id: int, build: Optional[dict[str, Any]] = None
+    ) -> dict[str, Any]:
+        """Fetch all the data for a build. The build itself can be passed in if already looked up,
+        e.g. by get_builds()"""
         logger.info("Retrieving Brew build: %s", build_id)
-        # koji api expects a build_id to be an int. If you pass a string it'll look for an NVR
-        build = self.koji_session.getBuild(build_id)
+        if not build:
+            # koji api expects a build_id to be an int. If you pass a string it'll look for an NVR
+            build = self.koji_session.getBuild(build_id)
         if not build:
             raise BrewBuildNotFound(f"Build {build_id} was not found")
         # getBuild will accept an NVR
@@ -1082,8 +1374,20 @@ class Brew:
             logger.info(f"Skipping processing build {build_id} ({build['name']})")
             return {}
 
+        # Make the remaining calls which only need the build in a single multicall
+        with self.multicall() as m:
+            build_type_call = m.getBuildType(build)
+            tags_call = m.listTags(build_id)
+            # Sometimes there is no source URL on the build, but it can be found in the task
+            # request info instead.
+            task_request_call = (
+                m.getTaskRequest(build["task_id"])
+                if not build.get("source") and build.get("task_id") is not None
+                else None
+            )
+
         # Determine build type
-        build_type_info = self.koji_session.getBuildType(build)
+        build_type_info = build_type_call.result
         build_type = next(
             (type_ for type_ in build_type_info.keys() if type_ in self.SUPPORTED_BUILD_TYPES),
             "unknown",
@@ -1121,7 +1425,7 @@ class Brew:
             # request info instead.
             logger.info("Fetching source from task info for %s", build_id)
             try:
-                build["source"] = self.get_source_of_build(build)
+                build["source"] = self.get_source_of_build(build, task_request_call)
             except BrewBuildSourceNotFound as exc:
                 # Some older builds do not specify source URLs; the below date was chosen based
                 # on some initial analysis of source-less builds in Brew.
@@ -1138,7 +1442,7 @@ class Brew:
         build["source"] = self.clean_source_of_build(build["source"])
 
         # Add list of Brew tags for this build
-        tags = self.koji_session.listTags(build_id)
+        tags = tags_call.result
         build["tags"] = sorted(set(tag["name"] for tag in tags))
         build["errata_tags"] = self.extract_advisory_ids(build["tags"])
         build["released_errata_tags"] = self.parse_advisory_ids(build["errata_tags"])
@@ -1160,7 +1464,11 @@ class Brew:
                 f"Build {build_id} of type {build_type} is not supported"
             )
 
-        component["build_meta"] = {"build_info": build, "type_info": build_type_info}
+        component["build_meta"] = {
+            "build_info": build,
+            "type_info": build_type_info,
+            "checksums": component.pop("checksums", {}),
+        }
         return component
 
     def get_builds_with_tag(
@@ -1173,9 +1481,33 @@ class Brew:
             logger.warning("Couldn't find brew builds with tag %s: %s", brew_tag, exc)
             return tuple()
 
+    def get_builds_with_tags(
+        self, brew_tags: Iterable[tuple[str, bool]], latest: bool = True
+    ) -> dict[tuple[str, bool], tuple[str, ...]]:
+        """Like get_builds_with_tag, but for many (brew_tag, inherit) pairs at once, using koji
+        multicalls of BREW_TAG_MULTICALL_BATCH_SIZE calls each. Tags which couldn't be listed are
+        left out of the result, so they aren't mistaken for tags which have no builds"""
+        with self.multicall(batch_size=settings.BREW_TAG_MULTICALL_BATCH_SIZE) as m:
+            calls = {
+                (brew_tag, inherit): m.listTagged(brew_tag, inherit=inherit, latest=latest)
+                for brew_tag, inherit in brew_tags
+            }
+        builds_by_tag = {}
+        for (brew_tag, inherit), call in calls.items():
+            try:
+                builds = call.result
+            except KojiMultiCall.RETRYABLE_ERRORS as exc:
+                logger.warning("Couldn't list brew builds with tag %s: %s", brew_tag, exc)
+                continue
+            except koji.GenericError as exc:  # type: ignore[attr-defined]
+                logger.warning("Couldn't find brew builds with tag %s: %s", brew_tag, exc)
+                continue
+            builds_by_tag[(brew_tag, inherit)] = tuple(b["build_id"] for b in builds)
+        return builds_by_tag
+
     def brew_rpm_headers_lookup(
         self, rpm_infos: list[dict[str, str]]
-    ) -> tuple[tuple[dict[str, str], Any], ...]:
+    ) -> tuple[tuple[dict[str, str], KojiCall], ...]:
         # Define headers from which we'll pull extra RPM metadata
         rpm_headers = (
             "summary",
@@ -1186,22 +1518,22 @@ class Brew:
             "url",
             "source",
         )
-        with self.koji_session.multicall() as m:
+        with self.multicall() as m:
             rpm_info_header_calls = tuple(
                 (rpm_info, m.getRPMHeaders(rpmID=rpm_info["id"], headers=rpm_headers))
                 for rpm_info in rpm_infos
             )
         return rpm_info_header_calls
 
-    def brew_srpm_lookup(self, srpms: Iterable[str]) -> tuple[tuple[str, Any], ...]:
+    def brew_srpm_lookup(self, srpms: Iterable[str]) -> tuple[tuple[str, KojiCall], ...]:
         """The Koji API findBuild call can except NVR as a format"""
-        with self.koji_session.multicall() as multicall:
+        with self.multicall() as multicall:
             find_build_id_calls = tuple((srpm, multicall.findBuildID(srpm)) for srpm in srpms)
         return find_build_id_calls
 
-    def brew_rpm_lookup(self, rpms: tuple[str, ...]) -> tuple[tuple[str, Any], ...]:
+    def brew_rpm_lookup(self, rpms: tuple[str, ...]) -> tuple[tuple[str, KojiCall], ...]:
         """The Koji API getRPM call can except rpm in NVR"""
-        with self.koji_session.multicall() as multicall:
+        with self.multicall() as multicall:
             get_rpm_calls = tuple((rpm, multicall.getRPM(rpm)) for rpm in rpms)
         return get_rpm_calls
 
@@ -1222,30 +1554,112 @@ class Brew:
         return f"{module_parts[0]}-{module_parts[1]}-{module_parts[2]}.{module_parts[3]}"
 
     def persist_modules(self, rhel_modules: dict[str, list[str]]) -> Generator[str, None, None]:
+        """Save the RPMs in each module, and the SRPMs they were built from, then yield each
+        module's build_id. All Brew lookups are made up front, then each module's rows are saved
+        with a few bulk queries, instead of a get_or_create call for every RPM"""
         # For each rhel_module look up it's build_id
-        find_build_id_calls = self.brew_srpm_lookup(rhel_modules.keys())
-        for srpm, call in find_build_id_calls:
+        module_build_ids: dict[str, int] = {}
+        for srpm, call in self.brew_srpm_lookup(rhel_modules.keys()):
             build_id = call.result
             if not build_id:
                 logger.warning("Did not find build_id for rhel_module: %s", srpm)
                 continue
-            rhel_module, _ = CollectorRhelModule.objects.get_or_create(
-                build_id=build_id,
-                defaults={"nvr": srpm},
-            )
-            # Lookup the rpm build_ids
+            module_build_ids[srpm] = build_id
+
+        # Lookup the rpm build_ids for every module, before saving anything
+        rpm_srpm_pairs_by_module: dict[str, list[tuple[str, int]]] = {}
+        for srpm in module_build_ids:
             rpms = tuple(
                 self.sans_epoch(rpm) for rpm in rhel_modules[srpm] if not rpm.endswith(".src")
             )
-            rpm_lookup_calls = self.brew_rpm_lookup(rpms)
-            for rpm, call in rpm_lookup_calls:
-                srpm_build_id = call.result["build_id"]
-                srpm_obj, _ = CollectorSRPM.objects.get_or_create(build_id=srpm_build_id)
-                rpm_obj, _ = CollectorRPM.objects.get_or_create(nvra=rpm, srpm=srpm_obj)
-                rpm_obj.rhel_module.add(rhel_module)
-
+            rpm_srpm_pairs_by_module[srpm] = [
+                (rpm, call.result["build_id"]) for rpm, call in self.brew_rpm_lookup(rpms)
+            ]
+
+        for srpm, build_id in module_build_ids.items():
+            start_time = time.monotonic()
+            rpm_srpm_pairs = tuple(rpm_srpm_pairs_by_module[srpm])
+            with transaction.atomic():
+                CollectorRhelModule.objects.bulk_create(
+                    (CollectorRhelModule(build_id=build_id, nvr=srpm),), ignore_conflicts=True
+                )
+                created_srpms, created_rpms, created_links = self._persist_module_rpms(
+                    build_id, rpm_srpm_pairs
+                )
+            logger.info(
+                "Saved module %s (%s) with %s RPMs in %.2fs: "
+                "created %s SRPMs, %s RPMs and %s RPM-module links",
+                srpm,
+                build_id,
+                len(rpm_srpm_pairs),
+                time.monotonic() - start_time,
+                created_srpms,
+                created_rpms,
+                created_links,
+            )
             yield build_id
 
+    @classmethod
+    def _persist_module_rpms(
+        cls, module_build_id: int, rpm_srpm_pairs: tuple[tuple[str, int], ...]
+    ) -> tuple[int, int, int]:
+        """Save (RPM NVRA, SRPM build_id) pairs and link each RPM to a module, in chunks
+        Returns the number of SRPMs, RPMs and links that were created"""
+        created_srpms = created_rpms = created_links = 0
+        rpm_module_through = CollectorRPM.rhel_module.through
+        for start in range(0, len(rpm_srpm_pairs), cls.PERSIST_MODULES_CHUNK_SIZE):
+            chunk = rpm_srpm_pairs[start : start + cls.PERSIST_MODULES_CHUNK_SIZE]
+            srpm_build_ids = {srpm_build_id for _, srpm_build_id in chunk}
+            existing_srpms = set(
+                CollectorSRPM.objects.filter(build_id__in=srpm_build_ids).values_list(
+                    "build_id", flat=True
+                )
+            )
+            new_srpms = srpm_build_ids - existing_srpms
+            CollectorSRPM.objects.bulk_create(
+                (CollectorSRPM(build_id=srpm_build_id) for srpm_build_id in new_srpms),
+                ignore_conflicts=True,
+            )
+            created_srpms += len(new_srpms)
+
+            def get_rpm_ids() -> dict[tuple[str, int], int]:
+                return {
+                    (nvra, srpm_id): rpm_id
+                    for rpm_id, nvra, srpm_id in CollectorRPM.objects.filter(
+                        nvra__in={nvra for nvra, _ in chunk}
+                    ).values_list("pk", "nvra", "srpm_id")
+                }
+
+            rpm_ids = get_rpm_ids()
+            new_rpms = set(chunk) - rpm_ids.keys()
+            if new_rpms:
+                CollectorRPM.objects.bulk_create(
+                    (CollectorRPM(nvra=nvra, srpm_id=srpm_id) for nvra, srpm_id in new_rpms),
+                    ignore_conflicts=True,
+                )
+                created_rpms += len(new_rpms)
+                # ignore_conflicts doesn't set the new rows' primary keys, so look them up again
+                rpm_ids = get_rpm_ids()
+
+            chunk_rpm_ids = {rpm_ids[pair] for pair in chunk if pair in rpm_ids}
+            linked_rpm_ids = set(
+                rpm_module_through.objects.filter(
+                    collectorrhelmodule_id=module_build_id, collectorrpm_id__in=chunk_rpm_ids
+                ).values_list("collectorrpm_id", flat=True)
+            )
+            new_links = chunk_rpm_ids - linked_rpm_ids
+            rpm_module_through.objects.bulk_create(
+                (
+                    rpm_module_through(
+                        collectorrpm_id=rpm_id, collectorrhelmodule_id=module_build_id
+                    )
+                    for rpm_id in new_links
+                ),
+                ignore_conflicts=True,
+            )
+            created_links += len(new_links)
+        return created_srpms, created_rpms, created_links
+
     def lookup_build_ids(
         self, rpm_filenames_by_srpm: dict[str, list[str]]
     ) -> Generator[str, None, None]:
@@ -0,0 +1,68 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Optional, TypeVar
+
+from requests import Response, Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class ConcurrentFetcher:
+    """Fetch many URLs at once using a bounded pool of threads, which share one requests.Session
+    Each host gets at most max_per_host connections, and requests which fail with a connection
+    error or a server error are retried with exponential backoff"""
+
+    def __init__(
+        self,
+        max_workers: int,
+        max_per_host: int,
+        retries: int = 5,
+        backoff_factor: float = 1.0,
+    ) -> None:
+        self.max_workers = max_workers
+        self.session = Session()
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(408, 429, 500, 502, 503, 504),
+            # Don't raise a MaxRetryError for codes in status_forcelist.
+            # This allows for more graceful exception handling using
+            # Response.raise_for_status.
+            raise_on_status=False,
+        )
+        # pool_block makes threads wait for a free connection to a host,
+        # instead of opening more than max_per_host connections to it
+        adapter = HTTPAdapter(
+            pool_connections=max_workers,
+            pool_maxsize=max_per_host,
+            pool_block=True,
+            max_retries=retry,
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, url: str, parse: Optional[Callable[[Response], T]] = None) -> Any:
+        """Fetch a single URL, and return the parsed response (or the response itself)"""
+        response = self.session.get(url)
+        response.raise_for_status()
+        if parse is None:
+            return response
+        return parse(response)
+
+    def get_all(
+        self, urls: Iterable[str], parse: Optional[Callable[[Response], T]] = None
+    ) -> list[Any]:
+        """Fetch all URLs concurrently, and return the parsed responses in the same order
+        The first error for any URL is raised, after all the other requests have finished"""
+        urls = list(urls)
+        if len(urls) < 2:
+            return [self.get(url, parse) for url in urls]
+
+        logger.info("Fetching %s URLs with %s workers", len(urls), self.max_workers)
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(urls))) as executor:
+            futures = [executor.submit(self.get, url, parse) for url in urls]
+        return [future.result() for future in futures]
@@ -0,0 +1,47 @@
+# Generated by Django 3.2.25 on 2026-10-18 21:56
+
+import uuid
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("collectors", "0009_add_pyxis_image_repos"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CollectorProductDefinition",
+            fields=[
+                (
+                    "uuid",
+                    models.UUIDField(
+                        default=uuid.uuid4, editable=False, primary_key=True, serialize=False
+                    ),
+                ),
+                (
+                    "type",
+                    models.CharField(
+                        choices=[
+                            ("PRODUCT", "Product"),
+                            ("VERSION", "Version"),
+                            ("STREAM", "Stream"),
+                        ],
+                        max_length=20,
+                    ),
+                ),
+                ("name", models.TextField()),
+                ("parent", models.TextField(default="")),
+                ("data", models.JSONField(default=dict)),
+                ("errata_fingerprint", models.CharField(default="", max_length=64)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="collectorproductdefinition",
+            constraint=models.UniqueConstraint(
+                fields=("type", "name"), name="unique_collector_product_definition"
+            ),
+        ),
+    ]
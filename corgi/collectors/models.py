@@ -44,6 +44,33 @@ class CollectorErrataProductVariant(CollectorErrataModel):
     repos = fields.ArrayField(models.CharField(max_length=1024), default=list)
 
 
+class CollectorProductDefinition(models.Model):
+    """A product, version or stream from product-definitions, stored in a normalized form
+    as of the last time update_products applied it, so later syncs only apply what changed"""
+
+    class Type(models.TextChoices):
+        PRODUCT = "PRODUCT"
+        VERSION = "VERSION"
+        STREAM = "STREAM"
+
+    uuid = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    type = models.CharField(choices=Type.choices, max_length=20)
+    name = models.TextField()
+    # The name of the product for a version, or the version for a stream
+    parent = models.TextField(default="")
+    # The definition's own data from product-definitions, without its children
+    data = models.JSONField(default=dict)
+    # Hash of the Errata Tool data this definition was applied with
+    errata_fingerprint = models.CharField(max_length=64, default="")
+
+    class Meta:
+        constraints = (
+            models.UniqueConstraint(
+                name="unique_collector_product_definition", fields=("type", "name")
+            ),
+        )
+
+
 class CollectorRhelModule(models.Model):
 
     build_id = models.IntegerField(primary_key=True)
@@ -1,10 +1,12 @@
 import copy
 import logging
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Generator
 
 import requests
 from django.conf import settings
+from requests.adapters import HTTPAdapter
 
 from corgi.collectors.brew import Brew
 from corgi.collectors.models import CollectorRPMRepository
@@ -36,6 +38,10 @@ class Pulp:
     def __init__(self):
         self.session = requests.Session()
         self.session.cert = (settings.UMB_CERT, settings.UMB_KEY)
+        # Keep one connection open for each worker fetching pages concurrently
+        adapter = HTTPAdapter(pool_maxsize=settings.PULP_FETCH_WORKERS)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
 
     def get_active_repositories(self) -> int:
         """Fetch all Pulp repos which had something shipped in them, and their content sets."""
@@ -92,22 +98,50 @@ class Pulp:
 
     def _get_rpm_data(self, repo) -> defaultdict:
         rpms_by_srpm = defaultdict(list)
-        page = 0
-        rpm_criteria = copy.deepcopy(RPM_CRITERIA)
-        while True:
-            rpm_criteria["criteria"]["skip"] = PAGE_SIZE * page
-            page += 1
-            rpm_data = self._get_unit_data(repo, rpm_criteria)
+        for rpm_data in self._get_rpm_pages(repo):
             for entry in rpm_data:
                 filename = entry["metadata"]["filename"]
                 if filename.endswith(".src"):
                     continue
                 source_rpm = entry["metadata"]["sourcerpm"].removesuffix(".src.rpm")
                 rpms_by_srpm[source_rpm].append(filename)
-            if len(rpm_data) < PAGE_SIZE:
-                break
         return rpms_by_srpm
 
+    def _get_rpm_pages(self, repo: str) -> Generator[list[dict[str, dict]], None, None]:
+        """Yield each page of RPM units in a repo as soon as it's fetched, in any order
+        Pages are fetched concurrently, using the repo's RPM count to know how many there are"""
+        skips = range(0, max(self._get_rpm_count(repo), 1), PAGE_SIZE)
+        last_page_is_full = False
+        with ThreadPoolExecutor(max_workers=settings.PULP_FETCH_WORKERS) as executor:
+            futures = {executor.submit(self._get_rpm_page, repo, skip): skip for skip in skips}
+            for future in as_completed(futures):
+                rpm_data = future.result()
+                if futures[future] == skips[-1]:
+                    last_page_is_full = len(rpm_data) == PAGE_SIZE
+                yield rpm_data
+
+        # RPMs might have been added since we counted them, so keep going until we find the end
+        skip = skips[-1]
+        while last_page_is_full:
+            skip += PAGE_SIZE
+            rpm_data = self._get_rpm_page(repo, skip)
+            last_page_is_full = len(rpm_data) == PAGE_SIZE
+            yield rpm_data
+
+    def _get_rpm_count(self, repo: str) -> int:
+        """Return the number of RPM units in a repo, or 0 if Pulp doesn't report it"""
+        url = f"{settings.PULP_URL}/api/v2/repositories/{repo}/"
+        response = self.session.get(url)
+        if response.status_code == 404:
+            return 0
+        response.raise_for_status()
+        return response.json().get("content_unit_counts", {}).get("rpm", 0)
+
+    def _get_rpm_page(self, repo: str, skip: int) -> list[dict[str, dict]]:
+        rpm_criteria = copy.deepcopy(RPM_CRITERIA)
+        rpm_criteria["criteria"]["skip"] = skip
+        return self._get_unit_data(repo, rpm_criteria)
+
     def _get_unit_data(self, repo: str, criteria: dict) -> list[dict[str, dict]]:
         url = f"{settings.PULP_URL}/api/v2/repositories/{repo}/search/units/"
         response = self.session.post(url, json=criteria)
@@ -2,8 +2,9 @@ import logging
 import os
 from collections import defaultdict
 from datetime import datetime
-from typing import Generator, Tuple
+from typing import IO, Any, Container, Generator, Optional, Tuple
 
+import ijson
 import requests
 
 from corgi.collectors.brew import Brew
@@ -12,6 +13,53 @@ from corgi.tasks.common import BUILD_TYPE
 logger = logging.getLogger(__name__)
 
 
+def iter_compose_entries(
+    stream: IO[bytes], section: str, variants: Optional[Container[str]] = None
+) -> Generator[tuple[str, str, str, Any], None, None]:
+    """Incrementally parse a compose metadata file like rpms.json or modules.json, which map
+    payload.<section>.<variant>.<arch>.<key> to some value, and yield (variant, arch, key, value)
+    for each entry. Only one entry's value is held in memory at a time, so memory use doesn't
+    depend on the size of the compose. Entries for variants not in variants are skipped."""
+    # Key of each map we're currently inside, e.g. ["payload", "rpms", variant, arch, key]
+    keys: list[Optional[str]] = []
+    builder: Optional[ijson.ObjectBuilder] = None
+    # How many maps / arrays deep we are in the entry we're building or skipping
+    nesting = 0
+    skipping = False
+
+    for event, value in ijson.basic_parse(stream, use_float=True):
+        if builder is not None or skipping:
+            if builder is not None:
+                builder.event(event, value)
+            if event in ("start_map", "start_array"):
+                nesting += 1
+            elif event in ("end_map", "end_array"):
+                nesting -= 1
+            if nesting == 0:
+                if builder is not None:
+                    yield keys[2], keys[3], keys[4], builder.value  # type: ignore[misc]
+                builder = None
+                skipping = False
+            continue
+
+        if event == "map_key":
+            keys[-1] = value
+        elif len(keys) == 5 and keys[:2] == ["payload", section] and not event.startswith("end_"):
+            # This event starts an entry's value
+            if variants is not None and keys[2] not in variants:
+                skipping = event in ("start_map", "start_array")
+            elif event in ("start_map", "start_array"):
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+            else:
+                yield keys[2], keys[3], keys[4], value  # type: ignore[misc]
+            nesting = 1
+        elif event == "start_map":
+            keys.append(None)
+        elif event == "end_map":
+            keys.pop()
+
+
 class RhelCompose:
     @classmethod
     def fetch_compose_data(
@@ -55,20 +103,45 @@ class RhelCompose:
         compose_data["rhel_modules"] = list(cls._fetch_module_data(compose_url, variants))
         return compose_id, compose_created_date, compose_data
 
+    @staticmethod
+    def _stream_compose_entries(
+        url: str, section: str, variants: list[str]
+    ) -> Generator[tuple[str, str, str, Any], None, None]:
+        """Parse compose metadata directly off the socket, see iter_compose_entries"""
+        with requests.get(url, stream=True) as response:
+            if not response.ok:
+                return
+            response.raw.decode_content = True
+            yield from iter_compose_entries(response.raw, section, set(variants))
+
+    @classmethod
+    def iter_compose_modules(
+        cls, compose_url: str, variants: list[str]
+    ) -> Generator[tuple[str, str, str, list[str]], None, None]:
+        """Yield (variant, arch, module key, module RPMs) for each module in the given variants"""
+        for variant, arch, module_key, module in cls._stream_compose_entries(
+            compose_url + "modules.json", "modules", variants
+        ):
+            yield variant, arch, module_key, module["rpms"]
+
+    @classmethod
+    def iter_compose_rpms(
+        cls, compose_url: str, variants: list[str]
+    ) -> Generator[tuple[str, str, str, list[str]], None, None]:
+        """Yield (variant, arch, SRPM, RPM filenames) for each SRPM in the given variants"""
+        for variant, arch, srpm, rpm_details in cls._stream_compose_entries(
+            compose_url + "rpms.json", "rpms", variants
+        ):
+            rpms = [os.path.basename(rpm_detail["path"]) for rpm_detail in rpm_details.values()]
+            yield variant, arch, srpm, rpms
+
     @classmethod
     def _fetch_module_data(cls, compose_url, variants):
         # Fetch a list of RHEL modules.
-        response = requests.get(compose_url + "modules.json")
         brew = Brew(BUILD_TYPE)
         rhel_modules = {}
-        if response.ok:
-            for variant, variant_modules in response.json()["payload"]["modules"].items():
-                if variant in variants:
-                    for arch, modules in variant_modules.items():
-                        for module_key in modules.keys():
-                            rhel_modules[brew.module_key_to_nvr(module_key)] = modules[module_key][
-                                "rpms"
-                            ]
+        for _, _, module_key, module_rpms in cls.iter_compose_modules(compose_url, variants):
+            rhel_modules[brew.module_key_to_nvr(module_key)] = module_rpms
         yield from brew.persist_modules(rhel_modules)
 
     @classmethod
@@ -76,16 +149,7 @@ class RhelCompose:
         # Fetch list of SRPMs. These include epoch! We don't bother indexing this by arch since
         # we can look up the SRPM from our component data and get the information from there.
         brew = Brew(BUILD_TYPE)
-        response = requests.get(compose_url + "rpms.json")
-        if response.ok:
-            rpm_filenames_by_srpm = defaultdict(list)
-            for variant, variant_rpms in response.json()["payload"]["rpms"].items():
-                if variant in variants:
-                    for arch, rpms in variant_rpms.items():
-                        for rpm, rpm_details in rpms.items():
-                            for rpm_detail in rpm_details.values():
-                                rpm_filenames_by_srpm[brew.sans_epoch(rpm)].append(
-                                    os.path.basename(rpm_detail["path"])
-                                )
-
-            yield from brew.lookup_build_ids(rpm_filenames_by_srpm)
+        rpm_filenames_by_srpm = defaultdict(list)
+        for _, _, srpm, rpms in cls.iter_compose_rpms(compose_url, variants):
+            rpm_filenames_by_srpm[brew.sans_epoch(srpm)].extend(rpms)
+        yield from brew.lookup_build_ids(rpm_filenames_by_srpm)
@@ -1,152 +1,244 @@
+import bz2
+import gzip
+import hashlib
 import logging
+import lzma
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, Any, Callable, Generator, Iterable
+from xml.etree import ElementTree
+
+import yaml
+import zstandard
+from django.conf import settings
+from django.core.cache import caches
 
 from corgi.collectors.brew import Brew
+from corgi.collectors.fetcher import ConcurrentFetcher
 from corgi.collectors.pulp import Pulp
-from corgi.tasks.common import run_external
 
 logger = logging.getLogger(__name__)
 
-# Disable cache, subscription-manager plugins because they output stderr in OpenShift
-DNF_BASE_COMMAND = ["dnf", "--noplugins", "--quiet"]
+REPO_NS = "{http://linux.duke.edu/metadata/repo}"
+COMMON_NS = "{http://linux.duke.edu/metadata/common}"
+RPM_NS = "{http://linux.duke.edu/metadata/rpm}"
+
+# Shared by all Yum collectors in this process, so connections to each repo's host are reused
+repodata_fetcher = ConcurrentFetcher(
+    max_workers=settings.YUM_FETCH_WORKERS, max_per_host=settings.YUM_FETCH_WORKERS
+)
+
+
+class RepodataReader:
+    """Wrap a streamed repodata file, to decompress it and check its checksum while it's read"""
+
+    DECOMPRESSORS: dict[str, Callable[[Any], Any]] = {
+        ".bz2": lambda f: bz2.BZ2File(f),
+        ".gz": lambda f: gzip.GzipFile(fileobj=f),
+        ".xz": lambda f: lzma.LZMAFile(f),
+        ".zst": lambda f: zstandard.ZstdDecompressor().stream_reader(f),
+    }
+
+    def __init__(self, raw: IO[bytes], checksum_type: str) -> None:
+        self.raw = raw
+        self.hash = hashlib.new(checksum_type)
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.raw.read(size)
+        self.hash.update(data)
+        return data
+
+    def decompressed(self, href: str) -> IO[bytes]:
+        for suffix, decompressor in self.DECOMPRESSORS.items():
+            if href.endswith(suffix):
+                return decompressor(self)
+        return self  # type: ignore[return-value]
+
+    def check(self, checksum: str, url: str) -> None:
+        """Read anything left in the file, and raise an error if its checksum doesn't match"""
+        while self.read(1024 * 1024):
+            pass
+        if self.hash.hexdigest() != checksum:
+            raise ValueError(f"Checksum mismatch for {url}: expected {checksum}")
 
 
 class Yum:
-    """Get NVR / NEVRA / NSVCA data for an arbitrary repo using DNF commands.
+    """Get NVR / NEVRA / NSVCA data for an arbitrary repo by reading its repodata directly.
     Usually the Pulp collector should be used instead.
     This Yum collector is only needed for community repos,
     or Red Hat repos which aren't tracked in Pulp.
+
+    Parsed repodata is stored in the "yum" cache, keyed by the checksum of each file in the repo's
+    repomd.xml, so a repo's packages and modules are only downloaded again when they change.
     """
 
     def __init__(self, source: str):
         self.brew = Brew(source)
 
     @staticmethod
-    def filter_by_repos(command: list[str], repos: tuple[str, ...]) -> list[str]:
-        """Take some DNF command and run it against only the repos specified."""
-        repo_id = 1
-        for repo_name in repos:
-            command.append(f"--repofrompath={repo_id},{repo_name}")
-            command.append(f"--repoid={repo_id}")
-            repo_id += 1
-        return command
-
-    def get_modules(
-        self, module_names: list[str], repos: tuple[str, ...]
-    ) -> list[dict[str, dict[str, list[str]]]]:
-        """Helper function to get specific data for modules in particular Yum repos."""
-        command = DNF_BASE_COMMAND + ["module", "info"]
-        command = self.filter_by_repos(command, repos)
-        for module_name in module_names:
-            command.append(module_name)
-        _, output = run_external(command)
-
-        modules_lines = []
-        start_line_no = 0
-        for line_no in range(len(output)):
-            if output[line_no] == "":
-                modules_lines.append(output[start_line_no:line_no])
-                start_line_no = line_no + 1
-
-        return [self.parse_module(lines) for lines in modules_lines]
+    def get_repomd(repo: str) -> dict[str, tuple[str, str, str]]:
+        """Map each type of repodata in a repo, like "primary", to its (href, checksum type,
+        checksum) from the repo's repomd.xml"""
+        response = repodata_fetcher.get(f"{repo.rstrip('/')}/repodata/repomd.xml")
+        repomd = ElementTree.fromstring(response.content)
+        repodata = {}
+        for data in repomd.iterfind(f"{REPO_NS}data"):
+            location = data.find(f"{REPO_NS}location")
+            checksum = data.find(f"{REPO_NS}checksum")
+            if location is None or checksum is None:
+                continue
+            repodata[data.attrib["type"]] = (
+                location.attrib["href"],
+                checksum.attrib["type"],
+                checksum.text or "",
+            )
+        return repodata
 
-    def find_modules_from_yum_repos(
-        self, repos: tuple[str, ...]
-    ) -> list[dict[str, dict[str, list[str]]]]:
-        """List and collect info for all RPM modules in particular Yum repos."""
-        command = DNF_BASE_COMMAND + ["module", "list"]
-        command = self.filter_by_repos(command, repos)
-        _, output = run_external(command)
+    @classmethod
+    def _read_repodata(
+        cls,
+        repo: str,
+        repodata_type: str,
+        parse: Callable[[IO[bytes]], list],
+    ) -> list:
+        """Stream, decompress and parse one type of repodata for a repo, or return the cached
+        result if we've already parsed the same file. Returns [] if the repo has no such data"""
+        repomd = cls.get_repomd(repo)
+        if repodata_type not in repomd:
+            logger.info("Yum repository %s has no %s data", repo, repodata_type)
+            return []
+        href, checksum_type, checksum = repomd[repodata_type]
 
-        module_names = set()
-        yum_modules = []
-        # first line of the first block
-        is_block_start = True
-        for line in output:
-            pieces = line.split()
-            if line == "":
-                # empty line indicates a new block
-                is_block_start = True
-                continue
-            elif is_block_start:
-                # first line is usually the number / name of the repository
-                is_block_start = False
-                continue
-            elif len(pieces) > 1 and pieces[0] == "Name" and pieces[1] == "Stream":
-                # second line has the names of the columns of the table
+        cache_key = f"yum:{repodata_type}:{checksum_type}:{checksum}"
+        result = caches["yum"].get(cache_key)
+        if result is not None:
+            logger.info("Using cached %s data for Yum repository %s", repodata_type, repo)
+            return result
+
+        url = f"{repo.rstrip('/')}/{href}"
+        logger.info("Reading %s data for Yum repository %s from %s", repodata_type, repo, url)
+        with repodata_fetcher.session.get(url, stream=True) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            reader = RepodataReader(response.raw, checksum_type)
+            result = parse(reader.decompressed(href))
+            reader.check(checksum, url)
+        caches["yum"].set(cache_key, result)
+        return result
+
+    @staticmethod
+    def parse_primary(primary: IO[bytes]) -> list[tuple[str, str, str, str, str, str]]:
+        """Return (sourcerpm, name, epoch, version, release, arch) for each package in a
+        primary.xml file, parsing one package at a time"""
+        packages = []
+        for _, element in ElementTree.iterparse(primary):
+            if element.tag != f"{COMMON_NS}package":
                 continue
-            elif pieces[0] == "Hint:":
-                # last line is "Hint: [d]efault....."
+            version = element.find(f"{COMMON_NS}version")
+            sourcerpm = element.findtext(f"{COMMON_NS}format/{RPM_NS}sourcerpm") or ""
+            packages.append(
+                (
+                    sourcerpm,
+                    element.findtext(f"{COMMON_NS}name") or "",
+                    version.attrib.get("epoch", "0") if version is not None else "0",
+                    version.attrib.get("ver", "") if version is not None else "",
+                    version.attrib.get("rel", "") if version is not None else "",
+                    element.findtext(f"{COMMON_NS}arch") or "",
+                )
+            )
+            # Drop the parsed package, so memory use doesn't grow with the size of the repo
+            element.clear()
+        return packages
+
+    @staticmethod
+    def parse_modules(modules: IO[bytes]) -> list[dict[str, dict[str, Any]]]:
+        """Return each module in a modules.yaml file, in the same format as Pulp"""
+        # BaseLoader keeps every value as a string, so streams like 3.10 aren't parsed as floats
+        loader = getattr(yaml, "CBaseLoader", yaml.BaseLoader)
+        yum_modules = []
+        for document in yaml.load_all(modules, Loader=loader):
+            if not document or document.get("document") != "modulemd":
+                # Skip modulemd-defaults, modulemd-obsoletes, etc.
                 continue
-            # everything else is a module name in the first column
-            module_names.add(pieces[0])
+            data = document["data"]
+            yum_modules.append(
+                {
+                    "metadata": {
+                        "name": data["name"],
+                        "stream": data["stream"],
+                        "version": data["version"],
+                        "context": data["context"],
+                        "artifacts": data.get("artifacts", {}).get("rpms", []),
+                    }
+                }
+            )
+        return yum_modules
+
+    @staticmethod
+    def _map_repos(function: Callable[[str], list], repos: Iterable[str]) -> list:
+        """Call some function for each repo in parallel, and return all their results together"""
+        repos = tuple(repos)
+        with ThreadPoolExecutor(
+            max_workers=max(min(settings.YUM_FETCH_WORKERS, len(repos)), 1)
+        ) as executor:
+            return [item for result in executor.map(function, repos) for item in result]
 
-        if module_names:
-            yum_modules = self.get_modules(sorted(module_names), repos)
+    def find_modules_from_yum_repos(
+        self, repos: tuple[str, ...]
+    ) -> list[dict[str, dict[str, list[str]]]]:
+        """List and collect info for all RPM modules in particular Yum repos."""
+        return self._map_repos(
+            lambda repo: self._read_repodata(repo, "modules", self.parse_modules), repos
+        )
 
-        return yum_modules
+    def get_packages_from_yum_repos(
+        self, repos: tuple[str, ...]
+    ) -> list[tuple[str, str, str, str, str, str]]:
+        """List all packages in particular Yum repos"""
+        return self._map_repos(
+            lambda repo: self._read_repodata(repo, "primary", self.parse_primary), repos
+        )
 
     @staticmethod
-    def parse_module(lines: list[str]) -> dict[str, dict[str, list[str]]]:
-        """Parse text data for a specific module into a Python dictionary"""
-        res: dict[str, dict] = {"metadata": {"artifacts": []}}
-        for current_line_no, line in enumerate(lines):
-            pieces = line.split()
-
-            if pieces[0] in ("Name", "Stream", "Version", "Context"):
-                # Name             : python36
-                # Stream           : 3.6 [d][e][a]
-                # Version          : 820190123171828
-                # Context          : 17efdbc7
-                res["metadata"][pieces[0].lower()] = pieces[2]
-            elif pieces[0] == "Artifacts":
-                if len(pieces) > 2:
-                    # Artifacts : python3-docs-0:3.6.7-1.module+el8+2339+1a6691f8.noarch
-                    res["metadata"]["artifacts"].append(pieces[2])
-                # For each remaining line, which all describe the artifacts
-                # : python36-0:3.6.8-1.module+el8+2710+846623d6.x86_64
-                for artifact_line in lines[current_line_no + 1 :]:
-                    artifact_pieces = artifact_line.split()
-                    if artifact_pieces[0] == ":" and len(artifact_pieces) > 1:
-                        res["metadata"]["artifacts"].append(artifact_pieces[1])
-                # assume Artifacts is at the end of the module info
-                break
-            # else ignore Architecture, Profiles, Repo, Summary, Description, etc.
-
-        return res
+    def _latest_packages(
+        packages: Iterable[tuple[str, str, str, str, str, str]]
+    ) -> Generator[tuple[str, str, str, str, str, str], None, None]:
+        """Yield only the latest version of each package name and arch"""
+        # Only needed for latest=True, which nothing uses by default
+        import rpm
+
+        latest: dict[tuple[str, str], tuple[str, str, str, str, str, str]] = {}
+        for package in packages:
+            key = (package[1], package[5])
+            if key not in latest or rpm.labelCompare(package[2:5], latest[key][2:5]) > 0:
+                latest[key] = package
+        yield from latest.values()
 
     def get_nevras_from_yum_repos(
         self, repos: tuple[str, ...], latest: bool = False, ignore_source: bool = True
     ) -> dict[str, list[str]]:
         """Collect all NVR / NEVRAs for all SRPM / RPM pairs in particular Yum repos."""
-        command = DNF_BASE_COMMAND + [
-            "--disable-modular-filtering",
-            "repoquery",
-            "--all",
-            "--queryformat",
-            "%{sourcerpm} %{name}:%{epoch}-%{version}-%{release}.%{arch}",
-        ]
+        packages: Iterable[tuple[str, str, str, str, str, str]] = self.get_packages_from_yum_repos(
+            repos
+        )
         if latest:
-            command.append("--latest-limit=1")
-        command = self.filter_by_repos(command, repos)
-
-        _, output = run_external(command)
+            packages = self._latest_packages(packages)
 
-        # For each line of output, split apart values like below:
+        # Split apart each package's values like below:
         # "name-version-release.el8.src.rpm name:epoch-version-release.el8.noarch.rpm"
         # into separate NVRs (for SRPMs) and NEVRAs (for normal RPMs)
         nvr_nevra_mapping = defaultdict(list)
-        for line in output:
-            srpm, rpm = line.split()
-            if rpm.endswith(".src"):
-                # The first part is "(none)" and the second is the SRPM
+        for srpm, name, epoch, version, release, arch in packages:
+            rpm = f"{name}:{epoch}-{version}-{release}.{arch}"
+            if arch == "src":
+                # The package has no sourcerpm because it is the SRPM
                 if ignore_source:
                     continue
-                # Else the second part becomes the SRPM (without suffix) and the RPM is left blank
+                # The SRPM (without suffix) is the package itself and the RPM is left blank
                 srpm = rpm.replace(".src", "")
                 rpm = ""
             else:
-                # The first part is the SRPM, but Brew uses a different format
+                # The package has a sourcerpm, but Brew uses a different format
                 srpm = srpm.replace(".src.rpm", "")
             nvr_nevra_mapping[srpm].append(rpm)
         return nvr_nevra_mapping
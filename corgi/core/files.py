@@ -1,13 +1,19 @@
+import json
 import logging
+import random
 import re
+import time
 import uuid
 from abc import ABC, abstractmethod
 from datetime import datetime
 from string import Template
 from typing import Generator, Optional, Union
+from uuid import UUID
 
 from boolean import Expression as LicenseExpression
 from boolean import ParseError
+from django.conf import settings
+from django.core.cache import caches
 from django.db.models import Manager, QuerySet
 from license_expression import ExpressionError, LicenseSymbol
 from spdx_tools.common.spdx_licensing import spdx_licensing
@@ -33,6 +39,155 @@ from corgi.core.models import Component, ComponentNode, ProductStream
 
 logger = logging.getLogger(__name__)
 
+# Stream manifests are also written as pre-compressed copies with these suffixes
+# Ordered by preference, when a client accepts more than one encoding
+MANIFEST_CONTENT_ENCODINGS = {"zstd": ".zst", "gzip": ".gz"}
+
+
+def get_manifest_json_encoder() -> json.JSONEncoder:
+    """Return the encoder used to write manifest files, either compact or pretty-printed"""
+    if settings.MANIFEST_COMPACT_JSON:
+        return json.JSONEncoder(separators=(",", ":"))
+    return json.JSONEncoder(indent=4)
+
+
+def get_accepted_manifest_encoding(accept_encoding: str) -> str:
+    """Return the preferred manifest content encoding allowed by an Accept-Encoding header,
+    or an empty string if the client doesn't accept any of them"""
+    accepted = set()
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        # Encodings with q=0 are explicitly not acceptable
+        if re.fullmatch(r"q=0(\.0{0,3})?", params.strip().replace(" ", "")):
+            continue
+        accepted.add(name.strip().lower())
+    for encoding in MANIFEST_CONTENT_ENCODINGS:
+        if encoding in accepted:
+            return encoding
+    return ""
+
+
+SPDX_ID_PATTERN = re.compile(r"^SPDXRef-[a-zA-Z0-9.-]+$")
+LICENSE_REF_PATTERN = re.compile(r"LicenseRef-[a-zA-Z0-9.-]+")
+# Relationships may also point to these special values, instead of an SPDX element
+SPDX_NO_ELEMENT_VALUES = ("NOASSERTION", "NONE")
+
+
+def get_spdx_content_errors(content: dict) -> Generator[str, None, None]:
+    """Check the rules an SPDX 2.3 manifest is likely to break, in a single linear pass
+    over its JSON content. This is much faster than spdx-tools' validate_full_spdx_document,
+    which must first parse the content into model objects and then checks each relationship
+    against every element in the document. Yields a message for each problem that is found."""
+    if content.get("spdxVersion") != ManifestFile.SPDX_VERSION:
+        yield f"spdxVersion must be {ManifestFile.SPDX_VERSION}, got {content.get('spdxVersion')}"
+    if content.get("dataLicense") != ManifestFile.DATA_LICENSE:
+        yield f"dataLicense must be {ManifestFile.DATA_LICENSE}, got {content.get('dataLicense')}"
+    if content.get("SPDXID") != ManifestFile.DOCUMENT_REF:
+        yield f"document SPDXID must be {ManifestFile.DOCUMENT_REF}, got {content.get('SPDXID')}"
+    for field in ("name", "documentNamespace"):
+        if not content.get(field):
+            yield f"document is missing required field {field}"
+    creation_info = content.get("creationInfo", {})
+    for field in ("created", "creators"):
+        if not creation_info.get(field):
+            yield f"document creationInfo is missing required field {field}"
+
+    # SPDXIDs must be unique, and relationships must only reference SPDXIDs in the document
+    spdx_ids = {ManifestFile.DOCUMENT_REF}
+    used_license_refs = set()
+    for package in content.get("packages", []):
+        spdx_id = package.get("SPDXID", "")
+        if not SPDX_ID_PATTERN.match(spdx_id):
+            yield f"package SPDXID {spdx_id} is not a valid SPDX identifier"
+        elif spdx_id in spdx_ids:
+            yield f"package SPDXID {spdx_id} is not unique"
+        spdx_ids.add(spdx_id)
+        for field in ("name", "downloadLocation"):
+            if not package.get(field):
+                yield f"package {spdx_id} is missing required field {field}"
+        for field in ("licenseConcluded", "licenseDeclared"):
+            used_license_refs.update(LICENSE_REF_PATTERN.findall(package.get(field, "")))
+
+    has_describes_relationship = False
+    for relationship in content.get("relationships", []):
+        relationship_type = relationship.get("relationshipType")
+        if not relationship_type:
+            yield f"relationship {relationship} is missing required field relationshipType"
+        elif relationship_type == RelationshipType.DESCRIBES.name:
+            has_describes_relationship = True
+        element_id = relationship.get("spdxElementId")
+        if element_id not in spdx_ids:
+            yield f"relationship spdxElementId {element_id} does not exist in the document"
+        related_id = relationship.get("relatedSpdxElement")
+        if related_id not in spdx_ids and related_id not in SPDX_NO_ELEMENT_VALUES:
+            yield f"relationship relatedSpdxElement {related_id} does not exist in the document"
+    if not has_describes_relationship:
+        yield "document must have at least one DESCRIBES relationship"
+
+    # Every LicenseRef used by a package must be declared exactly once, with its extracted text
+    declared_license_refs = set()
+    for extracted_license in content.get("hasExtractedLicensingInfos", []):
+        license_id = extracted_license.get("licenseId", "")
+        if not LICENSE_REF_PATTERN.fullmatch(license_id):
+            yield f"extracted license {license_id} is not a valid LicenseRef"
+        elif license_id in declared_license_refs:
+            yield f"extracted license {license_id} is not unique"
+        declared_license_refs.add(license_id)
+        if not extracted_license.get("extractedText"):
+            yield f"extracted license {license_id} is missing required field extractedText"
+    for license_ref in sorted(used_license_refs - declared_license_refs):
+        yield f"{license_ref} is used by a package, but is not declared in the document"
+
+
+class PackageCache:
+    """Packages rendered for components, shared by all manifests rendered in the same run.
+    Keyed by each component's PK and last_changed, so changed components are rendered again.
+    Only packages without CPEs, and without license refs that depend on their manifest, are cached.
+    """
+
+    def __init__(self) -> None:
+        self.packages: dict[tuple[UUID, datetime], tuple[Package, tuple[str, ...]]] = {}
+        self.hits = 0
+        self.misses = 0
+        # Total time spent building packages which weren't cached, used to estimate time saved
+        self.build_seconds = 0.0
+
+    def get_stats(self) -> dict[str, Union[int, float]]:
+        return {"hits": self.hits, "misses": self.misses, "build_seconds": self.build_seconds}
+
+    @staticmethod
+    def summarize_stats(stats: dict[str, Union[int, float]]) -> str:
+        """Describe the hit rate and estimated time saved for some (possibly summed) stats"""
+        lookups = stats["hits"] + stats["misses"]
+        hit_rate = stats["hits"] / lookups if lookups else 0.0
+        average_build_seconds = stats["build_seconds"] / stats["misses"] if stats["misses"] else 0.0
+        seconds_saved = stats["hits"] * average_build_seconds
+        return (
+            f"{stats['hits']} hits / {lookups} lookups ({hit_rate:.1%} hit rate), "
+            f"saved about {seconds_saved:.1f}s of {stats['build_seconds']:.1f}s spent building"
+        )
+
+    def get_package(self, manifest_file: "ManifestFile", component: Component) -> Package:
+        key = (component.pk, component.last_changed)
+        if key in self.packages:
+            package, license_names = self.packages[key]
+            # The package refers to these licenses, so they must be declared in this manifest too
+            for license_name in license_names:
+                manifest_file.add_license_ref(license_name)
+            self.hits += 1
+            return package
+
+        start_time = time.monotonic()
+        first_license_name = len(manifest_file.license_names)
+        package = manifest_file.render_package(component)
+        self.build_seconds += time.monotonic() - start_time
+        self.misses += 1
+        license_names = tuple(manifest_file.license_names[first_license_name:])
+        # Refs using a counter instead of the license name are different in each manifest
+        if all(re.match(ManifestFile.VALID_LICENSE_REF, name) for name in license_names):
+            self.packages[key] = (package, license_names)
+        return package
+
 
 class ManifestFile(ABC):
     """A data file that represents a generic manifest in machine-readable SPDX / JSON format."""
@@ -58,6 +213,7 @@ class ManifestFile(ABC):
         "version",
         "release",
         "type",
+        "last_changed",
     ]
     VALID_LICENSE_REF = r"^[\w.-]*$"
     LICENSE_REF_PREFIX = "LicenseRef-"
@@ -78,11 +234,15 @@ class ManifestFile(ABC):
         "may not be accurate."
     )
 
-    def __init__(self) -> None:
+    def __init__(self, package_cache: Optional[PackageCache] = None) -> None:
         # Ensures a unique LicenceRef index per manifest
         self.license_ref_counter = 0
         # Stored external licenses per manifest
         self.extracted_licenses: dict[str, str] = {}
+        # Every license which was turned into a LicenseRef, in order, so cached packages can
+        # declare the same licenses again
+        self.license_names: list[str] = []
+        self.package_cache = package_cache
 
     @staticmethod
     def version_info(epoch: int, version: str, release: str) -> str:
@@ -159,6 +319,7 @@ class ManifestFile(ABC):
             return self._license_as_ref(license_raw)
 
     def add_license_ref(self, invalid_license: str):
+        self.license_names.append(invalid_license)
         if invalid_license in self.extracted_licenses:
             return self.extracted_licenses[invalid_license]
 
@@ -211,6 +372,14 @@ class ManifestFile(ABC):
 
     def build_package(
         self, component: Component, include_cpes: bool = False, package_id: str = ""
+    ) -> Package:
+        # CPEs come from the component's variants, which can change without the component changing
+        if self.package_cache and not include_cpes and not package_id:
+            return self.package_cache.get_package(self, component)
+        return self.render_package(component, include_cpes, package_id)
+
+    def render_package(
+        self, component: Component, include_cpes: bool = False, package_id: str = ""
     ) -> Package:
         external_references = [
             ExternalPackageRef(
@@ -286,6 +455,12 @@ class ManifestFile(ABC):
                 f"{message.context}"
             )
 
+    def validate_content(self, content: dict, document_name: str) -> None:
+        """Validate converted JSON content using the fast, linear-time SPDX checks"""
+        for message in get_spdx_content_errors(content):
+            logging.error(message)
+            raise ValueError(f"SPDX validation failed for component {document_name}: {message}")
+
     def _parse_license_expression(
         self, license_raw: str, concluded: bool
     ) -> Optional[LicenseExpression]:
@@ -322,6 +497,18 @@ class ComponentManifestFile(ManifestFile):
         self.component = component
         self.document_uuid = f"{self.REF_PREFIX}{component.pk}"
 
+    def render_cached_json(self) -> str:
+        """Return the manifest as JSON from the "manifests" cache, keyed by the component's UUID
+        and fingerprint. The manifest is only rendered and validated when it isn't cached yet"""
+        cache = caches["manifests"]
+        fingerprint = self.component.get_manifest_fingerprint()
+        cache_key = f"component-manifest:{self.component.pk}:{fingerprint}"
+        manifest_json = cache.get(cache_key)
+        if manifest_json is None:
+            manifest_json = json.dumps(self.render_content())
+            cache.set(cache_key, manifest_json)
+        return manifest_json
+
     def render_content(
         self, created_at: datetime = datetime.now(), document_uuid: str = ""
     ) -> dict:
@@ -355,16 +542,20 @@ class ComponentManifestFile(ManifestFile):
         document.relationships = relationships
 
         document.extracted_licensing_info = self.build_extracted_license_info()
-        self.validate_document(document, document_name)
+        # The full validator is slow for large components, so only run it on a sample of them
+        if random.random() < settings.MANIFEST_FULL_VALIDATION_SAMPLE_RATE:
+            self.validate_document(document, document_name)
 
-        return DocumentConverter().convert(document)
+        content = DocumentConverter().convert(document)
+        self.validate_content(content, document_name)
+        return content
 
 
 class ProductManifestFile(ManifestFile):
     """A data file that represents a product manifest in machine-readable SPDX / JSON format."""
 
-    def __init__(self, stream: ProductStream) -> None:
-        super().__init__()
+    def __init__(self, stream: ProductStream, package_cache: Optional[PackageCache] = None) -> None:
+        super().__init__(package_cache)
         self.stream = stream
 
     def render_content(
@@ -0,0 +1,73 @@
+# Generated by Django 3.2.25 on 2026-10-18 21:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0130_remove_unused_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ProductStreamComponent",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name="ID"
+                    ),
+                ),
+                (
+                    "type",
+                    models.CharField(
+                        choices=[
+                            ("ROOT", "Root"),
+                            ("PROVIDES", "Provides"),
+                            ("UPSTREAM", "Upstream"),
+                        ],
+                        max_length=20,
+                    ),
+                ),
+                (
+                    "component",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="core.component",
+                    ),
+                ),
+                (
+                    "productstream",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="aggregate_components",
+                        to="core.productstream",
+                    ),
+                ),
+                (
+                    "root_component",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="core.component",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="productstreamcomponent",
+            index=models.Index(
+                fields=["productstream", "type", "component"], name="core_produc_product_63b580_idx"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="productstreamcomponent",
+            constraint=models.UniqueConstraint(
+                fields=("productstream", "root_component", "component", "type"),
+                name="unique_productstreamcomponent",
+            ),
+        ),
+    ]
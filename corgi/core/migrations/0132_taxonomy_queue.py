@@ -0,0 +1,56 @@
+# Generated by Django 3.2.25 on 2026-10-18 22:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0131_productstreamcomponent"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TaxonomyQueueEntry",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name="ID"
+                    ),
+                ),
+                (
+                    "type",
+                    models.CharField(
+                        choices=[("BUILD", "Build"), ("STREAM", "Stream")], max_length=20
+                    ),
+                ),
+                ("build_id", models.CharField(default="", max_length=200)),
+                ("build_type", models.CharField(default="", max_length=20)),
+                ("product_stream", models.TextField(default="")),
+                ("changed_root_pks", models.JSONField(default=list)),
+                ("first_queued_at", models.DateTimeField()),
+                ("last_queued_at", models.DateTimeField()),
+                ("times_queued", models.PositiveIntegerField(default=1)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="taxonomyqueueentry",
+            index=models.Index(
+                fields=["type", "last_queued_at"], name="core_taxono_type_3ca012_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="taxonomyqueueentry",
+            index=models.Index(
+                fields=["type", "first_queued_at"], name="core_taxono_type_b49ff2_idx"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="taxonomyqueueentry",
+            constraint=models.UniqueConstraint(
+                fields=("type", "build_id", "build_type", "product_stream"),
+                name="unique_taxonomyqueueentry",
+            ),
+        ),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 3.2.25 on 2026-10-18 22:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0132_taxonomy_queue"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TaskRun",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name="ID"
+                    ),
+                ),
+                ("task_id", models.CharField(max_length=255, unique=True)),
+                ("task_name", models.CharField(max_length=255)),
+                ("key", models.CharField(default="", max_length=255)),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("STARTED", "Started"),
+                            ("SUCCESS", "Success"),
+                            ("FAILURE", "Failure"),
+                            ("RETRY", "Retry"),
+                        ],
+                        default="STARTED",
+                        max_length=20,
+                    ),
+                ),
+                ("started_at", models.DateTimeField()),
+                ("finished_at", models.DateTimeField(null=True)),
+                ("task_args", models.TextField(default="")),
+                ("task_kwargs", models.TextField(default="")),
+                ("summary", models.JSONField(null=True)),
+                ("traceback", models.TextField(default="")),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="taskrun",
+            index=models.Index(
+                fields=["task_name", "status", "started_at"], name="core_taskru_task_na_11f6e8_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="taskrun",
+            index=models.Index(
+                fields=["task_name", "key", "status", "started_at"],
+                name="core_taskru_task_na_328546_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="taskrun",
+            index=models.Index(
+                fields=["status", "finished_at"], name="core_taskru_status_4d330f_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="taskrun",
+            index=models.Index(fields=["started_at"], name="core_taskru_started_64bfc0_idx"),
+        ),
+    ]
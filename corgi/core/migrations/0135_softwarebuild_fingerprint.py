@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 22:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0134_job_watermarks"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="softwarebuild",
+            name="fingerprint",
+            field=models.CharField(default="", max_length=64),
+        ),
+    ]
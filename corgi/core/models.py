@@ -1,3 +1,5 @@
+import hashlib
+import json
 import logging
 import re
 from abc import abstractmethod
@@ -8,9 +10,10 @@ from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.postgres import fields
-from django.db import models, transaction
+from django.db import connections, models, transaction
 from django.db.models import ManyToManyField, Q, QuerySet
 from django.db.models.expressions import F, Func, Subquery, Value
+from django.utils import timezone
 from mptt.managers import TreeManager
 from mptt.models import MPTTModel, TreeForeignKey
 from packageurl import PackageURL
@@ -40,6 +43,37 @@ class NodeManager(TreeManager):
     def get_queryset(self, *args, **kwargs):
         return super().get_queryset(*args, **kwargs).order_by()
 
+    def bulk_create_children(self, parent: "NodeModel", children: list["NodeModel"]) -> list:
+        """Insert many new leaf nodes as the last children of some parent node, using one query
+        to make space for them in the parent's tree and one query to create them all,
+        instead of two queries for each node like MPTTModel.save()"""
+        if not children:
+            return []
+        opts = self.model._mptt_meta
+        with transaction.atomic():
+            # Lock the parent and use its current position in the tree,
+            # in case another task added nodes since the parent was loaded
+            parent_pos = (
+                self.select_for_update()
+                .values(opts.tree_id_attr, opts.right_attr, opts.level_attr)
+                .get(pk=parent.pk)
+            )
+            tree_id = parent_pos[opts.tree_id_attr]
+            right = parent_pos[opts.right_attr]
+            size = 2 * len(children)
+            # Same as MPTTModel.save() when inserting a node as the last child
+            self._create_space(size, right - 1, tree_id)
+
+            for index, child in enumerate(children):
+                child.parent = parent
+                setattr(child, opts.tree_id_attr, tree_id)
+                setattr(child, opts.level_attr, parent_pos[opts.level_attr] + 1)
+                setattr(child, opts.left_attr, right + 2 * index)
+                setattr(child, opts.right_attr, right + 2 * index + 1)
+            created = self.bulk_create(children)
+        setattr(parent, opts.right_attr, right + size)
+        return created
+
 
 class NodeModel(MPTTModel, TimeStampedModel):
     """Generic model for component and product taxonomies
@@ -263,6 +297,9 @@ class SoftwareBuild(TimeStampedModel):
     completion_time = models.DateTimeField(null=True)  # meta_attr["completion_time"]
     # Store meta attributes relevant to different build system types.
     meta_attr = models.JSONField(default=dict)
+    # Hash of the collected build data, so reprocessing an unchanged build skips rewriting its
+    # components. Only set once the build was fully processed, see get_build_fingerprint()
+    fingerprint = models.CharField(max_length=64, default="")
     # implicit field "components" from Component model's ForeignKey
     components: models.Manager["Component"]
 
@@ -697,17 +734,18 @@ class ProductStream(ProductModel):
     # is created by productstreams field on Component model
     components: "ComponentQuerySet"
 
+    # implicit "aggregate_components" field on ProductStream model
+    # is created by productstream field on ProductStreamComponent model
+    aggregate_components: models.Manager["ProductStreamComponent"]
+
     @property
     def provides_queryset(self, using: str = "read_only") -> QuerySet["Component"]:
         """Returns unique aggregate "provides" for the latest components in this stream,
         for use in templates"""
         unique_provides = (
-            self.components.manifest_components(ofuri=self.get_ofuri())
-            .using(using)
-            .values_list("provides__pk", flat=True)
-            .distinct()
-            .order_by("provides__pk")
-            .iterator()
+            self.aggregate_components.using(using)
+            .filter(type=ProductStreamComponent.Type.PROVIDES)
+            .values("component_id")
         )
         return (
             Component.objects.filter(pk__in=unique_provides)
@@ -725,17 +763,77 @@ class ProductStream(ProductModel):
         """Returns unique aggregate "upstreams" for the latest components in this stream,
         for use in templates"""
         unique_upstreams = (
-            # RPM upstream data is human-generated and unreliable
-            self.components.exclude(type=Component.Type.RPM)
-            .manifest_components(ofuri=self.get_ofuri())
-            .using(using)
-            .values_list("upstreams__pk", flat=True)
-            .distinct()
-            .order_by("upstreams__pk")
-            .iterator()
+            self.aggregate_components.using(using)
+            .filter(type=ProductStreamComponent.Type.UPSTREAM)
+            .values("component_id")
         )
         return Component.objects.filter(pk__in=unique_upstreams).using(using)
 
+    def refresh_aggregate_components(
+        self, changed_root_pks: Iterable[Union[UUID, str]] = ()
+    ) -> int:
+        """Update the stored provides / upstreams for the latest root components in this stream.
+        Only roots which were added to or removed from the stream, or whose component taxonomy
+        was saved again (passed in changed_root_pks), are updated. Returns the number of
+        roots which were updated"""
+        current_root_pks = set(
+            self.components.manifest_components(ofuri=self.get_ofuri())
+            .using("default")
+            .values_list("pk", flat=True)
+        )
+        stored_root_pks = set(
+            self.aggregate_components.filter(type=ProductStreamComponent.Type.ROOT).values_list(
+                "root_component_id", flat=True
+            )
+        )
+        changed_pks = stored_root_pks.union(current_root_pks).intersection(
+            UUID(str(pk)) for pk in changed_root_pks
+        )
+        removed_root_pks = (stored_root_pks - current_root_pks) | changed_pks
+        added_root_pks = (current_root_pks - stored_root_pks) | changed_pks
+        if not removed_root_pks and not added_root_pks:
+            return 0
+
+        aggregate_components = [
+            ProductStreamComponent(
+                productstream=self,
+                root_component_id=root_pk,
+                component_id=root_pk,
+                type=ProductStreamComponent.Type.ROOT,
+            )
+            for root_pk in added_root_pks
+        ]
+        # "provides" is the reverse side of the "sources" relationship
+        provides = Component.sources.through.objects.filter(
+            to_component_id__in=added_root_pks
+        ).values_list("to_component_id", "from_component_id")
+        # RPM upstream data is human-generated and unreliable
+        upstreams = (
+            Component.upstreams.through.objects.filter(from_component_id__in=added_root_pks)
+            .exclude(from_component__type=Component.Type.RPM)
+            .values_list("from_component_id", "to_component_id")
+        )
+        for aggregate_type, related_pks in (
+            (ProductStreamComponent.Type.PROVIDES, provides),
+            (ProductStreamComponent.Type.UPSTREAM, upstreams),
+        ):
+            aggregate_components.extend(
+                ProductStreamComponent(
+                    productstream=self,
+                    root_component_id=root_pk,
+                    component_id=related_pk,
+                    type=aggregate_type,
+                )
+                for root_pk, related_pk in related_pks.iterator()
+            )
+
+        with transaction.atomic():
+            self.aggregate_components.filter(root_component_id__in=removed_root_pks).delete()
+            ProductStreamComponent.objects.bulk_create(
+                aggregate_components, batch_size=1000, ignore_conflicts=True
+            )
+        return len(removed_root_pks | added_root_pks)
+
     @property
     def cpes_from_brew_tags(self):
         return self.distinct_inferred_variant_cpes()
@@ -796,6 +894,34 @@ class ProductStreamTag(Tag):
     tagged_model = models.ForeignKey(ProductStream, on_delete=models.CASCADE, related_name="tags")
 
 
+class ProductStreamComponent(models.Model):
+    """The provides and upstreams of each latest root component in a stream, stored so that
+    manifests and filters don't need to look up the latest components and join over their
+    provides / upstreams each time. Root components are also stored, to track which roots
+    have changed. Updated by ProductStream.refresh_aggregate_components()"""
+
+    class Type(models.TextChoices):
+        ROOT = "ROOT"
+        PROVIDES = "PROVIDES"
+        UPSTREAM = "UPSTREAM"
+
+    productstream = models.ForeignKey(
+        ProductStream, on_delete=models.CASCADE, related_name="aggregate_components"
+    )
+    root_component = models.ForeignKey("Component", on_delete=models.CASCADE, related_name="+")
+    component = models.ForeignKey("Component", on_delete=models.CASCADE, related_name="+")
+    type = models.CharField(choices=Type.choices, max_length=20)
+
+    class Meta:
+        constraints = (
+            models.UniqueConstraint(
+                name="unique_productstreamcomponent",
+                fields=("productstream", "root_component", "component", "type"),
+            ),
+        )
+        indexes = (models.Index(fields=("productstream", "type", "component")),)
+
+
 class ProductVariant(ProductModel):
     """Product Variant model
 
@@ -892,6 +1018,87 @@ class Channel(TimeStampedModel, ProductTaxonomyMixin):
         self.productvariants.set(variants)
 
 
+class ProductComponentRelationManager(models.Manager):
+    """Custom manager to create or update many relations with one query per batch"""
+
+    # Relations are unique on these fields, see unique_productcomponentrelation below
+    CONFLICT_FIELDS = ("external_system_id", "product_ref", "build_id", "build_type")
+
+    def upsert(
+        self,
+        relations: Iterable["ProductComponentRelation"],
+        update_fields: Iterable[str] = (),
+        batch_size: int = 1000,
+    ) -> list[str]:
+        """Save relations using INSERT ... ON CONFLICT, instead of get_or_create / update_or_create
+        for each relation. Relations which already exist are left alone, like get_or_create,
+        unless some update_fields are given, which are updated like update_or_create.
+        A nullable foreign key in update_fields, like software_build, is only updated when the
+        new value isn't None, so we don't unlink a build from an existing relation by mistake.
+
+        Returns the build_id of each relation that was created, so callers can process only
+        the builds which are new to some product instead of every build they saw."""
+        # Postgres can't insert and update the same row in one statement,
+        # so if the same relation is given more than once, only the last one is saved
+        unique_relations = {
+            tuple(str(getattr(relation, field)) for field in self.CONFLICT_FIELDS): relation
+            for relation in relations
+        }
+        if not unique_relations:
+            return []
+
+        connection = connections[self.db]
+        quote_name = connection.ops.quote_name
+        meta = self.model._meta
+        table = quote_name(meta.db_table)
+        fields = [field for field in meta.fields if field.concrete]
+        fields_by_name = {field.name: field for field in fields}
+        columns = ", ".join(quote_name(field.column) for field in fields)
+        conflict_columns = ", ".join(
+            quote_name(fields_by_name[field].column) for field in self.CONFLICT_FIELDS
+        )
+
+        update_fields = tuple(update_fields)
+        if update_fields:
+            assignments = []
+            for field_name in (*update_fields, "last_changed"):
+                update_field = fields_by_name[field_name]
+                column = quote_name(update_field.column)
+                if update_field.is_relation and update_field.null:
+                    assignments.append(f"{column} = COALESCE(EXCLUDED.{column}, {table}.{column})")
+                else:
+                    assignments.append(f"{column} = EXCLUDED.{column}")
+            on_conflict = f"DO UPDATE SET {', '.join(assignments)}"
+        else:
+            on_conflict = "DO NOTHING"
+
+        row_placeholder = f"({', '.join(['%s'] * len(fields))})"
+        build_id_column = quote_name(fields_by_name["build_id"].column)
+        created_build_ids: list[str] = []
+        batch = list(unique_relations.values())
+        with connection.cursor() as cursor:
+            for start in range(0, len(batch), batch_size):
+                chunk = batch[start : start + batch_size]
+                params = [
+                    # pre_save sets the auto_now timestamps, like Model.save() does
+                    field.get_db_prep_save(field.pre_save(relation, True), connection)
+                    for relation in chunk
+                    for field in fields
+                ]
+                # xmax is 0 for rows which were inserted, and nonzero for rows which were updated
+                cursor.execute(
+                    f"INSERT INTO {table} ({columns}) "
+                    f"VALUES {', '.join([row_placeholder] * len(chunk))} "
+                    f"ON CONFLICT ({conflict_columns}) {on_conflict} "
+                    f"RETURNING {build_id_column}, (xmax = 0)",
+                    params,
+                )
+                created_build_ids.extend(
+                    build_id for build_id, created in cursor.fetchall() if created
+                )
+        return created_build_ids
+
+
 class ProductComponentRelation(TimeStampedModel):
     """class to be used for linking taxonomies"""
 
@@ -929,6 +1136,8 @@ class ProductComponentRelation(TimeStampedModel):
     build_id = models.CharField(max_length=200, default="")
     build_type = models.CharField(choices=SoftwareBuild.Type.choices, max_length=20)
 
+    objects = ProductComponentRelationManager()
+
     class Meta:
         constraints = (
             models.UniqueConstraint(
@@ -962,6 +1171,134 @@ class ProductComponentRelation(TimeStampedModel):
         )
 
 
+class TaxonomyQueueEntryManager(models.Manager):
+    """Custom manager to add builds and streams to the taxonomy queue, coalescing duplicates"""
+
+    # Entries are unique on these fields, see unique_taxonomyqueueentry below
+    CONFLICT_FIELDS = ("type", "build_id", "build_type", "product_stream")
+
+    def enqueue(self, entries: Iterable["TaxonomyQueueEntry"]) -> None:
+        """Add entries to the queue using INSERT ... ON CONFLICT. An entry which is already queued
+        isn't added again, instead its last_queued_at time is reset, which restarts its quiet
+        period, and any new changed_root_pks are merged into its existing ones"""
+        unique_entries: dict[tuple[str, ...], TaxonomyQueueEntry] = {}
+        for entry in entries:
+            key = tuple(getattr(entry, field) for field in self.CONFLICT_FIELDS)
+            if key in unique_entries:
+                # Postgres can't insert and update the same row in one statement
+                unique_entries[key].changed_root_pks = sorted(
+                    {*unique_entries[key].changed_root_pks, *entry.changed_root_pks}
+                )
+            else:
+                unique_entries[key] = entry
+        if not unique_entries:
+            return
+
+        now = timezone.now()
+        connection = connections[self.db]
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        params: list[Any] = []
+        for entry in unique_entries.values():
+            params.extend(getattr(entry, field) for field in self.CONFLICT_FIELDS)
+            params.extend((json.dumps([str(pk) for pk in entry.changed_root_pks]), now, now))
+        row_placeholder = "(%s, %s, %s, %s, %s::jsonb, %s, %s, 1)"
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} (type, build_id, build_type, product_stream, "
+                "changed_root_pks, first_queued_at, last_queued_at, times_queued) "
+                f"VALUES {', '.join([row_placeholder] * len(unique_entries))} "
+                f"ON CONFLICT ({', '.join(self.CONFLICT_FIELDS)}) DO UPDATE SET "
+                "last_queued_at = EXCLUDED.last_queued_at, "
+                f"times_queued = {table}.times_queued + 1, "
+                "changed_root_pks = (SELECT COALESCE(jsonb_agg(DISTINCT pk), '[]'::jsonb) "
+                f"FROM jsonb_array_elements({table}.changed_root_pks || EXCLUDED.changed_root_pks) "
+                "AS pk)",
+                params,
+            )
+
+
+class TaxonomyQueueEntry(models.Model):
+    """A build or product stream whose taxonomy needs to be saved again. Builds and streams are
+    often changed many times within a few minutes, so instead of saving their taxonomy each time,
+    they're queued here once and processed by slow_drain_taxonomy_queue after they stop changing.
+    See corgi.tasks.common.queue_save_taxonomy"""
+
+    class Type(models.TextChoices):
+        BUILD = "BUILD"
+        STREAM = "STREAM"
+
+    type = models.CharField(choices=Type.choices, max_length=20)
+    # Set for builds
+    build_id = models.CharField(max_length=200, default="")
+    build_type = models.CharField(max_length=20, default="")
+    # Set for streams, with the root components whose taxonomy changed
+    product_stream = models.TextField(default="")
+    changed_root_pks = models.JSONField(default=list)
+    # When the entry was first queued, and queued again most recently
+    first_queued_at = models.DateTimeField()
+    last_queued_at = models.DateTimeField()
+    times_queued = models.PositiveIntegerField(default=1)
+
+    objects = TaxonomyQueueEntryManager()
+
+    class Meta:
+        constraints = (
+            models.UniqueConstraint(
+                name="unique_taxonomyqueueentry",
+                fields=("type", "build_id", "build_type", "product_stream"),
+            ),
+        )
+        indexes = (
+            models.Index(fields=("type", "last_queued_at")),
+            models.Index(fields=("type", "first_queued_at")),
+        )
+
+
+class TaskRun(models.Model):
+    """One run of a Celery task, recorded by the signal handlers in corgi.tasks.runs
+    Replaces scanning django_celery_results' TaskResult table, which stores args and results as
+    untyped text, with typed and indexed columns for how we look up past runs"""
+
+    class Status(models.TextChoices):
+        STARTED = "STARTED"
+        SUCCESS = "SUCCESS"
+        FAILURE = "FAILURE"
+        RETRY = "RETRY"
+
+    task_id = models.CharField(max_length=255, unique=True)
+    task_name = models.CharField(max_length=255)
+    # The thing a task ran for, like a stream name or build ID, taken from its first argument
+    key = models.CharField(max_length=255, default="")
+    status = models.CharField(choices=Status.choices, max_length=20, default=Status.STARTED)
+    started_at = models.DateTimeField()
+    finished_at = models.DateTimeField(null=True)
+    # Only used for reporting failures, so these aren't parsed
+    task_args = models.TextField(default="")
+    task_kwargs = models.TextField(default="")
+    # The task's return value if it's JSON-serializable, e.g. counts of things it processed
+    summary = models.JSONField(null=True)
+    traceback = models.TextField(default="")
+
+    class Meta:
+        indexes = (
+            models.Index(fields=("task_name", "status", "started_at")),
+            models.Index(fields=("task_name", "key", "status", "started_at")),
+            models.Index(fields=("status", "finished_at")),
+            models.Index(fields=("started_at",)),
+        )
+
+
+class JobWatermark(models.Model):
+    """How far an incremental periodic job, like fetch_unprocessed_brew_tag_relations, has
+    processed. The job only looks at things created after its watermark, which is advanced in the
+    same transaction as the work it covers. See corgi.tasks.common.watermark"""
+
+    name = models.CharField(max_length=255, unique=True)
+    # Everything created before this time has been processed
+    value = models.DateTimeField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+
 def get_product_details(
     variant_names: tuple[str, ...], stream_names: list[str]
 ) -> dict[str, set[str]]:
@@ -1881,7 +2218,12 @@ class Component(TimeStampedModel, ProductTaxonomyMixin):
         # If so, use the existing value for the field (or the empty string default value) instead
         return related_url if related_url else self.related_url
 
-    def save(self, *args, **kwargs):
+    # Fields which save() sets based on other fields, see set_computed_fields() below
+    COMPUTED_FIELDS = ("nvr", "nevra", "filename", "purl", "related_url", "el_match")
+
+    def set_computed_fields(self) -> bool:
+        """Set the nvr, purl and other fields which are computed from this component's data,
+        without saving. Returns True if the purl changed, so any nodes need the new purl"""
         self.nvr = self.get_nvr()
         self.nevra = self.get_nevra()
         if self.type == Component.Type.RPM:
@@ -1889,9 +2231,8 @@ class Component(TimeStampedModel, ProductTaxonomyMixin):
             self.filename = f"{self.nevra}.rpm"
 
         purl = self.get_purl().to_string()
-        if self.purl != purl:
-            self.purl = purl
-            self.cnodes.exclude(purl=purl).update(purl=purl)
+        purl_changed = self.purl != purl
+        self.purl = purl
 
         self.related_url = self._build_repo_url_for_type()
 
@@ -1899,6 +2240,11 @@ class Component(TimeStampedModel, ProductTaxonomyMixin):
         el_match = re.match(EL_MATCH_RE, self.release)
         if el_match:
             self.el_match = [x for x in el_match.groups() if x]
+        return purl_changed
+
+    def save(self, *args, **kwargs):
+        if self.set_computed_fields():
+            self.cnodes.exclude(purl=self.purl).update(purl=self.purl)
 
         super().save(*args, **kwargs)
 
@@ -2311,6 +2657,23 @@ class Component(TimeStampedModel, ProductTaxonomyMixin):
         """Return only the purls from the set of all upstream nodes"""
         return self.get_upstreams_nodes(using=using).values_list("purl", flat=True).distinct()
 
+    def get_manifest_fingerprint(self, using: str = "read_only") -> str:
+        """Return a hash of everything this Component's manifest is rendered from, so that cached
+        manifests can be reused until this Component or its provides / upstreams change"""
+        fingerprint = hashlib.sha256(f"{self.pk}:{self.last_changed.isoformat()}".encode())
+        for cpe in self.cpes.using(using):
+            fingerprint.update(f"|{cpe}".encode())
+        for related_components in (self.provides, self.upstreams):
+            fingerprint.update(b"/")
+            for pk, last_changed in (
+                related_components.db_manager(using)
+                .values_list("pk", "last_changed")
+                .order_by("pk")
+                .iterator()
+            ):
+                fingerprint.update(f"|{pk}:{last_changed.isoformat()}".encode())
+        return fingerprint.hexdigest()
+
     def disassociate_with_service_streams(self, stream_refs: Iterable[ProductStream]) -> None:
         """Disassociate this component with the passed in managed service ProductStreams,
         any child ProductModels, and any unused ancestor ProductModels in that service's hierarchy.
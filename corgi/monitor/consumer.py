@@ -1,23 +1,29 @@
 import json
 import logging
-from collections.abc import Callable
+import sqlite3
+from collections import Counter, defaultdict
+from collections.abc import Callable, Hashable
+from typing import Optional
 
 from django.conf import settings
-from proton import Event, SSLDomain
+from proton import Delivery, Event, Receiver, SSLDomain
 from proton.handlers import MessagingHandler
 from proton.reactor import Container, Selector
 
 from corgi.collectors.pnc import is_sbomer_product
-from corgi.tasks.brew import slow_update_brew_tags
+from corgi.monitor.spool import PendingTask, UMBSpool
+from corgi.tasks.brew import slow_refresh_brew_build_tags, slow_update_brew_tags
 from corgi.tasks.errata_tool import slow_handle_shipped_errata
+from corgi.tasks.fairshare import TaskSource, get_queue_length, set_default_task_source
 from corgi.tasks.pnc import slow_fetch_pnc_sbom, slow_handle_pnc_errata_released
 from corgi.tasks.pyxis import slow_fetch_pyxis_manifest
 
 logger = logging.getLogger(__name__)
 
-# A method which receives an event, and returns true if the message was accepted,
-# or false if it should be released back into the queue.
-HandleMethod = Callable[[Event], bool]
+
+# A method which receives an event, and returns the task to send for it, or None if the message
+# should be accepted without sending a task. Any error releases the message back into the queue.
+HandleMethod = Callable[[Event], Optional[PendingTask]]
 
 
 class UMBReceiverHandler(MessagingHandler):
@@ -25,7 +31,8 @@ class UMBReceiverHandler(MessagingHandler):
 
     def __init__(self, virtual_topic_addresses: dict[str, HandleMethod], selectors: dict[str, str]):
         """Set up a handler that listens to many topics and processes messages from each"""
-        super(UMBReceiverHandler, self).__init__()
+        # Don't let proton grant credit for more messages automatically, see update_credit()
+        super(UMBReceiverHandler, self).__init__(prefetch=0)
 
         # A mapping of virtual topic addresses to functions that handle topic messages
         # as determined by a specific listener.
@@ -58,6 +65,26 @@ class UMBReceiverHandler(MessagingHandler):
         # message that is accepted automatically (this is the default value).
         self.auto_settle = True
 
+        # Messages are held for settings.UMB_BATCH_WINDOW seconds, so that many messages about the
+        # same build or erratum (e.g. when it's tagged into many Brew tags at once) only send one
+        # task. Each message is only accepted once the task for it was sent to the Celery broker
+        self.pending_tasks: dict[tuple[Hashable, ...], PendingTask] = {}
+        self.pending_deliveries: defaultdict[tuple[Hashable, ...], list[Delivery]] = defaultdict(
+            list
+        )
+        self.flush_scheduled = False
+        # Counts of messages received, messages coalesced into another message's task,
+        # and tasks sent or which failed to send, since the consumer started
+        self.stats: Counter[str] = Counter()
+
+        # If a spool is configured, messages are accepted once their tasks are written to it,
+        # and the tasks are sent from the spool, so they survive Redis outages and restarts
+        self.spool = UMBSpool(settings.UMB_SPOOL_PATH) if settings.UMB_SPOOL_PATH else None
+        # We only ask the broker for more messages while the spool and the slow queue
+        # aren't backed up, so we don't keep accepting messages we can't process
+        self.receivers: list[Receiver] = []
+        self.paused = False
+
     def on_start(self, event: Event) -> None:
         """Connect to UMB broker(s) and set up a receiver for each virtual topic address"""
         logger.info("Connecting to broker(s): %s", self.urls)
@@ -65,9 +92,12 @@ class UMBReceiverHandler(MessagingHandler):
         for virtual_topic_address in self.virtual_topic_addresses:
             topic_selector = self.selectors.get(virtual_topic_address, "")
             recv_opts = [Selector(topic_selector)] if topic_selector else []
-            event.container.create_receiver(
+            receiver = event.container.create_receiver(
                 conn, virtual_topic_address, name=None, options=recv_opts
             )
+            self.receivers.append(receiver)
+        # Send any tasks left in the spool from before a restart
+        self.flush(event.container)
 
     def on_message(self, event: Event) -> None:
         """Route message to a handler function, based on the virtual topic it was received on"""
@@ -82,27 +112,191 @@ class UMBReceiverHandler(MessagingHandler):
 
         if not address:
             raise ValueError(f"UMB event {event.message.id} had no address!")
-        elif callback:
-            handled = callback(event)
-        else:
+        elif not callback:
             raise ValueError(
                 f"UMB event {event.message.id} had unrecognized address: {event.message.address}"
             )
 
-        if handled:
-            # Accept the delivered message to remove it from the queue.
-            self.accept(event.delivery)
-        else:
+        self.stats["received"] += 1
+        try:
+            pending_task = callback(event)
+        except Exception as exc:
+            logger.error("Failed to handle UMB event %s: %s", event.message.id, str(exc))
             # Release message back to the queue but report back that it was delivered. The
             # message will be re-delivered to any available client again.
             self.release(event.delivery, delivered=True)
+            return
+
+        if not pending_task:
+            # Nothing to do for this message, so accept it to remove it from the queue.
+            self.accept(event.delivery)
+            return
+
+        existing_task = self.pending_tasks.get(pending_task.key)
+        if existing_task:
+            self.stats["coalesced"] += 1
+            pending_task = self.coalesce(existing_task, pending_task)
+        self.pending_tasks[pending_task.key] = pending_task
+        self.pending_deliveries[pending_task.key].append(event.delivery)  # type: ignore[arg-type]
+
+        if settings.UMB_BATCH_WINDOW <= 0 or len(self.pending_tasks) >= settings.UMB_BATCH_MAX_SIZE:
+            self.flush(event.container)
+        else:
+            self.schedule_flush(event.container, settings.UMB_BATCH_WINDOW)
+            if not self.paused:
+                self.grant_credit()
+
+    def on_link_opened(self, event: Event) -> None:
+        """Ask for messages once each receiver is attached, including after reconnecting"""
+        if not self.paused:
+            self.grant_credit()
+
+    def on_timer_task(self, event: Event) -> None:
+        """Send the tasks for all messages received during the batch window,
+        and retry sending spooled tasks"""
+        self.flush_scheduled = False
+        self.flush(event.container)
+
+    def schedule_flush(self, container: Container, delay: float) -> None:
+        if not self.flush_scheduled:
+            container.schedule(delay, self)
+            self.flush_scheduled = True
+
+    def on_disconnected(self, event: Event) -> None:
+        """Forget any messages we haven't sent tasks for. They can't be accepted on a new
+        connection, so the broker will deliver them again after we reconnect"""
+        if self.pending_tasks:
+            logger.warning(
+                "Disconnected from UMB, %s messages will be redelivered",
+                sum(len(deliveries) for deliveries in self.pending_deliveries.values()),
+            )
+        self.pending_tasks.clear()
+        self.pending_deliveries.clear()
+
+    @staticmethod
+    def coalesce(existing_task: PendingTask, new_task: PendingTask) -> PendingTask:
+        """Combine two tasks for messages with the same key"""
+        if existing_task.task in (slow_update_brew_tags, slow_refresh_brew_build_tags):
+            # Several tags were added / removed for the same build, so read all its tags at once
+            build_id = int(existing_task.args[0])
+            return PendingTask(new_task.key, slow_refresh_brew_build_tags, (build_id,), {})
+        # Otherwise the newest message for e.g. an erratum replaces older ones
+        return new_task
+
+    def flush(self, container: Container) -> None:
+        """Send or spool the tasks for all pending messages, then ask for more messages
+        unless we're backed up"""
+        pending_tasks, pending_deliveries = self.pending_tasks, self.pending_deliveries
+        self.pending_tasks, self.pending_deliveries = {}, defaultdict(list)
+        if self.spool is None:
+            self.send(pending_tasks, pending_deliveries)
+        else:
+            self.write_to_spool(pending_tasks, pending_deliveries)
+            self.send_from_spool()
+        self.update_credit(container)
+
+    def send(
+        self,
+        pending_tasks: dict[tuple[Hashable, ...], PendingTask],
+        pending_deliveries: dict[tuple[Hashable, ...], list[Delivery]],
+    ) -> None:
+        """Send one task for each key, then accept all the messages it covers,
+        or release them back into the queue if the task couldn't be sent"""
+        for key, pending_task in pending_tasks.items():
+            try:
+                pending_task.task.apply_async(args=pending_task.args, kwargs=pending_task.kwargs)
+            except Exception as exc:
+                logger.error(
+                    "Failed to schedule %s task for %s: %s", pending_task.task.name, key, str(exc)
+                )
+                self.stats["failed"] += 1
+                for delivery in pending_deliveries[key]:
+                    self.release(delivery, delivered=True)
+            else:
+                self.stats["dispatched"] += 1
+                for delivery in pending_deliveries[key]:
+                    self.accept(delivery)
+        logger.info("Sent %s tasks for UMB events, totals: %s", len(pending_tasks), self.stats)
+
+    def write_to_spool(
+        self,
+        pending_tasks: dict[tuple[Hashable, ...], PendingTask],
+        pending_deliveries: dict[tuple[Hashable, ...], list[Delivery]],
+    ) -> None:
+        """Write the tasks for all pending messages to the spool in one transaction, then accept
+        the messages, or release them back into the queue if the spool couldn't be written"""
+        if not pending_tasks or self.spool is None:
+            return
+        deliveries = [delivery for key in pending_tasks for delivery in pending_deliveries[key]]
+        try:
+            self.spool.add(pending_tasks.values(), self.coalesce)
+        except sqlite3.Error as exc:
+            logger.error("Failed to spool %s tasks for UMB events: %s", len(pending_tasks), exc)
+            for delivery in deliveries:
+                self.release(delivery, delivered=True)
+            return
+        self.stats["spooled"] += len(pending_tasks)
+        for delivery in deliveries:
+            self.accept(delivery)
+
+    def send_from_spool(self) -> None:
+        """Send the oldest spooled tasks, and remove each from the spool once it was sent.
+        Stop at the first failure, since the Celery broker is probably down, and try again later"""
+        if self.spool is None:
+            return
+        sent = 0
+        for pending_task in self.spool.peek(settings.UMB_BATCH_MAX_SIZE):
+            try:
+                pending_task.task.apply_async(args=pending_task.args, kwargs=pending_task.kwargs)
+            except Exception as exc:
+                logger.error(
+                    "Failed to schedule %s task for %s, it will be retried: %s",
+                    pending_task.task.name,
+                    pending_task.key,
+                    str(exc),
+                )
+                self.stats["failed"] += 1
+                break
+            self.spool.remove(pending_task)
+            self.stats["dispatched"] += 1
+            sent += 1
+        logger.info("Sent %s spooled tasks for UMB events, totals: %s", sent, self.stats)
+
+    def update_credit(self, container: Container) -> None:
+        """Ask for more messages, unless the spool or the Celery queue is backed up.
+        While we're paused, or some tasks are still in the spool, check again later"""
+        spool_depth = len(self.spool) if self.spool is not None else 0
+        queue_depth = get_queue_length("slow") if settings.UMB_QUEUE_MAX_DEPTH else None
+        paused = bool(
+            settings.UMB_SPOOL_MAX_DEPTH and spool_depth >= settings.UMB_SPOOL_MAX_DEPTH
+        ) or bool(queue_depth is not None and queue_depth >= settings.UMB_QUEUE_MAX_DEPTH)
+        if paused != self.paused:
+            logger.warning(
+                "%s UMB messages, %s tasks in spool, %s tasks in slow queue",
+                "Pausing" if paused else "Resuming",
+                spool_depth,
+                queue_depth,
+            )
+            self.paused = paused
+            if paused:
+                self.stats["paused"] += 1
+        if not paused:
+            self.grant_credit()
+        if paused or spool_depth:
+            self.schedule_flush(container, settings.UMB_FLOW_CHECK_INTERVAL)
+
+    def grant_credit(self) -> None:
+        """Top up each receiver's credit, so the broker sends it up to UMB_PREFETCH messages"""
+        for receiver in self.receivers:
+            if receiver.credit < settings.UMB_PREFETCH:
+                receiver.flow(settings.UMB_PREFETCH - receiver.credit)
 
     ##########################
     # Message Handlers: Brew #
     ##########################
 
     @staticmethod
-    def brew_tags(event: Event) -> bool:
+    def brew_tags(event: Event) -> Optional[PendingTask]:
         """Handle messages about Brew builds that have tags added or removed"""
         logger.info("Handling UMB event for added or removed tags: %s", event.message.id)
         message = json.loads(event.message.body)
@@ -114,23 +308,13 @@ class UMBReceiverHandler(MessagingHandler):
         else:
             kwargs = {"tag_removed": tag_added_or_removed}
 
-        try:
-            slow_update_brew_tags.apply_async(args=(build_id,), kwargs=kwargs)
-        except Exception as exc:
-            logger.error(
-                "Failed to schedule slow_update_brew_tags task for build ID %s: %s",
-                build_id,
-                str(exc),
-            )
-            return False
-        else:
-            return True
+        return PendingTask(("brew_tags", build_id), slow_update_brew_tags, (build_id,), kwargs)
 
     ########################
     # Message Handlers: ET #
     ########################
     @staticmethod
-    def et_shipped_errata(event: Event) -> bool:
+    def et_shipped_errata(event: Event) -> Optional[PendingTask]:
         """Handle messages about ET advisories that enter the SHIPPED_LIVE state"""
         logger.info("Handling UMB event for shipped erratum: %s", event.message.id)
         message = json.loads(event.message.body)
@@ -144,64 +328,43 @@ class UMBReceiverHandler(MessagingHandler):
                 f"Received event with wrong status for erratum {errata_id}: {errata_status}"
             )
 
-        try:
-            # If an erratum has the wrong status, we'll raise an error in the task
-            # Errata for PNC/SBOMer products won't have attached artifacts, so handle
-            # those separately
-            if is_sbomer_product(errata_product, errata_release):
-                slow_handle_pnc_errata_released.apply_async(args=(errata_id, errata_status))
-            else:
-                slow_handle_shipped_errata.apply_async(args=(errata_id, errata_status))
-        except Exception as exc:
-            logger.error(
-                "Failed to schedule slow_handle_shipped_errata task for erratum ID %s: %s",
-                errata_id,
-                str(exc),
-            )
-            return False
+        # If an erratum has the wrong status, we'll raise an error in the task
+        # Errata for PNC/SBOMer products won't have attached artifacts, so handle
+        # those separately
+        if is_sbomer_product(errata_product, errata_release):
+            task = slow_handle_pnc_errata_released
         else:
-            return True
+            task = slow_handle_shipped_errata
+        return PendingTask(("errata", errata_id), task, (errata_id, errata_status), {})
 
     ############################
     # Message Handlers: SBOMer #
     ############################
     @staticmethod
-    def sbomer_complete(event: Event) -> bool:
+    def sbomer_complete(event: Event) -> Optional[PendingTask]:
         logger.info(f"Handling UMB message for PNC SBOM {event.message.id}")
         message = json.loads(event.message.body)
-        try:
-            slow_fetch_pnc_sbom.delay(
-                message["purl"],
-                message["productConfig"]["errataTool"],
-                message["sbom"],
-            )
-        except Exception as e:
-            logger.error(f"Failed to schedule PNC SBOM fetch {event.message.id}: {str(e)}")
-            return False
-        else:
-            return True
+        return PendingTask(
+            ("sbomer", message["sbom"]["id"]),
+            slow_fetch_pnc_sbom,
+            (message["purl"], message["productConfig"]["errataTool"], message["sbom"]),
+            {},
+        )
 
     ############################
     # Message Handlers: pyxis  #
     ############################
     @staticmethod
-    def pyxis_manifest_create(event: Event) -> bool:
+    def pyxis_manifest_create(event: Event) -> Optional[PendingTask]:
         logger.info(f"Handling UMB message for pyxis manifest {event.message.id}")
         message = json.loads(event.message.body)
 
-        try:
-            created_by = message["entityData"]["created_by"]
-            if created_by == "hacbs-release-pyxis":
-                slow_fetch_pyxis_manifest.delay(message["entityData"]["_id"]["$oid"])
-            else:
-                logger.info(f"Not scheduling pyxis manifest fetch {event.message.id}: {created_by}")
-
-        except Exception as e:
-            logger.error(f"Failed to schedule pyxis manifest fetch {event.message.id}: {str(e)}")
-            return False
-
-        else:
-            return True
+        created_by = message["entityData"]["created_by"]
+        if created_by != "hacbs-release-pyxis":
+            logger.info(f"Not scheduling pyxis manifest fetch {event.message.id}: {created_by}")
+            return None
+        manifest_id = message["entityData"]["_id"]["$oid"]
+        return PendingTask(("pyxis", manifest_id), slow_fetch_pyxis_manifest, (manifest_id,), {})
 
 
 class UMBListener:
@@ -231,6 +394,8 @@ class UMBListener:
     def consume(cls):
         """Run a single message handler, which can listen to multiple virtual topic addresses"""
         logger.info("Starting consumer for virtual topic(s): %s", cls.virtual_topic_addresses)
+        # Every task sent by this process handles a fresh UMB event
+        set_default_task_source(TaskSource.UMB)
         Container(
             UMBReceiverHandler(
                 virtual_topic_addresses=cls.virtual_topic_addresses,
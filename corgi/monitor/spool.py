@@ -0,0 +1,110 @@
+"""A local, on-disk spool for tasks to send for UMB messages
+
+Messages are accepted once their tasks are safely written to the spool, and tasks are only removed
+from the spool once they were sent to the Celery broker. If Redis is down or the consumer restarts,
+the spooled tasks are sent later instead of being lost, without holding the messages unsettled.
+"""
+
+import json
+import sqlite3
+import time
+from collections.abc import Callable, Hashable, Iterable
+from typing import Any, NamedTuple
+
+from config.celery import app
+
+
+class PendingTask(NamedTuple):
+    """A task to send for some UMB message. Messages with the same key, like the kind of event and
+    the build or erratum ID it's for, are coalesced into a single task"""
+
+    key: tuple[Hashable, ...]
+    task: Any
+    args: tuple
+    kwargs: dict
+
+
+class UMBSpool:
+    """Tasks waiting to be sent to Celery, stored in a SQLite database in WAL mode"""
+
+    def __init__(self, path: str):
+        # Only used by the single thread of the proton container
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # Make sure each write is on disk before the messages it covers are accepted
+        self.connection.execute("PRAGMA synchronous=FULL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS pending_tasks ("
+            "key TEXT PRIMARY KEY, task_name TEXT NOT NULL, args TEXT NOT NULL, "
+            "kwargs TEXT NOT NULL, spooled_at REAL NOT NULL)"
+        )
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM pending_tasks").fetchone()[0]
+
+    @staticmethod
+    def _dump_key(key: tuple[Hashable, ...]) -> str:
+        return json.dumps(key)
+
+    @staticmethod
+    def _load(task_name: str, key: str, args: str, kwargs: str) -> PendingTask:
+        return PendingTask(
+            tuple(json.loads(key)),
+            app.tasks[task_name],
+            tuple(json.loads(args)),
+            json.loads(kwargs),
+        )
+
+    def add(
+        self,
+        pending_tasks: Iterable[PendingTask],
+        coalesce: Callable[[PendingTask, PendingTask], PendingTask],
+    ) -> None:
+        """Write all the given tasks in a single transaction, coalescing each with any task
+        for the same key that's still waiting in the spool"""
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            for pending_task in pending_tasks:
+                key = self._dump_key(pending_task.key)
+                existing = self.connection.execute(
+                    "SELECT task_name, key, args, kwargs FROM pending_tasks WHERE key = ?", (key,)
+                ).fetchone()
+                if existing:
+                    pending_task = coalesce(self._load(*existing), pending_task)
+                    # Keep the original spooled_at, so the task keeps its place in line
+                    self.connection.execute(
+                        "UPDATE pending_tasks SET task_name = ?, args = ?, kwargs = ? "
+                        "WHERE key = ?",
+                        (
+                            pending_task.task.name,
+                            json.dumps(pending_task.args),
+                            json.dumps(pending_task.kwargs),
+                            key,
+                        ),
+                    )
+                else:
+                    self.connection.execute(
+                        "INSERT INTO pending_tasks (key, task_name, args, kwargs, spooled_at) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (
+                            key,
+                            pending_task.task.name,
+                            json.dumps(pending_task.args),
+                            json.dumps(pending_task.kwargs),
+                            time.time(),
+                        ),
+                    )
+
+    def peek(self, limit: int) -> list[PendingTask]:
+        """Return up to limit of the oldest tasks in the spool"""
+        rows = self.connection.execute(
+            "SELECT task_name, key, args, kwargs FROM pending_tasks ORDER BY spooled_at LIMIT ?",
+            (limit,),
+        ).fetchall()
+        return [self._load(*row) for row in rows]
+
+    def remove(self, pending_task: PendingTask) -> None:
+        """Remove a task from the spool, once it was sent"""
+        self.connection.execute(
+            "DELETE FROM pending_tasks WHERE key = ?", (self._dump_key(pending_task.key),)
+        )
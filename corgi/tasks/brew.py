@@ -1,18 +1,28 @@
+import time
+from collections import defaultdict
 from datetime import datetime, timedelta
 from typing import Any, Optional
 
 import koji
+from celery.exceptions import SoftTimeLimitExceeded
 from celery.utils.log import get_task_logger
 from celery_singleton import Singleton
 from django.conf import settings
 from django.db import IntegrityError, transaction
-from django.db.models import Count, Q, QuerySet
+from django.db.models import Count, OuterRef, Q, QuerySet, Subquery
 from django.utils import dateformat, dateparse, timezone
 from django.utils.timezone import make_aware
 from requests import RequestException
 
 from config.celery import app
-from corgi.collectors.brew import ADVISORY_REGEX, Brew, BrewBuildTypeNotSupported
+from corgi.collectors.brew import (
+    ADVISORY_REGEX,
+    FINGERPRINT_EXCLUDED_KEYS,
+    Brew,
+    BrewBuildTypeNotSupported,
+    get_build_fingerprint,
+)
+from corgi.collectors.models import CollectorRhelModule
 from corgi.collectors.pyxis import get_repo_for_label
 from corgi.core.constants import CONTAINER_REPOSITORY
 from corgi.core.models import (
@@ -28,12 +38,14 @@ from corgi.tasks.common import (
     RETRY_KWARGS,
     RETRYABLE_ERRORS,
     create_relations,
-    get_last_success_for_task,
+    fetch_builds_in_chunks,
+    queue_save_taxonomy,
     save_node,
     set_license_declared_safely,
-    slow_save_taxonomy,
+    watermark,
 )
 from corgi.tasks.errata_tool import slow_load_errata
+from corgi.tasks.prod_defs import slow_reset_build_product_taxonomy
 from corgi.tasks.pyxis import (
     slow_fetch_pyxis_image_by_nvr,
     slow_update_name_for_container_from_pyxis,
@@ -49,14 +61,36 @@ def slow_fetch_brew_build(
     build_type: str = BUILD_TYPE,
     save_product: bool = True,
     force_process: bool = False,
+    force_rewrite: bool = False,
 ) -> bool:
+    return fetch_brew_build(
+        build_id, build_type, save_product, force_process, force_rewrite=force_rewrite
+    )
+
+
+def fetch_brew_build(
+    build_id: str,
+    build_type: str = BUILD_TYPE,
+    save_product: bool = True,
+    force_process: bool = False,
+    brew: Optional[Brew] = None,
+    build_info: Optional[dict[str, Any]] = None,
+    force_rewrite: bool = False,
+) -> bool:
+    """Fetch a single build, optionally reusing a Brew collector and build info
+    which were already looked up for a whole chunk of builds
+
+    When force_process reprocesses a build whose data in Brew hasn't changed since it was
+    last processed, only its tags and relations are updated. Use force_rewrite to save
+    all its components again anyway"""
     logger.info("Fetch brew build called with build id: %s", build_id)
+    force_process |= force_rewrite
 
     try:
         softwarebuild = SoftwareBuild.objects.get(build_id=build_id, build_type=build_type)
     except SoftwareBuild.DoesNotExist:
         # Process the build below
-        pass
+        softwarebuild = None
     else:
         logger.info("Already processed build_id %s", build_id)
 
@@ -66,14 +100,14 @@ def slow_fetch_brew_build(
             # But we want to save the taxonomy again
             if save_product:
                 logger.info("Only saving product taxonomy for build_id %s", build_id)
-                slow_save_taxonomy.delay(build_id, build_type)
+                queue_save_taxonomy(build_id, build_type)
             return False
         # Else build exists, but we do want to reload it
     # Else build doesn't exist
     logger.info("Fetching brew build with build_id: %s", build_id)
 
     try:
-        component = Brew(build_type).get_component_data(int(build_id))
+        component = (brew or Brew(build_type)).get_component_data(int(build_id), build_info)
     except BrewBuildTypeNotSupported as exc:
         logger.warning(str(exc))
         return False
@@ -82,6 +116,12 @@ def slow_fetch_brew_build(
         logger.info("No data fetched for build %s from Brew, exiting...", build_id)
         return False
 
+    fingerprint = get_build_fingerprint(component)
+    if softwarebuild and softwarebuild.fingerprint == fingerprint and not force_rewrite:
+        logger.info("Build %s is unchanged in Brew, only updating its tags", build_id)
+        _update_unchanged_build(softwarebuild, component, save_product, force_process)
+        return False
+
     build_meta = component["build_meta"]["build_info"]
     build_meta["corgi_ingest_start_dt"] = dateformat.format(timezone.now(), "Y-m-d H:i:s")
     build_meta["corgi_ingest_status"] = "INPROGRESS"
@@ -118,7 +158,7 @@ def slow_fetch_brew_build(
 
     # Allow async call of slow_load_errata task, see CORGI-21
     if save_product:
-        slow_save_taxonomy.delay(build_id, build_type)
+        queue_save_taxonomy(build_id, build_type)
 
     for released_erratum in build_meta.get("released_errata_tags", []):
         slow_load_errata.delay(released_erratum, force_process=force_process)
@@ -129,6 +169,10 @@ def slow_fetch_brew_build(
     if settings.SCA_ENABLED:
         cpu_software_composition_analysis.delay(str(softwarebuild.pk), force_process=force_process)
 
+    # Only record the fingerprint once the build was fully processed, so a build which failed
+    # partway through is processed again next time
+    SoftwareBuild.objects.filter(pk=softwarebuild.pk).update(fingerprint=fingerprint)
+
     logger.info(
         "Created build (%s) or root (%s) or child(ren) (%s) for brew build: (%s, %s)",
         build_created,
@@ -141,6 +185,36 @@ def slow_fetch_brew_build(
     return build_created or root_created or any_child_created
 
 
+def _update_unchanged_build(
+    softwarebuild: SoftwareBuild, component: dict[str, Any], save_product: bool, force_process: bool
+) -> None:
+    """Save only the tags and relations for a build whose components haven't changed"""
+    build_meta = component["build_meta"]["build_info"]
+    for key in FINGERPRINT_EXCLUDED_KEYS:
+        softwarebuild.meta_attr[key] = build_meta.get(key, [])
+    softwarebuild.save(update_fields=["meta_attr", "last_changed"])
+
+    update_relation_software_build_fk(
+        softwarebuild.build_id, softwarebuild.build_type, softwarebuild
+    )
+    new_relations = load_brew_tags(softwarebuild, build_meta["tags"])
+    logger.info(f"Created {new_relations} for brew tags in {softwarebuild.build_id}")
+
+    if save_product:
+        queue_save_taxonomy(softwarebuild.build_id, softwarebuild.build_type)
+
+    for released_erratum in build_meta.get("released_errata_tags", []):
+        slow_load_errata.delay(released_erratum, force_process=force_process)
+
+    # Nested builds have their own fingerprints, so they're only rewritten if they changed
+    _get_nested_builds(
+        softwarebuild.build_type,
+        component.get("nested_builds", ()),
+        force_process,
+        save_product,
+    )
+
+
 def _get_nested_builds(
     build_type: str, nested_builds: set[int], force_process: bool, save_product: bool
 ) -> None:
@@ -252,6 +326,130 @@ def slow_fetch_modular_build(
     return created or node_created or any_child_created
 
 
+@app.task(
+    base=Singleton,
+    autoretry_for=RETRYABLE_ERRORS,
+    retry_kwargs=RETRY_KWARGS,
+    priority=6,
+    soft_time_limit=settings.CELERY_LONGEST_SOFT_TIME_LIMIT,
+)
+def slow_fetch_brew_builds(
+    build_ids: list[str],
+    build_type: str = BUILD_TYPE,
+    modular: bool = False,
+    save_product: bool = True,
+    force_process: bool = False,
+) -> dict[str, Any]:
+    """Fetch a chunk of builds in a single task, instead of one slow_fetch_brew_build or
+    slow_fetch_modular_build task per build. The builds share one Brew session, and are looked up
+    with a single getBuild multicall and a few DB queries for the whole chunk.
+
+    Builds which fail with a retryable error are retried in their own task, so one bad build
+    doesn't make the whole chunk run again. Returns a summary of the chunk, which is saved
+    as this task's only result"""
+    started = time.monotonic()
+    build_ids = list(dict.fromkeys(str(build_id) for build_id in build_ids))
+    summary: dict[str, Any] = {
+        "builds": len(build_ids),
+        "modules": 0,
+        "existing": 0,
+        "fetched": 0,
+        "retried": [],
+        "failed": {},
+    }
+    task_kwargs = {"save_product": save_product, "force_process": force_process}
+
+    if modular:
+        # Same check as Brew.fetch_rhel_module, but for all builds in the chunk at once
+        # Module build_ids can also be NVRs, which are never SRPM build_ids
+        module_ids = {build_id for build_id in build_ids if not build_id.isdigit()}
+        module_ids.update(
+            str(build_id)
+            for build_id in CollectorRhelModule.objects.filter(
+                build_id__in=[int(build_id) for build_id in build_ids if build_id.isdigit()]
+            ).values_list("build_id", flat=True)
+        )
+        for build_id in module_ids:
+            try:
+                slow_fetch_modular_build(build_id, **task_kwargs)
+            except Exception as exc:
+                _handle_chunk_error(summary, build_id, exc, slow_fetch_modular_build, (build_id,))
+            else:
+                summary["modules"] += 1
+        build_ids = [build_id for build_id in build_ids if build_id not in module_ids]
+        # Like slow_fetch_modular_build, builds which aren't modules use the default save_product
+        task_kwargs = {"force_process": force_process}
+
+    if not force_process:
+        existing_build_ids = set(
+            SoftwareBuild.objects.filter(build_id__in=build_ids, build_type=build_type).values_list(
+                "build_id", flat=True
+            )
+        )
+        if existing_build_ids:
+            # Same as update_relation_software_build_fk, but for all existing builds at once
+            ProductComponentRelation.objects.filter(
+                build_id__in=existing_build_ids, build_type=build_type, software_build__isnull=True
+            ).update(
+                software_build=Subquery(
+                    SoftwareBuild.objects.filter(
+                        build_id=OuterRef("build_id"), build_type=build_type
+                    ).values("pk")[:1]
+                )
+            )
+            if task_kwargs.get("save_product", True):
+                for build_id in existing_build_ids:
+                    queue_save_taxonomy(build_id, build_type)
+        summary["existing"] = len(existing_build_ids)
+        build_ids = [build_id for build_id in build_ids if build_id not in existing_build_ids]
+
+    brew = Brew(build_type)
+    build_infos = brew.get_builds(int(build_id) for build_id in build_ids)
+    for build_id in build_ids:
+        try:
+            fetch_brew_build(
+                build_id,
+                build_type,
+                brew=brew,
+                build_info=build_infos.get(int(build_id)),
+                **task_kwargs,
+            )
+        except Exception as exc:
+            _handle_chunk_error(
+                summary, build_id, exc, slow_fetch_brew_build, (build_id, build_type), task_kwargs
+            )
+        else:
+            summary["fetched"] += 1
+
+    summary["seconds"] = round(time.monotonic() - started, 1)
+    logger.info("Fetched chunk of %s builds: %s", build_type, summary)
+    if summary["failed"]:
+        # Fail the task so the chunk is reported with other failed tasks, but only after
+        # all the other builds in the chunk were processed
+        raise ValueError(f"Failed to fetch some builds in chunk: {summary}")
+    return summary
+
+
+def _handle_chunk_error(
+    summary: dict[str, Any],
+    build_id: str,
+    exc: Exception,
+    task: app.task,
+    args: tuple,
+    kwargs: Optional[dict[str, bool]] = None,
+) -> None:
+    """Retry a build from a chunk in its own task, or record why it failed in the chunk summary"""
+    if isinstance(exc, SoftTimeLimitExceeded):
+        raise exc
+    if isinstance(exc, RETRYABLE_ERRORS):
+        logger.warning("Retrying build %s outside of its chunk after error: %s", build_id, exc)
+        task.apply_async(args=args, kwargs=kwargs or {})
+        summary["retried"].append(build_id)
+    else:
+        logger.exception("Failed to fetch build %s in chunk", build_id, exc_info=exc)
+        summary["failed"][build_id] = repr(exc)
+
+
 def save_component(component: dict, parent: ComponentNode) -> bool:
     logger.debug("Called save component with component %s", component)
     component_type = component.pop("type")
@@ -689,7 +887,7 @@ def slow_save_container_children(
 
         # Incomplete provides / upstreams ForeignKeys are probably still better
         # than timeouts / failing to load a build and create all the child components
-        slow_save_taxonomy.delay(build_id, build_type)
+        queue_save_taxonomy(build_id, build_type)
     return any_go_module_created or any_source_created or any_cachito_created
 
 
@@ -769,26 +967,103 @@ def save_upstream(
     soft_time_limit=settings.CELERY_LONGEST_SOFT_TIME_LIMIT,
 )
 def load_stream_brew_tags() -> None:
-    for ps in ProductStream.objects.get_queryset():
-        brew, build_type, refresh_task = _relation_context_for_stream(ps.name)
-        for brew_tag, inherit in ps.brew_tags.items():
-            builds = brew.get_builds_with_tag(brew_tag, inherit=inherit, latest=False)
-            no_of_created = create_relations(
-                builds,
+    """Sync the Brew tag relations for all product streams with the builds in each tag.
+    Tags for all streams are listed together in koji multicalls, then compared to the stored
+    relations, so only builds which were added to or removed from a tag are processed"""
+    streams_by_build_type: dict[SoftwareBuild.Type, list[tuple[str, dict[str, bool]]]] = (
+        defaultdict(list)
+    )
+    for stream_name, brew_tags in ProductStream.objects.exclude(brew_tags__exact={}).values_list(
+        "name", "brew_tags"
+    ):
+        _, build_type, _ = _relation_context_for_stream(stream_name)
+        streams_by_build_type[build_type].append((stream_name, brew_tags))
+
+    for build_type, streams in streams_by_build_type.items():
+        brew, _, refresh_task = _relation_context_for_stream(streams[0][0])
+        # Streams often share the same tags, so each tag is only listed once
+        builds_by_tag = brew.get_builds_with_tags(
+            {
+                (brew_tag, inherit)
+                for _, brew_tags in streams
+                for brew_tag, inherit in brew_tags.items()
+            },
+            latest=False,
+        )
+        for stream_name, brew_tags in streams:
+            _sync_stream_brew_tags(stream_name, brew_tags, build_type, builds_by_tag, refresh_task)
+
+
+def _sync_stream_brew_tags(
+    stream_name: str,
+    brew_tags: dict[str, bool],
+    build_type: SoftwareBuild.Type,
+    builds_by_tag: dict[tuple[str, bool], tuple[str, ...]],
+    refresh_task: app.task,
+) -> None:
+    """Create relations for builds which were added to a stream's Brew tags, and delete relations
+    for builds which were removed from them"""
+    stored_build_ids: dict[str, set[str]] = defaultdict(set)
+    for brew_tag, build_id in ProductComponentRelation.objects.filter(
+        type=ProductComponentRelation.Type.BREW_TAG,
+        product_ref=stream_name,
+        build_type=build_type,
+        external_system_id__in=brew_tags.keys(),
+    ).values_list("external_system_id", "build_id"):
+        stored_build_ids[brew_tag].add(build_id)
+
+    for brew_tag, inherit in brew_tags.items():
+        if (brew_tag, inherit) not in builds_by_tag:
+            # Listing the tag failed, so we don't know which builds were added or removed
+            continue
+        tagged_build_ids = {str(build_id) for build_id in builds_by_tag[(brew_tag, inherit)]}
+        added_build_ids = tagged_build_ids - stored_build_ids[brew_tag]
+        removed_build_ids = stored_build_ids[brew_tag] - tagged_build_ids
+        if added_build_ids:
+            create_relations(
+                tuple(sorted(added_build_ids)),
                 build_type,
                 brew_tag,
-                ps.name,
+                stream_name,
                 ProductComponentRelation.Type.BREW_TAG,
                 refresh_task,
             )
-            logger.info("Saving %s new builds for %s", no_of_created, brew_tag)
+        if removed_build_ids:
+            _delete_untagged_relations(stream_name, brew_tag, build_type, removed_build_ids)
+        logger.info(
+            "Brew tag %s for %s has %s new builds and %s removed builds",
+            brew_tag,
+            stream_name,
+            len(added_build_ids),
+            len(removed_build_ids),
+        )
+
+
+def _delete_untagged_relations(
+    stream_name: str, brew_tag: str, build_type: str, build_ids: set[str]
+) -> None:
+    """Delete a stream's relations for builds which were removed from one of its Brew tags,
+    and reset the product taxonomy for those builds so the stream is removed from them"""
+    relations = ProductComponentRelation.objects.filter(
+        type=ProductComponentRelation.Type.BREW_TAG,
+        product_ref=stream_name,
+        external_system_id=brew_tag,
+        build_type=build_type,
+        build_id__in=build_ids,
+    )
+    software_build_ids = set(
+        relations.exclude(software_build=None).values_list("software_build_id", flat=True)
+    )
+    relations.delete()
+    for software_build_id in software_build_ids:
+        slow_reset_build_product_taxonomy.delay(str(software_build_id))
 
 
 def load_brew_tags(software_build: SoftwareBuild, brew_tags: list[str]) -> int:
     all_stream_tags = ProductStream.objects.exclude(brew_tags__exact={}).values_list(
         "name", "brew_tags"
     )
-    no_created = 0
+    relations = []
     distinct_brew_tags = set(brew_tags)
     for stream_name, stream_tags in all_stream_tags:
         distinct_stream_tags = set(stream_tags)
@@ -798,19 +1073,20 @@ def load_brew_tags(software_build: SoftwareBuild, brew_tags: list[str]) -> int:
             logger.info(f"Creating relations for {stream_name} and {tag}")
             # We do this inline instead of via create_relations function because
             # it's the only time we call it where we have a software_build object created
-            _, created = ProductComponentRelation.objects.update_or_create(
-                external_system_id=tag,
-                product_ref=stream_name,
-                build_id=software_build.build_id,
-                build_type=build_type,
-                defaults={
-                    "type": ProductComponentRelation.Type.BREW_TAG,
-                    "software_build": software_build,
-                },
+            relations.append(
+                ProductComponentRelation(
+                    external_system_id=tag,
+                    product_ref=stream_name,
+                    build_id=software_build.build_id,
+                    build_type=build_type,
+                    type=ProductComponentRelation.Type.BREW_TAG,
+                    software_build=software_build,
+                )
             )
-            if created:
-                no_created += 1
-    return no_created
+    created_build_ids = ProductComponentRelation.objects.upsert(
+        relations, update_fields=("type", "software_build")
+    )
+    return len(created_build_ids)
 
 
 def _relation_context_for_stream(stream_name: str) -> tuple[Brew, SoftwareBuild.Type, app.task]:
@@ -826,11 +1102,10 @@ def _relation_context_for_stream(stream_name: str) -> tuple[Brew, SoftwareBuild.
 
 
 def fetch_modular_builds(relations_query: QuerySet, force_process: bool = False) -> None:
-    for build_id in relations_query:
-        # Daily tasks / fetching Pulp and Yum modules should finish ASAP
-        slow_fetch_modular_build.apply_async(
-            args=(build_id,), kwargs={"force_process": force_process}, priority=0
-        )
+    # Daily tasks / fetching Pulp and Yum modules should finish ASAP
+    fetch_builds_in_chunks(
+        relations_query.iterator(), modular=True, priority=0, force_process=force_process
+    )
 
 
 def fetch_unprocessed_relations(
@@ -854,27 +1129,28 @@ def fetch_unprocessed_relations(
     relations_query = ProductComponentRelation.objects.filter(query).filter(software_build=None)
 
     processed_builds = 0
-    for relation in relations_query.iterator():
-        logger.info(f"Processing {relation.type} relation build with id: {relation.build_id}")
-        if relation.build_type == SoftwareBuild.Type.CENTOS:
+    centos_build_ids = []
+    build_ids = []
+    for build_id, build_type in relations_query.values_list("build_id", "build_type").iterator():
+        logger.info(f"Processing {build_type} relation build with id: {build_id}")
+        if build_type == SoftwareBuild.Type.CENTOS:
             # This skips use of the Collector models for builds in the CENTOS koji instance
             # It was done to avoid updating the collector models not to use build_id as
             # a primary key. It's possible because the only product stream (openstack-rdo)
             # stored in CENTOS koji doesn't use modules
-            slow_fetch_brew_build.apply_async(
-                args=(relation.build_id, SoftwareBuild.Type.CENTOS),
-                kwargs={"force_process": force_process},
-                # Daily tasks to fetch unprocessed relations should finish ASAP
-                priority=0,
-            )
+            centos_build_ids.append(build_id)
         else:
-            slow_fetch_modular_build.apply_async(
-                # Daily tasks to fetch unprocessed relations should finish ASAP
-                args=(relation.build_id,),
-                kwargs={"force_process": force_process},
-                priority=0,
-            )
+            build_ids.append(build_id)
         processed_builds += 1
+
+    # Daily tasks to fetch unprocessed relations should finish ASAP
+    no_of_chunks = fetch_builds_in_chunks(
+        centos_build_ids, SoftwareBuild.Type.CENTOS, priority=0, force_process=force_process
+    )
+    no_of_chunks += fetch_builds_in_chunks(
+        build_ids, modular=True, priority=0, force_process=force_process
+    )
+    logger.info(f"Fetching builds for {processed_builds} relations in {no_of_chunks} chunks")
     return processed_builds
 
 
@@ -888,16 +1164,18 @@ def fetch_unprocessed_brew_tag_relations(
     force_process: bool = False, days_created_since: int = 0
 ) -> int:
     if days_created_since:
-        created_dt = timezone.now() - timedelta(days=days_created_since)
-    else:
-        created_dt = get_last_success_for_task(
-            "corgi.tasks.brew.fetch_unprocessed_brew_tag_relations"
+        # Manual runs which look back a given number of days don't move the watermark
+        return fetch_unprocessed_relations(
+            relation_type=ProductComponentRelation.Type.BREW_TAG,
+            force_process=force_process,
+            created_since=timezone.now() - timedelta(days=days_created_since),
+        )
+    with watermark("corgi.tasks.brew.fetch_unprocessed_brew_tag_relations") as created_dt:
+        return fetch_unprocessed_relations(
+            relation_type=ProductComponentRelation.Type.BREW_TAG,
+            force_process=force_process,
+            created_since=created_dt,
         )
-    return fetch_unprocessed_relations(
-        relation_type=ProductComponentRelation.Type.BREW_TAG,
-        force_process=force_process,
-        created_since=created_dt,
-    )
 
 
 @app.task(base=Singleton, autoretry_for=RETRYABLE_ERRORS, retry_kwargs=RETRY_KWARGS, priority=6)
@@ -958,6 +1236,12 @@ def slow_refresh_brew_build_tags(build_id: int) -> None:
     # e.g. stream-name-candidate will change to stream-name-released
 
     logger.info(f"Refreshing Brew build tags for {build_id}")
+    if not SoftwareBuild.objects.filter(
+        build_type=SoftwareBuild.Type.BREW, build_id=str(build_id)
+    ).exists():
+        # UMB tag events for many builds we haven't loaded are coalesced into this task
+        logger.warning(f"Brew build with matching ID not ingested (yet?): {build_id}")
+        return
     brew = Brew(SoftwareBuild.Type.BREW)
     tags = sorted(set(tag["name"] for tag in brew.koji_session.listTags(build_id)))
     errata_tags = Brew.extract_advisory_ids(tags)
@@ -1,13 +1,17 @@
 import subprocess
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from typing import Optional
+from itertools import islice
+from typing import Iterable, Iterator, Optional, Union
+from uuid import UUID
 
 from celery.utils.log import get_task_logger
 from celery_singleton import Singleton
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Q, QuerySet
 from django.db.utils import InterfaceError as DjangoInterfaceError
 from django.utils import timezone
-from django_celery_results.models import TaskResult
 from psycopg2.errors import InterfaceError as Psycopg2InterfaceError
 from redis.exceptions import ConnectionError as RedisConnectionError
 from requests.exceptions import RequestException
@@ -16,8 +20,11 @@ from config.celery import app
 from corgi.core.models import (
     Component,
     ComponentNode,
+    JobWatermark,
     ProductComponentRelation,
+    ProductStream,
     SoftwareBuild,
+    TaxonomyQueueEntry,
 )
 
 logger = get_task_logger(__name__)
@@ -56,24 +63,32 @@ def fatal_code(e):
         return 400 <= e.response.status_code < 500 and e.response.status_code != 408
 
 
-def get_last_success_for_task(task_name: str) -> datetime:
-    """Return the timestamp of the last successful task so we can fetch updates since that time.
+# Periodic jobs look back a little before their watermark, in case anything created just before
+# the watermark wasn't visible yet when the job last ran
+WATERMARK_OVERLAP = timedelta(minutes=30)
+# When a job has no watermark yet, it looks back this far. If that still misses stuff, it indicates
+# a longer outage and updates should be scheduled manually, or the watermark rewound
+WATERMARK_DEFAULT_LOOKBACK = timedelta(days=3)
 
-    For extra measure, the last success timestamp is offset by 30 minutes to overlap. If no record
-    of a job that succeeded exists in our results DB, return a refresh timestamp of 3 days ago.
-    If that still misses stuff, it indicates a longer outage and updates should be scheduled
-    manually.
+
+@contextmanager
+def watermark(job_name: str) -> Iterator[datetime]:
+    """Yield the time an incremental job should fetch updates since, based on its watermark.
+
+    The watermark is locked for the duration of the block, and when the block finishes without an
+    error it's advanced to the time the block started, in the same transaction as any DB writes in
+    the block. If the block fails, the watermark and those writes are rolled back together, so the
+    next run covers the same time again. Use the rewindwatermark management command to make a job
+    reprocess older data.
     """
-    last_success = (
-        TaskResult.objects.filter(task_name=task_name, status="SUCCESS")
-        .order_by("-date_created")
-        .values_list("date_created", flat=True)
-        .using("read_only")
-        .first()
-    )
-    return (
-        last_success - timedelta(minutes=30) if last_success else timezone.now() - timedelta(days=3)
-    )
+    started_at = timezone.now()
+    with transaction.atomic():
+        job_watermark, _ = JobWatermark.objects.select_for_update().get_or_create(
+            name=job_name, defaults={"value": started_at - WATERMARK_DEFAULT_LOOKBACK}
+        )
+        yield job_watermark.value - WATERMARK_OVERLAP
+        job_watermark.value = started_at
+        job_watermark.save(update_fields=("value", "updated_at"))
 
 
 def create_relations(
@@ -84,31 +99,64 @@ def create_relations(
     relation_type: ProductComponentRelation.Type,
     refresh_task: Optional[app.task],
 ) -> int:
-    no_of_relations = 0
-    for build_id in build_ids:
-        _, created = ProductComponentRelation.objects.get_or_create(
-            external_system_id=external_system_id,
-            product_ref=product_ref,
-            build_id=build_id,
-            build_type=build_type,
-            defaults={"type": relation_type},
+    """Create relations between some product and builds, then process any builds which are new
+    to that product. Returns the number of relations that were created"""
+    created_build_ids = set(
+        ProductComponentRelation.objects.upsert(
+            ProductComponentRelation(
+                external_system_id=external_system_id,
+                product_ref=product_ref,
+                build_id=build_id,
+                build_type=build_type,
+                type=relation_type,
+            )
+            for build_id in build_ids
+        )
+    )
+    # When creating relations via fetch_brew_build we call save_product_taxonomy right after
+    # we call this function, so no need to refresh the build.
+    if refresh_task:
+        refreshed_build_ids = set()
+        for build_id in build_ids:
+            if str(build_id) not in created_build_ids or build_id in refreshed_build_ids:
+                continue
+            refreshed_build_ids.add(build_id)
+            # Similar to fetch_unprocessed_relations
+            # This skips use of the Collector models for builds in the CENTOS koji instance
+            # It was done to avoid updating the collector models not to use build_id as
+            # a primary key. It's possible because the only product stream (openstack-rdo)
+            # stored in CENTOS koji doesn't use modules
+            refresh_task_kwargs = {"build_id": build_id}
+            if build_type == SoftwareBuild.Type.CENTOS:
+                refresh_task_kwargs["build_type"] = build_type
+            # Daily tasks to create relations should finish ASAP
+            refresh_task.apply_async(kwargs=refresh_task_kwargs, priority=0)
+    return len(created_build_ids)
+
+
+def fetch_builds_in_chunks(
+    build_ids: Iterable[str],
+    build_type: str = BUILD_TYPE,
+    modular: bool = False,
+    priority: Optional[int] = None,
+    **kwargs: bool,
+) -> int:
+    """Fetch many builds using one slow_fetch_brew_builds task per chunk of builds,
+    instead of one task per build. Duplicate build IDs are only fetched once.
+    Returns the number of chunks that were sent"""
+    # Sent by name, since corgi.tasks.brew imports this module
+    options = {} if priority is None else {"priority": priority}
+    unique_build_ids = iter(dict.fromkeys(str(build_id) for build_id in build_ids))
+    no_of_chunks = 0
+    while chunk := list(islice(unique_build_ids, settings.BUILD_FETCH_CHUNK_SIZE)):
+        app.send_task(
+            "corgi.tasks.brew.slow_fetch_brew_builds",
+            args=(chunk, build_type),
+            kwargs={"modular": modular, **kwargs},
+            **options,
         )
-        if created:
-            # When creating relations via fetch_brew_build we call save_product_taxonomy right after
-            # we call this function, so no need to refresh the build.
-            if refresh_task:
-                # Similar to fetch_unprocessed_relations
-                # This skips use of the Collector models for builds in the CENTOS koji instance
-                # It was done to avoid updating the collector models not to use build_id as
-                # a primary key. It's possible because the only product stream (openstack-rdo)
-                # stored in CENTOS koji doesn't use modules
-                refresh_task_kwargs = {"build_id": build_id}
-                if build_type == SoftwareBuild.Type.CENTOS:
-                    refresh_task_kwargs["build_type"] = build_type
-                # Daily tasks to create relations should finish ASAP
-                refresh_task.apply_async(kwargs=refresh_task_kwargs, priority=0)
-            no_of_relations += 1
-    return no_of_relations
+        no_of_chunks += 1
+    return no_of_chunks
 
 
 def run_external(
@@ -184,4 +232,102 @@ def slow_save_taxonomy(build_id: str, build_type: str, save_components: bool = T
         logger.info(f"Saving component taxonomy for {build_type} build {build_id}")
         for root_component in build.components.get_queryset():
             root_component.save_component_taxonomy()
+
+    # The build may have been added to new streams, or its root components' taxonomy changed
+    root_component_pks = build.components.values_list("pk", flat=True)
+    queue_refresh_stream_components(
+        ProductStream.objects.filter(components__software_build=build).distinct(),
+        root_component_pks,
+    )
     logger.info(f"Finished saving taxonomies for {build_type} build {build_id}")
+
+
+def queue_save_taxonomy(build_id: str, build_type: str) -> None:
+    """Save a build's taxonomies with slow_save_taxonomy, once the build hasn't been queued again
+    for TAXONOMY_QUEUE_QUIET_PERIOD seconds. This way a build which is changed many times in a row,
+    e.g. by ingestion, errata and SCA, has its taxonomies saved only once. If the queue is
+    disabled, the taxonomies are saved right away in their own task instead"""
+    if not settings.TAXONOMY_QUEUE_QUIET_PERIOD:
+        slow_save_taxonomy.delay(build_id, build_type)
+        return
+    TaxonomyQueueEntry.objects.enqueue(
+        (
+            TaxonomyQueueEntry(
+                type=TaxonomyQueueEntry.Type.BUILD, build_id=str(build_id), build_type=build_type
+            ),
+        )
+    )
+
+
+def queue_refresh_stream_components(
+    streams: QuerySet[ProductStream], changed_root_pks: Iterable[Union[UUID, str]]
+) -> None:
+    """Refresh the stored provides / upstreams for some streams, once they haven't been queued
+    again for TAXONOMY_QUEUE_QUIET_PERIOD seconds, or right away if the queue is disabled"""
+    if not settings.TAXONOMY_QUEUE_QUIET_PERIOD:
+        for stream in streams:
+            stream.refresh_aggregate_components(changed_root_pks=changed_root_pks)
+        return
+    root_pks = sorted(str(pk) for pk in changed_root_pks)
+    TaxonomyQueueEntry.objects.enqueue(
+        TaxonomyQueueEntry(
+            type=TaxonomyQueueEntry.Type.STREAM,
+            product_stream=stream_name,
+            changed_root_pks=root_pks,
+        )
+        for stream_name in streams.values_list("name", flat=True)
+    )
+
+
+@app.task(
+    base=Singleton,
+    autoretry_for=RETRYABLE_ERRORS,
+    retry_kwargs=RETRY_KWARGS,
+    soft_time_limit=settings.CELERY_LONGEST_SOFT_TIME_LIMIT,
+)
+def slow_drain_taxonomy_queue() -> dict[str, int]:
+    """Process builds and streams in the taxonomy queue which haven't been queued again for
+    TAXONOMY_QUEUE_QUIET_PERIOD seconds, or which have waited TAXONOMY_QUEUE_MAX_DELAY seconds
+    in total, at most TAXONOMY_QUEUE_BATCH_SIZE of each. Builds are processed first, since saving
+    their taxonomy queues their streams. Returns the number of builds / streams processed"""
+    now = timezone.now()
+    due = Q(last_queued_at__lte=now - timedelta(seconds=settings.TAXONOMY_QUEUE_QUIET_PERIOD)) | Q(
+        first_queued_at__lte=now - timedelta(seconds=settings.TAXONOMY_QUEUE_MAX_DELAY)
+    )
+    processed = {}
+    for entry_type in (TaxonomyQueueEntry.Type.BUILD, TaxonomyQueueEntry.Type.STREAM):
+        processed[entry_type.label] = 0
+        entries = TaxonomyQueueEntry.objects.filter(due, type=entry_type).order_by(
+            "first_queued_at"
+        )[: settings.TAXONOMY_QUEUE_BATCH_SIZE]
+        for entry in entries:
+            # Remove the entry before processing it, so if the same build / stream is queued again
+            # in the meantime, it gets a new entry and is processed again later
+            entry.delete()
+            try:
+                processed[entry_type.label] += _process_taxonomy_queue_entry(entry)
+            except RETRYABLE_ERRORS:
+                # Queue the entry again, so it isn't lost when this task is retried
+                TaxonomyQueueEntry.objects.enqueue((entry,))
+                raise
+    logger.info(f"Drained taxonomy queue: {processed}")
+    return processed
+
+
+def _process_taxonomy_queue_entry(entry: TaxonomyQueueEntry) -> int:
+    """Save the taxonomy for a queued build, or refresh the components for a queued stream.
+    Returns 1 if it was processed, or 0 if the build / stream no longer exists"""
+    if entry.type == TaxonomyQueueEntry.Type.BUILD:
+        try:
+            slow_save_taxonomy(entry.build_id, entry.build_type)
+        except SoftwareBuild.DoesNotExist:
+            logger.warning(f"Queued {entry.build_type} build {entry.build_id} no longer exists")
+            return 0
+        return 1
+
+    stream = ProductStream.objects.filter(name=entry.product_stream).first()
+    if not stream:
+        logger.warning(f"Queued product stream {entry.product_stream} no longer exists")
+        return 0
+    stream.refresh_aggregate_components(changed_root_pks=entry.changed_root_pks)
+    return 1
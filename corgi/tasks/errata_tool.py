@@ -1,4 +1,4 @@
-from typing import Any, DefaultDict
+from typing import DefaultDict
 
 from celery.utils.log import get_task_logger
 from celery_singleton import Singleton
@@ -17,7 +17,13 @@ from corgi.core.models import (
     ProductVariant,
     SoftwareBuild,
 )
-from corgi.tasks.common import BUILD_TYPE, RETRY_KWARGS, RETRYABLE_ERRORS
+from corgi.tasks.common import (
+    BUILD_TYPE,
+    RETRY_KWARGS,
+    RETRYABLE_ERRORS,
+    fetch_builds_in_chunks,
+    queue_save_taxonomy,
+)
 from corgi.tasks.pyxis import slow_update_name_for_container_from_pyxis
 
 logger = get_task_logger(__name__)
@@ -46,7 +52,7 @@ def slow_save_errata_product_taxonomy(erratum_id: int) -> None:
     for build_id, build_type, _ in relation_builds:
         logger.info("Saving product taxonomy for build (%s, %s)", build_id, build_type)
         # once all build's components are ingested we must save product taxonomy
-        app.send_task("corgi.tasks.common.slow_save_taxonomy", args=(build_id, build_type))
+        queue_save_taxonomy(build_id, build_type)
 
 
 @app.task(base=Singleton, autoretry_for=RETRYABLE_ERRORS, retry_kwargs=RETRY_KWARGS, priority=3)
@@ -94,32 +100,31 @@ def slow_load_errata(erratum_name: str, force_process: bool = False) -> None:
         if len(build_ids) > 0:
             percentage_complete = int(no_of_processed_builds / len(build_ids) * 100)
             logger.info("Processed %i%% of builds in %s", percentage_complete, erratum_name)
-        for build_id in build_ids:
-            # We set save_product argument to False because it reads from the
-            # ProductComponentRelations table which this function writes to. We've seen contention
-            # on this database table causes by recursive looping of this task, and the
-            # slow_fetch_modular_build task, eg CORGI-21. We call save_product_taxonomy from
-            # this task only after all the builds in the errata have been loaded instead.
-            logger.info("Calling slow_fetch_modular_build for %s", build_id)
-            app.send_task(
-                "corgi.tasks.brew.slow_fetch_modular_build",
-                args=(build_id,),
-                # Do not pass force_process through to child tasks
-                # Or Celery will get stuck in an infinite loop
-                # processing the same Brew builds / errata repeatedly
-                kwargs={"save_product": False, "force_process": False},
-            )
-            # We might have already processed the build from Brew, but when it gets pushed by ET
-            # container builds can get a new name. Make sure we check for that here and update the
-            # container name if so.
-            if is_container:
-                build = SoftwareBuild.objects.filter(
-                    build_id=build_id, build_type=SoftwareBuild.Type.BREW
-                ).first()
-                if build:
-                    # Let this propagate an error if the nvr key is missing
-                    nvr = build.meta_attr["nvr"]
-                    slow_update_name_for_container_from_pyxis.delay(nvr)
+        # We set save_product argument to False because it reads from the
+        # ProductComponentRelations table which this function writes to. We've seen contention
+        # on this database table causes by recursive looping of this task, and the
+        # slow_fetch_modular_build task, eg CORGI-21. We call save_product_taxonomy from
+        # this task only after all the builds in the errata have been loaded instead.
+        no_of_chunks = fetch_builds_in_chunks(
+            build_ids,
+            modular=True,
+            save_product=False,
+            # Do not pass force_process through to child tasks
+            # Or Celery will get stuck in an infinite loop
+            # processing the same Brew builds / errata repeatedly
+            force_process=False,
+        )
+        logger.info("Fetching %s builds in %s chunks", len(build_ids), no_of_chunks)
+        # We might have already processed the builds from Brew, but when they get pushed by ET
+        # container builds can get a new name. Make sure we check for that here and update the
+        # container names if so.
+        if is_container:
+            builds = SoftwareBuild.objects.filter(
+                build_id__in=build_ids, build_type=SoftwareBuild.Type.BREW
+            ).values_list("meta_attr", flat=True)
+            for meta_attr in builds:
+                # Let this propagate an error if the nvr key is missing
+                slow_update_name_for_container_from_pyxis.delay(meta_attr["nvr"])
 
     if force_process:
         slow_save_errata_product_taxonomy.delay(erratum_id)
@@ -133,32 +138,39 @@ def save_errata_relation(
     erratum_id: int,
     variant_to_component_map: DefaultDict[str, list],
 ) -> None:
+    relations = []
     for variant_id, build_objects in variant_to_component_map.items():
         for build_obj in build_objects:
             for build_id, errata_components in build_obj.items():
                 # Add to relations list as we go, so we can fetch them below
                 build_ids.add(build_id)
-                defaults: dict[str, Any] = {
-                    "type": ProductComponentRelation.Type.ERRATA,
-                    "meta_attr": {"components": errata_components},
-                }
-                software_build = SoftwareBuild.objects.filter(
-                    build_id=build_id, build_type=build_type
-                ).first()
-                if software_build:
-                    # If software_build is None, this code will not add a "software_build": None
-                    # key / value pair to the defaults dict, so we won't remove the linked
-                    # software_build from any existing relations by mistake
-                    # If software_build is None / doesn't exist, there shouldn't be any other
-                    # relations with a linked build.
-                    defaults["software_build"] = software_build
-                ProductComponentRelation.objects.update_or_create(
-                    external_system_id=erratum_id,
-                    product_ref=variant_id,
-                    build_id=build_id,
-                    build_type=build_type,
-                    defaults=defaults,
-                )
+                relations.append((variant_id, build_id, errata_components))
+
+    # Look up all the builds at once, instead of once per relation
+    software_builds = dict(
+        SoftwareBuild.objects.filter(
+            build_id__in=[build_id for _, build_id, _ in relations], build_type=build_type
+        ).values_list("build_id", "pk")
+    )
+    # If a build doesn't exist, software_build is None. upsert won't unlink the build
+    # from an existing relation in that case, so we won't remove the linked software_build
+    # from any existing relations by mistake. If software_build is None / doesn't exist,
+    # there shouldn't be any other relations with a linked build.
+    ProductComponentRelation.objects.upsert(
+        (
+            ProductComponentRelation(
+                external_system_id=erratum_id,
+                product_ref=variant_id,
+                build_id=build_id,
+                build_type=build_type,
+                type=ProductComponentRelation.Type.ERRATA,
+                meta_attr={"components": errata_components},
+                software_build_id=software_builds.get(str(build_id)),
+            )
+            for variant_id, build_id, errata_components in relations
+        ),
+        update_fields=("type", "meta_attr", "software_build"),
+    )
 
 
 def _get_relation_builds(erratum_id: int) -> QuerySet:
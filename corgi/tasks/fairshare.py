@@ -0,0 +1,226 @@
+"""Share worker slots fairly between the sources which send tasks, like UMB events and backfills
+
+Every task is tagged with the source which sent it when it's published. Tasks sent by another task
+inherit that task's source, so e.g. all the builds fetched for a UMB-triggered errata count as UMB.
+
+For queues in settings.FAIR_SHARE_QUEUES, Redis tracks which tasks from each source are still
+queued or running. Once a source has more tasks in flight than its budget in
+settings.FAIR_SHARE_BUDGETS, its extra tasks are demoted to the lowest priority. Sources without a
+budget, like UMB, keep the priority they were sent with. Workers always take higher-priority tasks
+first, so fresh events only wait behind at most the budgeted tasks from each other source, instead
+of behind a whole backfill.
+"""
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from functools import cache
+from typing import Any, Iterator, Optional
+
+from celery import current_task
+from celery.signals import before_task_publish, task_postrun, task_prerun
+from celery.utils.log import get_task_logger
+from django.conf import settings
+from redis import Redis
+from redis.exceptions import RedisError
+
+logger = get_task_logger(__name__)
+
+
+class TaskSource:
+    UMB = "umb"
+    PERIODIC = "periodic"
+    BACKFILL = "backfill"
+    MANUAL = "manual"
+
+    ALL = (UMB, PERIODIC, BACKFILL, MANUAL)
+
+
+SOURCE_HEADER = "corgi_source"
+PUBLISHED_HEADER = "corgi_published_at"
+KEY_PREFIX = "corgi:fairshare"
+
+_current_source: ContextVar[Optional[str]] = ContextVar("corgi_task_source", default=None)
+_default_source = TaskSource.MANUAL
+
+
+def set_default_task_source(source: str) -> None:
+    """Set the source for all tasks sent by this process, e.g. PERIODIC for Celery beat"""
+    global _default_source
+    _default_source = source
+
+
+@contextmanager
+def task_source(source: str) -> Iterator[None]:
+    """Tag all tasks sent inside this block with the given source"""
+    token = _current_source.set(source)
+    try:
+        yield
+    finally:
+        _current_source.reset(token)
+
+
+def get_task_source() -> str:
+    """Return the source for tasks sent right now, from the enclosing task_source() block,
+    the task that's currently running, or the default for this process"""
+    source = _current_source.get()
+    if source:
+        return source
+    if current_task:
+        source = getattr(current_task.request, SOURCE_HEADER, None)
+        if source:
+            return source
+    return _default_source
+
+
+@cache
+def _redis() -> Redis:
+    return Redis.from_url(
+        settings.CELERY_BROKER_URL, socket_timeout=settings.FAIR_SHARE_REDIS_TIMEOUT
+    )
+
+
+def _in_flight_key(queue: str, source: str) -> str:
+    return f"{KEY_PREFIX}:{queue}:{source}:in_flight"
+
+
+def _wait_key(queue: str, source: str) -> str:
+    return f"{KEY_PREFIX}:{queue}:{source}:wait"
+
+
+@before_task_publish.connect
+def tag_task_source(
+    sender: Optional[str] = None,
+    headers: Optional[dict[str, Any]] = None,
+    properties: Optional[dict[str, Any]] = None,
+    routing_key: str = "",
+    **kwargs: Any,
+) -> None:
+    """Tag each task with its source, and demote it if its source has used up its budget"""
+    if headers is None or properties is None:
+        # Only task message protocol 2 has headers, which we always use
+        return
+    # Retried tasks keep their original source
+    source = headers.get(SOURCE_HEADER) or get_task_source()
+    headers[SOURCE_HEADER] = source
+    headers[PUBLISHED_HEADER] = time.time()
+
+    if routing_key not in settings.FAIR_SHARE_QUEUES:
+        return
+    task_id = headers["id"]
+    key = _in_flight_key(routing_key, source)
+    now = time.time()
+    try:
+        pipe = _redis().pipeline()
+        # Forget tasks which never finished, e.g. because their worker was killed
+        pipe.zremrangebyscore(key, "-inf", now - settings.CELERY_LONGEST_SOFT_TIME_LIMIT)
+        pipe.zadd(key, {task_id: now})
+        pipe.zcard(key)
+        pipe.expire(key, settings.CELERY_LONGEST_SOFT_TIME_LIMIT)
+        in_flight = pipe.execute()[2]
+    except RedisError as e:
+        # Never block sending tasks because of fair-share bookkeeping
+        logger.warning(f"Couldn't count in-flight {source} tasks for {sender}: {e}")
+        return
+
+    budget = settings.FAIR_SHARE_BUDGETS.get(source)
+    if budget and in_flight > budget:
+        logger.debug(
+            f"Demoting {sender} task {task_id}, {source} has {in_flight} tasks in flight "
+            f"in queue {routing_key} (budget {budget})"
+        )
+        properties["priority"] = settings.FAIR_SHARE_OVERFLOW_PRIORITY
+
+
+def _get_queue(task: Any) -> str:
+    delivery_info = getattr(task.request, "delivery_info", None) or {}
+    return delivery_info.get("routing_key") or ""
+
+
+@task_prerun.connect
+def record_queue_wait(task: Any = None, **kwargs: Any) -> None:
+    """Record how long each task waited in its queue, per source"""
+    if task is None:
+        return
+    queue = _get_queue(task)
+    published_at = getattr(task.request, PUBLISHED_HEADER, None)
+    if queue not in settings.FAIR_SHARE_QUEUES or not published_at:
+        return
+    eta = getattr(task.request, "eta", None)
+    if eta:
+        # Don't count the time a task was deliberately delayed for, e.g. before a retry
+        published_at = max(published_at, datetime.fromisoformat(eta).timestamp())
+    wait = max(time.time() - published_at, 0.0)
+
+    source = getattr(task.request, SOURCE_HEADER, None) or TaskSource.MANUAL
+    try:
+        pipe = _redis().pipeline()
+        key = _wait_key(queue, source)
+        pipe.hincrbyfloat(key, "total_seconds", wait)
+        pipe.hincrby(key, "count", 1)
+        pipe.hset(key, "last_seconds", wait)
+        pipe.execute()
+    except RedisError as e:
+        logger.warning(f"Couldn't record queue wait for {source} task {task.request.id}: {e}")
+
+
+@task_postrun.connect
+def release_task_slot(task: Any = None, task_id: str = "", state: str = "", **kwargs: Any) -> None:
+    """Stop counting a task as in flight once it's finished"""
+    if task is None or state == "RETRY":
+        # Retried tasks were already sent again, with the same task ID
+        return
+    queue = _get_queue(task)
+    if queue not in settings.FAIR_SHARE_QUEUES:
+        return
+    source = getattr(task.request, SOURCE_HEADER, None) or TaskSource.MANUAL
+    try:
+        _redis().zrem(_in_flight_key(queue, source), task_id)
+    except RedisError as e:
+        logger.warning(f"Couldn't release slot for {source} task {task_id}: {e}")
+
+
+def get_fair_share_stats() -> dict[str, dict[str, dict[str, float]]]:
+    """Return the number of tasks in flight and how long they waited, per queue and source"""
+    stats: dict[str, dict[str, dict[str, float]]] = {}
+    try:
+        pipe = _redis().pipeline()
+        for queue in settings.FAIR_SHARE_QUEUES:
+            for source in TaskSource.ALL:
+                pipe.zcard(_in_flight_key(queue, source))
+                pipe.hgetall(_wait_key(queue, source))
+        results = iter(pipe.execute())
+    except RedisError as e:
+        logger.warning(f"Couldn't get fair-share stats: {e}")
+        return stats
+
+    for queue in settings.FAIR_SHARE_QUEUES:
+        stats[queue] = {}
+        for source in TaskSource.ALL:
+            in_flight = next(results)
+            wait = {key.decode(): float(value) for key, value in next(results).items()}
+            count = wait.get("count", 0)
+            stats[queue][source] = {
+                "in_flight": in_flight,
+                "budget": settings.FAIR_SHARE_BUDGETS.get(source, 0),
+                "tasks_started": count,
+                "avg_wait_seconds": wait.get("total_seconds", 0) / count if count else 0,
+                "last_wait_seconds": wait.get("last_seconds", 0),
+            }
+    return stats
+
+
+def get_queue_length(queue: str) -> Optional[int]:
+    """Return the number of tasks waiting in a Celery queue, at every priority,
+    or None if Redis couldn't be reached"""
+    # Kombu keeps a separate Redis list for each priority step, see kombu.transport.redis
+    priority_queues = [queue, *(f"{queue}\x06\x16{priority}" for priority in (3, 6, 9))]
+    try:
+        pipe = _redis().pipeline()
+        for priority_queue in priority_queues:
+            pipe.llen(priority_queue)
+        return sum(pipe.execute())
+    except RedisError as e:
+        logger.warning(f"Couldn't get length of queue {queue}: {e}")
+        return None
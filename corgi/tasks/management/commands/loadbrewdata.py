@@ -7,6 +7,7 @@ from corgi.collectors.brew import Brew
 from corgi.core.models import ProductStream, SoftwareBuild
 from corgi.tasks.brew import fetch_unprocessed_brew_tag_relations, slow_fetch_brew_build
 from corgi.tasks.common import BUILD_TYPE
+from corgi.tasks.fairshare import TaskSource, set_default_task_source
 
 
 class Command(BaseCommand):
@@ -49,6 +50,12 @@ class Command(BaseCommand):
             action="store_true",
             help="Force ingestion even if build exists",
         )
+        parser.add_argument(
+            "-r",
+            "--rewrite",
+            action="store_true",
+            help="Save all components again, even if the build hasn't changed in Brew",
+        )
         parser.add_argument(
             "-t",
             "--skip-taxonomy",
@@ -58,6 +65,8 @@ class Command(BaseCommand):
         )
 
     def handle(self, *args, **options) -> None:
+        # Bulk loads shouldn't delay tasks for fresh UMB events
+        set_default_task_source(TaskSource.BACKFILL)
         if options["build_ids"]:
             build_ids = options["build_ids"]
         elif options["stream"]:
@@ -105,6 +114,7 @@ class Command(BaseCommand):
                     build_type,
                     force_process=options["force"],
                     save_product=options["skip_taxonomy"],
+                    force_rewrite=options["rewrite"],
                 )
             else:
                 slow_fetch_brew_build.apply_async(
@@ -115,6 +125,7 @@ class Command(BaseCommand):
                     kwargs={
                         "force_process": options["force"],
                         "save_product": options["skip_taxonomy"],
+                        "force_rewrite": options["rewrite"],
                     },
                     # Tasks users run manually with management commands should finish ASAP
                     priority=0,
@@ -3,6 +3,7 @@ import sys
 from django.core.management.base import BaseCommand, CommandParser
 
 from corgi.tasks.errata_tool import slow_load_errata, slow_load_stream_errata
+from corgi.tasks.fairshare import TaskSource, set_default_task_source
 from corgi.tasks.pulp import update_cdn_repo_channels
 
 
@@ -38,6 +39,8 @@ class Command(BaseCommand):
         parser.add_argument("-s", "--product_stream", help="Product Stream to load errata for.")
 
     def handle(self, *args, **options) -> None:
+        # Bulk loads shouldn't delay tasks for fresh UMB events
+        set_default_task_source(TaskSource.BACKFILL)
         if options["errata_ids"]:
             errata_ids = options["errata_ids"]
             for erratum_id in errata_ids:
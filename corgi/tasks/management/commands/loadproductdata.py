@@ -3,6 +3,7 @@ from django.core.management.base import BaseCommand
 
 from corgi.tasks.brew import load_stream_brew_tags
 from corgi.tasks.errata_tool import load_et_products
+from corgi.tasks.fairshare import TaskSource, set_default_task_source
 from corgi.tasks.prod_defs import update_products
 from corgi.tasks.pulp import setup_pulp_relations, update_cdn_repo_channels
 from corgi.tasks.rhel_compose import save_composes
@@ -14,6 +15,8 @@ class Command(BaseCommand):
     help = "Fetch product data from Product Definitions."
 
     def handle(self, *args, **options):
+        # Bulk loads shouldn't delay tasks for fresh UMB events
+        set_default_task_source(TaskSource.BACKFILL)
         if settings.COMMUNITY_MODE_ENABLED:
             self.do_update_products()
             self.do_load_brew_tags()
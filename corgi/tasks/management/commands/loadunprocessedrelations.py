@@ -2,6 +2,7 @@ from django.core.management.base import BaseCommand, CommandParser
 
 from corgi.core.models import ProductComponentRelation
 from corgi.tasks.brew import fetch_unprocessed_relations
+from corgi.tasks.fairshare import TaskSource, set_default_task_source
 
 
 class Command(BaseCommand):
@@ -16,6 +17,8 @@ class Command(BaseCommand):
         )
 
     def handle(self, *args, **options):
+        # Bulk loads shouldn't delay tasks for fresh UMB events
+        set_default_task_source(TaskSource.BACKFILL)
         if options["product_ref"]:
             if not ProductComponentRelation.objects.filter(
                 product_ref=options["product_ref"]
@@ -4,6 +4,7 @@ from django.core.management.base import BaseCommand, CommandParser
 
 from corgi.core.models import ProductComponentRelation, ProductStream
 from corgi.tasks.brew import fetch_modular_builds
+from corgi.tasks.fairshare import TaskSource, set_default_task_source
 from corgi.tasks.yum import fetch_unprocessed_yum_relations
 
 
@@ -29,6 +30,8 @@ class Command(BaseCommand):
         )
 
     def handle(self, *args, **options) -> None:
+        # Bulk loads shouldn't delay tasks for fresh UMB events
+        set_default_task_source(TaskSource.BACKFILL)
         if options["stream_names"]:
             for stream_name in options["stream_names"]:
                 self.stdout.write(self.style.NOTICE(f"Fetching builds for stream: {stream_name}"))
@@ -0,0 +1,70 @@
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.db import transaction
+from django.utils import timezone
+
+from corgi.core.models import JobWatermark
+
+
+class Command(BaseCommand):
+    help = "Show or rewind the watermarks of incremental periodic jobs, so they reprocess old data"
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "jobs",
+            nargs="*",
+            help="Full task names of the jobs to rewind, e.g. "
+            "corgi.tasks.brew.fetch_unprocessed_brew_tag_relations. "
+            "Show all watermarks if none are given",
+        )
+        rewind = parser.add_mutually_exclusive_group()
+        rewind.add_argument(
+            "-d",
+            "--days",
+            type=int,
+            help="Rewind the watermarks by this many days",
+        )
+        rewind.add_argument(
+            "-t",
+            "--to",
+            type=datetime.fromisoformat,
+            help="Rewind the watermarks to this ISO 8601 date / time",
+        )
+
+    def handle(self, *args, **options) -> None:
+        if not options["jobs"]:
+            for name, value in JobWatermark.objects.order_by("name").values_list("name", "value"):
+                self.stdout.write(f"{name}: {value.isoformat()}")
+            return
+        if not options["days"] and not options["to"]:
+            raise CommandError("Must give --days or --to, to rewind watermarks")
+
+        watermarks = JobWatermark.objects.filter(name__in=options["jobs"])
+        missing = set(options["jobs"]).difference(watermarks.values_list("name", flat=True))
+        if missing:
+            raise CommandError(f"No watermarks found for jobs: {', '.join(sorted(missing))}")
+
+        rewound = []
+        for job_watermark in watermarks:
+            if options["days"]:
+                new_value = job_watermark.value - timedelta(days=options["days"])
+            else:
+                new_value = options["to"]
+                if timezone.is_naive(new_value):
+                    new_value = timezone.make_aware(new_value)
+                if new_value > job_watermark.value:
+                    raise CommandError(
+                        f"Can't move {job_watermark.name} forwards from {job_watermark.value}"
+                    )
+            job_watermark.value = new_value
+            rewound.append(job_watermark)
+
+        with transaction.atomic():
+            for job_watermark in rewound:
+                job_watermark.save(update_fields=("value", "updated_at"))
+                self.stdout.write(
+                    self.style.SUCCESS(
+                        f"Rewound {job_watermark.name} to {job_watermark.value.isoformat()}"
+                    )
+                )
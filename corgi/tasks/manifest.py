@@ -1,20 +1,31 @@
+import gzip
 import hashlib
 import json
+import os
+import random
 import uuid
+from contextlib import ExitStack
 from datetime import datetime
 from pathlib import Path
+from typing import Generator, Optional, Union
 
+import zstandard
+from celery import chord
 from celery.utils.log import get_task_logger
 from celery_singleton import Singleton
 from django.conf import settings
 from django.db.models import Count
-from django_celery_results.models import TaskResult
 from spdx_tools.spdx.model import RelationshipType
 from spdx_tools.spdx.parser.parse_anything import parse_file
 
 from config.celery import app
-from corgi.core.files import ProductManifestFile
-from corgi.core.models import Component, ProductStream
+from corgi.core.files import (
+    MANIFEST_CONTENT_ENCODINGS,
+    PackageCache,
+    ProductManifestFile,
+    get_manifest_json_encoder,
+)
+from corgi.core.models import Component, ProductStream, TaskRun
 from corgi.tasks.common import RETRY_KWARGS, RETRYABLE_ERRORS
 
 logger = get_task_logger(__name__)
@@ -22,19 +33,57 @@ logger = get_task_logger(__name__)
 BUF_SIZE = 65536  # 64kb
 
 
+# Packages rendered by cpu_update_ps_manifest tasks in this worker process, keyed by the ID of
+# the update_manifests run they're part of. Only the current run's cache is kept
+_package_caches: dict[str, PackageCache] = {}
+
+
+def get_package_cache(run_id: str) -> PackageCache:
+    """Return the package cache shared by all streams in an update_manifests run"""
+    if run_id not in _package_caches:
+        _package_caches.clear()
+        _package_caches[run_id] = PackageCache()
+    return _package_caches[run_id]
+
+
 @app.task(
     base=Singleton,
     autoretry_for=RETRYABLE_ERRORS,
     retry_kwargs=RETRY_KWARGS,
 )
 def update_manifests():
-    for ps in ProductStream.objects.annotate(num_components=Count("components")).filter(
-        num_components__gt=0
-    ):
-        cpu_update_ps_manifest.delay(ps.name)
+    run_id = str(uuid.uuid4())
+    header = [
+        cpu_update_ps_manifest.si(ps.name, run_id=run_id)
+        for ps in ProductStream.objects.annotate(num_components=Count("components")).filter(
+            num_components__gt=0
+        )
+    ]
+    # Report how well the package cache worked once all the streams are finished
+    chord(header)(report_manifest_package_cache.s(run_id))
+
+
+@app.task(
+    base=Singleton,
+    autoretry_for=RETRYABLE_ERRORS,
+    retry_kwargs=RETRY_KWARGS,
+)
+def report_manifest_package_cache(results: list[list], run_id: str) -> dict:
+    """Sum and log the package cache stats from each cpu_update_ps_manifest task in a run"""
+    stats: dict[str, Union[int, float]] = {"hits": 0, "misses": 0, "build_seconds": 0.0}
+    for result in results:
+        # Each task returns a (updated, created_at, document_uuid, package_cache_stats) tuple
+        for key, value in result[3].items():
+            stats[key] += value
+    logger.info(
+        f"Package cache for update_manifests run {run_id}: {PackageCache.summarize_stats(stats)}"
+    )
+    return stats
 
 
-def same_contents(existing_file: str, stream: ProductStream) -> tuple[bool, dict]:
+def same_contents(
+    existing_file: str, stream: ProductStream, package_cache: Optional[PackageCache] = None
+) -> tuple[bool, dict]:
     """Check if the contents of existing file matches the latest manifest for the stream.
     In the case that the stream manifest needs to be updated the function returns the new content to
      be written. If the existing file is missing, or no successful task result is found new content
@@ -45,29 +94,32 @@ def same_contents(existing_file: str, stream: ProductStream) -> tuple[bool, dict
         logger.info(f"Didn't find existing file {existing_file}")
         return False, {}
 
+    # Only runs which wrote the manifest know its created_at date and document UUID
     last_update_manifest_task_for_stream = (
-        TaskResult.objects.filter(
+        TaskRun.objects.filter(
             task_name="corgi.tasks.manifest.cpu_update_ps_manifest",
-            task_args__contains=stream.name,
-            result__contains="true",
-            status="SUCCESS",
+            key=stream.name,
+            status=TaskRun.Status.SUCCESS,
+            summary__0=True,
         )
-        .order_by("-date_created")
+        .order_by("-started_at")
         .first()
     )
     if not last_update_manifest_task_for_stream:
-        logger.info(f"Didn't find TaskResult for {stream.name}")
+        logger.info(f"Didn't find TaskRun for {stream.name}")
         return False, {}
-    task_result = json.loads(last_update_manifest_task_for_stream.result)
+    task_result = last_update_manifest_task_for_stream.summary
     created_at = datetime.strptime(task_result[1], "%Y-%m-%dT%H:%M:%SZ")
     document_uuid = task_result[2]
     # generate some new content with the old document created_at and document_uuid but latest
     # stream data
-    new_content = ProductManifestFile(stream).render_content(
+    new_content = ProductManifestFile(stream, package_cache).render_content(
         created_at=created_at, document_uuid=document_uuid
     )
-    new_content_json = json.dumps(new_content, indent=4)
-    new_content_md5_hash = hashlib.md5(new_content_json.encode("utf-8")).hexdigest()
+    new_content_md5 = hashlib.md5()
+    for chunk in _encode_content(new_content):
+        new_content_md5.update(chunk)
+    new_content_md5_hash = new_content_md5.hexdigest()
     old_content_md5_hash = calculate_file_md5_hash(existing_file_obj)
     if new_content_md5_hash == old_content_md5_hash:
         logger.info(
@@ -136,12 +188,27 @@ def calculate_file_md5_hash(existing_file_obj: Path) -> str:
     retry_kwargs=RETRY_KWARGS,
     soft_time_limit=settings.CELERY_LONGEST_SOFT_TIME_LIMIT,
 )
-def cpu_update_ps_manifest(product_stream: str) -> tuple[bool, str, str]:
+def cpu_update_ps_manifest(
+    product_stream: str, run_id: str = ""
+) -> tuple[bool, str, str, dict[str, Union[int, float]]]:
+    """Update the manifest for a stream. When run_id is given, reuse packages rendered by other
+    streams in the same update_manifests run, if they ran in this worker process"""
     logger.info(f"Updating manifest for {product_stream}")
+    package_cache = get_package_cache(run_id) if run_id else PackageCache()
+    stats_before = package_cache.get_stats()
+    updated, created_at, document_uuid = _update_ps_manifest(product_stream, package_cache)
+    stats = {key: value - stats_before[key] for key, value in package_cache.get_stats().items()}
+    logger.info(f"Package cache for {product_stream}: {PackageCache.summarize_stats(stats)}")
+    return updated, created_at, document_uuid, stats
+
+
+def _update_ps_manifest(product_stream: str, package_cache: PackageCache) -> tuple[bool, str, str]:
     ps = ProductStream.objects.get(name=product_stream)
     output_file = f"{settings.STATIC_ROOT}/{product_stream}.json"
+    # Catch any changes to the stream's latest root components before rendering
+    ps.refresh_aggregate_components()
     if ps.components.manifest_components(quick=True, ofuri=ps.ofuri).exists():
-        match, new_content = same_contents(output_file, ps)
+        match, new_content = same_contents(output_file, ps, package_cache)
         if match:
             logger.info(f"Not updating {output_file} with same contents")
             return False, "", ""
@@ -150,7 +217,7 @@ def cpu_update_ps_manifest(product_stream: str) -> tuple[bool, str, str]:
             created_at, document_uuid = _write_content(new_content, output_file, product_stream)
             return True, created_at, document_uuid
         # output_file was missing, generate new file with manifest content
-        content = ProductManifestFile(ps).render_content()
+        content = ProductManifestFile(ps, package_cache).render_content()
         created_at, document_uuid = _write_content(content, output_file, product_stream)
         return True, created_at, document_uuid
     else:
@@ -168,23 +235,81 @@ def cpu_update_ps_manifest(product_stream: str) -> tuple[bool, str, str]:
     retry_kwargs=RETRY_KWARGS,
     soft_time_limit=settings.CELERY_LONGEST_SOFT_TIME_LIMIT,
 )
-def cpu_validate_ps_manifest(product_stream: str):
+def cpu_validate_ps_manifest(product_stream: str, full: bool = False) -> None:
+    """Validate a stream's manifest file with the fast SPDX checks, or with the full (slow)
+    spdx-tools validator when full is True"""
     logger.info(f"Validating manifest for {product_stream}")
     ps = ProductStream.objects.get(name=product_stream)
     manifest_file = ProductManifestFile(ps)
     file_name = f"{settings.STATIC_ROOT}/{ps.external_name}.json"
-    document = parse_file(file_name)
     try:
-        manifest_file.validate_document(document, ps.external_name)
+        if full:
+            document = parse_file(file_name)
+            manifest_file.validate_document(document, ps.external_name)
+        else:
+            with open(file_name, "rb") as fh:
+                content = json.load(fh)
+            manifest_file.validate_content(content, ps.external_name)
     except ValueError:
         logger.info(f"Got error validating SPDX document for {product_stream}")
         slow_ensure_root_provides.delay(product_stream)
         slow_ensure_root_upstreams.delay(product_stream)
 
 
+@app.task(
+    base=Singleton,
+    autoretry_for=RETRYABLE_ERRORS,
+    retry_kwargs=RETRY_KWARGS,
+)
+def validate_manifests_sample() -> list[str]:
+    """Run the full SPDX validator against a random sample of stream manifests, as a deep check
+    on top of the fast validation done each time a manifest is written"""
+    stream_names = [
+        ps.name
+        for ps in ProductStream.objects.annotate(num_components=Count("components")).filter(
+            num_components__gt=0
+        )
+        if Path(f"{settings.STATIC_ROOT}/{ps.external_name}.json").is_file()
+    ]
+    sample = random.sample(
+        stream_names, min(len(stream_names), settings.MANIFEST_FULL_VALIDATION_SAMPLE_SIZE)
+    )
+    for stream_name in sample:
+        cpu_validate_ps_manifest.delay(stream_name, full=True)
+    return sample
+
+
+def _encode_content(content: dict) -> Generator[bytes, None, None]:
+    """Serialize manifest content into UTF-8 chunks of roughly BUF_SIZE bytes"""
+    buffer: list[str] = []
+    buffer_size = 0
+    for chunk in get_manifest_json_encoder().iterencode(content):
+        buffer.append(chunk)
+        buffer_size += len(chunk)
+        if buffer_size >= BUF_SIZE:
+            yield "".join(buffer).encode("utf-8")
+            buffer = []
+            buffer_size = 0
+    if buffer:
+        yield "".join(buffer).encode("utf-8")
+
+
 def _write_content(new_content, output_file, product_stream) -> tuple[str, str]:
-    with open(output_file, "w") as fh:
-        fh.write(json.dumps(new_content, indent=4))
+    # Write the plain JSON manifest and its pre-compressed copies in a single streaming pass
+    # Use temporary files, so that clients never download a partially-written manifest
+    output_files = [output_file]
+    output_files.extend(f"{output_file}{suffix}" for suffix in MANIFEST_CONTENT_ENCODINGS.values())
+    with ExitStack() as stack:
+        fhs = [
+            stack.enter_context(open(f"{output_file}.tmp", "wb")),
+            stack.enter_context(gzip.open(f"{output_file}.gz.tmp", "wb", compresslevel=6)),
+            stack.enter_context(zstandard.open(f"{output_file}.zst.tmp", "wb")),
+        ]
+        for chunk in _encode_content(new_content):
+            for fh in fhs:
+                fh.write(chunk)
+    for file_name in output_files:
+        os.replace(f"{file_name}.tmp", file_name)
     created_at = new_content["creationInfo"]["created"]
     new_relationships = new_content["relationships"]
     document_uuid = get_document_uuid(new_relationships, product_stream)
@@ -213,7 +338,7 @@ def get_document_uuid(new_relationships, product_stream):
 )
 def slow_ensure_root_upstreams(product_stream: str) -> int:
     logger.info(f"slow_ensure_root_upstreams called for {product_stream}")
-    saved_count = 0
+    saved_pks = []
     ps = ProductStream.objects.get(name=product_stream)
     for root_c in ps.components.filter(type=Component.Type.CONTAINER_IMAGE).manifest_components(
         ofuri=ps.ofuri
@@ -221,8 +346,9 @@ def slow_ensure_root_upstreams(product_stream: str) -> int:
         if root_c.get_upstreams_pks().count() != root_c.upstreams.count():
             logger.info(f"saving component taxonomy for {root_c.purl} in stream {ps.name}")
             root_c.save_component_taxonomy()
-            saved_count += 1
-    return saved_count
+            saved_pks.append(root_c.pk)
+    ps.refresh_aggregate_components(changed_root_pks=saved_pks)
+    return len(saved_pks)
 
 
 # Added because of PSDEVOPS-1070
@@ -234,11 +360,12 @@ def slow_ensure_root_upstreams(product_stream: str) -> int:
 )
 def slow_ensure_root_provides(product_stream: str) -> int:
     logger.info(f"slow_ensure_root_provides called for {product_stream}")
-    saved_count = 0
+    saved_pks = []
     ps = ProductStream.objects.get(name=product_stream)
     for root_c in ps.components.manifest_components(ofuri=ps.ofuri):
         if len(root_c.get_provides_pks()) != root_c.provides.count():
             logger.info(f"saving component taxonomy for {root_c.purl} in stream {ps.name}")
             root_c.save_component_taxonomy()
-            saved_count += 1
-    return saved_count
+            saved_pks.append(root_c.pk)
+    ps.refresh_aggregate_components(changed_root_pks=saved_pks)
+    return len(saved_pks)
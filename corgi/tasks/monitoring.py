@@ -1,7 +1,6 @@
 from collections import Counter, defaultdict
 from datetime import timedelta
 
-from celery import states as celery_states
 from celery.signals import beat_init
 from celery.utils.log import get_task_logger
 from celery_singleton import Singleton, clear_locks
@@ -13,13 +12,18 @@ from django_celery_results.models import TaskResult
 
 from config.celery import app
 from config.utils import running_dev
-from corgi.tasks.common import RETRY_KWARGS, RETRYABLE_ERRORS, get_last_success_for_task
+from corgi.core.models import TaskRun
+from corgi.tasks.common import RETRY_KWARGS, RETRYABLE_ERRORS, watermark
+from corgi.tasks.fairshare import TaskSource, set_default_task_source
 
 logger = get_task_logger(__name__)
 
 
 @beat_init.connect
 def setup_periodic_tasks(sender, **kwargs):
+    # Every task sent by Celery beat is a periodic task
+    set_default_task_source(TaskSource.PERIODIC)
+
     def upsert_cron_task(module, task, **kwargs):
         crontab, _ = CrontabSchedule.objects.get_or_create(timezone=timezone.utc, **kwargs)
         PeriodicTask.objects.get_or_create(
@@ -56,6 +60,7 @@ def setup_periodic_tasks(sender, **kwargs):
         upsert_cron_task("yum", "load_yum_repositories", hour=3, minute=0)
         upsert_cron_task("yum", "fetch_unprocessed_yum_relations", hour=4, minute=0)
         upsert_cron_task("manifest", "update_manifests", hour=5, minute=0)
+        upsert_cron_task("manifest", "validate_manifests_sample", hour=6, minute=0)
         upsert_cron_task("monitoring", "email_failed_tasks", hour=6, minute=30)
         upsert_cron_task("monitoring", "expire_task_results", hour=7, minute=30)
     else:
@@ -75,9 +80,13 @@ def setup_periodic_tasks(sender, **kwargs):
         upsert_cron_task("yum", "load_yum_repositories", hour=8, minute=0)
         upsert_cron_task("yum", "fetch_unprocessed_yum_relations", hour=9, minute=0)
         upsert_cron_task("manifest", "update_manifests", hour=11, minute=0)
+        upsert_cron_task("manifest", "validate_manifests_sample", hour=12, minute=0)
         upsert_cron_task("monitoring", "email_failed_tasks", hour=12, minute=45)
         upsert_cron_task("monitoring", "expire_task_results", hour=13, minute=45)
 
+    # Builds and streams are only queued for a few minutes, so drain the queue often
+    upsert_interval_task("common", "slow_drain_taxonomy_queue", minutes=5)
+
 
 @app.task(base=Singleton, autoretry_for=(Exception,), retry_backoff=900, retry_jitter=False)
 def email_failed_tasks():
@@ -87,70 +96,75 @@ def email_failed_tasks():
     if running_dev():
         return
 
-    failed_tasks_threshold = get_last_success_for_task("corgi.tasks.monitoring.email_failed_tasks")
-    failed_tasks_max_threshold = timezone.now() - timedelta(days=3)
-    # Don't send emails about tasks that failed more than three days ago. Otherwise, we may end
-    # up reporting way too many errors, exceeding the allowed message size set by our SMTP server.
-    max_threshold = max(failed_tasks_threshold, failed_tasks_max_threshold)
-
-    failed_tasks = (
-        TaskResult.objects.filter(
-            status__in=(celery_states.FAILURE, celery_states.RETRY),
-            date_done__gte=max_threshold,
+    # If the email fails to send, the watermark isn't advanced, so the next run reports these too
+    with watermark("corgi.tasks.monitoring.email_failed_tasks") as failed_tasks_threshold:
+        failed_tasks_max_threshold = timezone.now() - timedelta(days=3)
+        # Don't send emails about tasks that failed more than three days ago. Otherwise, we may
+        # end up reporting way too many errors, exceeding the allowed message size set by our
+        # SMTP server.
+        max_threshold = max(failed_tasks_threshold, failed_tasks_max_threshold)
+
+        failed_tasks = (
+            TaskRun.objects.filter(
+                status__in=(TaskRun.Status.FAILURE, TaskRun.Status.RETRY),
+                finished_at__gte=max_threshold,
+            )
+            .order_by("task_name", "finished_at")
+            .using("read_only")
         )
-        .order_by("task_name", "date_done")
-        .using("read_only")
-    )
 
-    failed_tasks_count = failed_tasks.count()
-    subject = (
-        f"Failed Corgi Celery tasks after {failed_tasks_threshold.date()}: {failed_tasks_count}"
-    )
+        failed_tasks_count = failed_tasks.count()
+        subject = (
+            f"Failed Corgi Celery tasks after {failed_tasks_threshold.date()}: {failed_tasks_count}"
+        )
 
-    report_body = f"The following Celery tasks failed since {max_threshold}:\n\n"
-    if failed_tasks_count == 0:
-        report_body += "No failed tasks! Hooray!"
+        report_body = f"The following Celery tasks failed since {max_threshold}:\n\n"
+        if failed_tasks_count == 0:
+            report_body += "No failed tasks! Hooray!"
 
-    else:
-        # Group task errors (args, kwargs, and the traceback) by task_name
-        errors_by_task = defaultdict(list)
-        for task in failed_tasks.iterator(chunk_size=100):
-            failed_task = (task.task_args, task.task_kwargs, task.traceback or task.result)
-            errors_by_task[task.task_name].append(failed_task)
-
-        for task_name, errors in errors_by_task.items():
-            # Create a list of unique errors (each unique triple) and report the total and
-            # per-error numbers in each section.
-            unique_errors = Counter(errors)
-            report_body += f"# {task_name}: {sum(unique_errors.values())} total errors\n\n"
-
-            # Sort from highest error count per unique error to lowest.
-            unique_errors = sorted(unique_errors.items(), key=lambda x: x[1], reverse=True)
-            for (task_args, task_kwargs, task_traceback), error_count in unique_errors:
-                report_body += (
-                    f"## {task_name}: {error_count} error(s) when called with:\n\n"
-                    f"args={task_args}\nkwargs={task_kwargs}\n{task_traceback}\n"
-                )
-            report_body += "---\n\n"
-
-    EmailMessage(
-        subject=subject,
-        body=report_body,
-        to=settings.ADMINS,
-        from_email=settings.SERVER_EMAIL,
-    ).send()
+        else:
+            # Group task errors (args, kwargs, and the traceback) by task_name
+            errors_by_task = defaultdict(list)
+            for task in failed_tasks.iterator(chunk_size=100):
+                failed_task = (task.task_args, task.task_kwargs, task.traceback)
+                errors_by_task[task.task_name].append(failed_task)
+
+            for task_name, errors in errors_by_task.items():
+                # Create a list of unique errors (each unique triple) and report the total and
+                # per-error numbers in each section.
+                unique_errors = Counter(errors)
+                report_body += f"# {task_name}: {sum(unique_errors.values())} total errors\n\n"
+
+                # Sort from highest error count per unique error to lowest.
+                unique_errors = sorted(unique_errors.items(), key=lambda x: x[1], reverse=True)
+                for (task_args, task_kwargs, task_traceback), error_count in unique_errors:
+                    report_body += (
+                        f"## {task_name}: {error_count} error(s) when called with:\n\n"
+                        f"args={task_args}\nkwargs={task_kwargs}\n{task_traceback}\n"
+                    )
+                report_body += "---\n\n"
+
+        EmailMessage(
+            subject=subject,
+            body=report_body,
+            to=settings.ADMINS,
+            from_email=settings.SERVER_EMAIL,
+        ).send()
 
 
 @app.task(base=Singleton, autoretry_for=RETRYABLE_ERRORS, retry_kwargs=RETRY_KWARGS)
 def expire_task_results():
-    """Delete task results older than 30 days.
+    """Delete task runs older than 30 days.
 
-    To prevent the task results table to grow to huge numbers, remove any results that are
-    30 days or older. This job mimics the built-in celery.backend_cleanup job but works with
-    our schedules and is a bit more transparent in what it actually does.
+    To prevent the task runs table to grow to huge numbers, remove any runs that are
+    30 days or older. Results in the Redis result backend expire on their own, but task results
+    from when we used the django-db result backend are also removed here, until none are left.
     """
     expired_on = timezone.now() - timedelta(days=30)
-    removed_count, _ = TaskResult.objects.filter(date_done__lt=expired_on).delete()
-    logger.info("Removed %s expired task results", removed_count)
+    removed_count, _ = TaskRun.objects.filter(started_at__lt=expired_on).delete()
+    logger.info("Removed %s expired task runs", removed_count)
+    removed_results_count, _ = TaskResult.objects.filter(date_done__lt=expired_on).delete()
+    if removed_results_count:
+        logger.info("Removed %s old django-db task results", removed_results_count)
 
-    return f"Removed {removed_count} expired task results"
+    return f"Removed {removed_count} expired task runs"
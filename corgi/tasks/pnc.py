@@ -1,8 +1,13 @@
+from collections import defaultdict
+from typing import Any, Iterable
 from urllib.parse import unquote
 
 import requests
 from celery.utils.log import get_task_logger
 from celery_singleton import Singleton
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.utils import timezone
 
 from config.celery import app
 from corgi.collectors.errata_tool import ErrataTool
@@ -14,8 +19,7 @@ from corgi.core.models import (
     ProductVariant,
     SoftwareBuild,
 )
-from corgi.tasks.brew import set_license_declared_safely
-from corgi.tasks.common import RETRY_KWARGS, RETRYABLE_ERRORS, slow_save_taxonomy
+from corgi.tasks.common import RETRY_KWARGS, RETRYABLE_ERRORS, queue_save_taxonomy
 
 logger = get_task_logger(__name__)
 
@@ -46,19 +50,108 @@ def slow_fetch_pnc_sbom(purl: str, product_data: dict, sbom_data: dict) -> None:
     )
 
     # Create ProductComponentRelation
-    ProductComponentRelation.objects.update_or_create(
-        build_id=root_build.build_id,
-        build_type=root_build.build_type,
-        product_ref=sbom.product_variant,
-        external_system_id=sbom_data["id"],
-        defaults={
-            "software_build": root_build,
-            "type": ProductComponentRelation.Type.SBOMER,
-        },
+    ProductComponentRelation.objects.upsert(
+        (
+            ProductComponentRelation(
+                build_id=root_build.build_id,
+                build_type=root_build.build_type,
+                product_ref=sbom.product_variant,
+                external_system_id=sbom_data["id"],
+                software_build=root_build,
+                type=ProductComponentRelation.Type.SBOMER,
+            ),
+        ),
+        update_fields=("type", "software_build"),
     )
 
     # Create components
-    components = {}
+    components = _save_sbom_components(sbom, root_build)
+
+    # Create ComponentNodes
+    root_component = components.pop("root")
+    _save_sbom_nodes(root_component, components.values())
+
+    # Save product and component taxonomies
+    queue_save_taxonomy(root_build.build_id, root_build.build_type)
+
+
+# Number of SBOM components to look up and save with each set of bulk queries
+SBOM_COMPONENTS_CHUNK_SIZE = 1000
+
+# Components are unique on these fields, see unique_components on the Component model
+ComponentKey = tuple[str, str, str, str, str]
+
+
+def _component_key(component: Component) -> ComponentKey:
+    return (component.type, component.name, component.version, component.release, component.arch)
+
+
+def _get_components(keys: Iterable[ComponentKey]) -> dict[ComponentKey, Component]:
+    """Look up and lock all the components for some keys, using one query"""
+    keys = set(keys)
+    components = Component.objects.select_for_update().filter(
+        type__in={key[0] for key in keys},
+        name__in={key[1] for key in keys},
+        version__in={key[2] for key in keys},
+        release__in={key[3] for key in keys},
+        arch__in={key[4] for key in keys},
+    )
+    return {
+        key: component for component in components if (key := _component_key(component)) in keys
+    }
+
+
+def _upsert_sbom_components(
+    defaults_by_key: dict[ComponentKey, dict[str, Any]]
+) -> dict[ComponentKey, Component]:
+    """Create or update a chunk of components, like Component.objects.update_or_create()
+    but using a few bulk queries instead of a few queries for each component"""
+    existing = _get_components(defaults_by_key)
+
+    new = {}
+    for key in defaults_by_key.keys() - existing.keys():
+        component_type, name, version, release, arch = key
+        new[key] = Component(
+            type=component_type,
+            name=name,
+            version=version,
+            release=release,
+            arch=arch,
+            **defaults_by_key[key],
+        )
+        new[key].set_computed_fields()
+    Component.objects.bulk_create(new.values(), ignore_conflicts=True)
+
+    # If another task created some component since we looked, our copy wasn't saved
+    created_pks = set(
+        Component.objects.filter(pk__in=[component.pk for component in new.values()]).values_list(
+            "pk", flat=True
+        )
+    )
+    lost_keys = [key for key, component in new.items() if component.pk not in created_pks]
+    if lost_keys:
+        existing.update(_get_components(lost_keys))
+
+    now = timezone.now()
+    update_fields = {"last_changed", *Component.COMPUTED_FIELDS}
+    for key, component in existing.items():
+        for field, value in defaults_by_key[key].items():
+            setattr(component, field, value)
+            update_fields.add(field)
+        if component.set_computed_fields():
+            component.cnodes.exclude(purl=component.purl).update(purl=component.purl)
+        component.last_changed = now
+    Component.objects.bulk_update(existing.values(), fields=sorted(update_fields))
+
+    new.update(existing)
+    return new
+
+
+def _save_sbom_components(sbom: SbomerSbom, root_build: SoftwareBuild) -> dict[str, Component]:
+    """Save all the components in an SBOM, and return them by their bomref"""
+    defaults_by_key: dict[ComponentKey, dict[str, Any]] = {}
+    keys_by_bomref: dict[str, ComponentKey] = {}
+    licenses_by_key: dict[ComponentKey, str] = {}
     for bomref, component in sbom.components.items():
         defaults = {"namespace": component["namespace"], "meta_attr": component["meta_attr"]}
 
@@ -72,20 +165,37 @@ def slow_fetch_pnc_sbom(purl: str, product_data: dict, sbom_data: dict) -> None:
         else:
             component_type = Component.Type.GENERIC
 
-        components[bomref], _ = Component.objects.update_or_create(
-            type=component_type,
-            name=component["name"],
-            version=component["version"],
-            release="",
-            arch="noarch",
-            defaults=defaults,
-        )
+        # Entries for the same component are saved only once, with the combined defaults
+        # from each entry, like calling update_or_create() for each one in order
+        key: ComponentKey = (component_type, component["name"], component["version"], "", "noarch")
+        defaults_by_key.setdefault(key, {}).update(defaults)
+        keys_by_bomref[bomref] = key
+        licenses_by_key[key] = " OR ".join(component["licenses"])
 
-        set_license_declared_safely(components[bomref], " OR ".join(component["licenses"]))
+    keys = list(defaults_by_key)
+    saved: dict[ComponentKey, Component] = {}
+    for start in range(0, len(keys), SBOM_COMPONENTS_CHUNK_SIZE):
+        chunk = keys[start : start + SBOM_COMPONENTS_CHUNK_SIZE]
+        with transaction.atomic():
+            saved.update(_upsert_sbom_components({key: defaults_by_key[key] for key in chunk}))
 
-    # Create ComponentNodes
-    # Create the root node from the SBOM's component
-    root_component = components.pop("root")
+    # Same as set_license_declared_safely(), with one query for each distinct license
+    pks_by_license = defaultdict(list)
+    for key, license_declared_raw in licenses_by_key.items():
+        if license_declared_raw:
+            pks_by_license[license_declared_raw].append(saved[key].pk)
+    for license_declared_raw, pks in pks_by_license.items():
+        Component.objects.filter(pk__in=pks).exclude(
+            license_declared_raw=license_declared_raw
+        ).update(license_declared_raw=license_declared_raw)
+
+    logger.info(f"Saved {len(saved)} components for {len(keys_by_bomref)} SBOM entries")
+    return {bomref: saved[key] for bomref, key in keys_by_bomref.items()}
+
+
+def _save_sbom_nodes(root_component: Component, components: Iterable[Component]) -> None:
+    """Create the root node for an SBOM's root component, and PROVIDES nodes under it for all
+    other components, using one bulk insert for any nodes that don't already exist"""
     root_node, _ = ComponentNode.objects.get_or_create(
         type=ComponentNode.ComponentNodeType.SOURCE,
         parent=None,
@@ -98,18 +208,27 @@ def slow_fetch_pnc_sbom(purl: str, product_data: dict, sbom_data: dict) -> None:
     # CORGI-880: Record all included components as direct children of
     # the root, rather than recreating the relationships in the
     # CycloneDX manifest
-    for component in components.values():
-        ComponentNode.objects.get_or_create(
-            type=ComponentNode.ComponentNodeType.PROVIDES,
-            parent=root_node,
-            purl=component.purl,
-            defaults={
-                "obj": component,
-            },
+    content_type = ContentType.objects.get_for_model(Component)
+    with transaction.atomic():
+        # Lock the root node, so no other task adds the same children at the same time
+        root_node = ComponentNode.objects.select_for_update().get(pk=root_node.pk)
+        existing_purls = set(
+            root_node.children.filter(type=ComponentNode.ComponentNodeType.PROVIDES).values_list(
+                "purl", flat=True
+            )
         )
-
-    # Save product and component taxonomies
-    slow_save_taxonomy.delay(root_build.build_id, root_build.build_type)
+        new_nodes = {}
+        for component in components:
+            if component.purl in existing_purls or component.purl in new_nodes:
+                continue
+            new_nodes[component.purl] = ComponentNode(
+                type=ComponentNode.ComponentNodeType.PROVIDES,
+                purl=component.purl,
+                content_type=content_type,
+                object_id=component.pk,
+            )
+        ComponentNode.objects.bulk_create_children(root_node, list(new_nodes.values()))
+    logger.info(f"Created {len(new_nodes)} nodes under {root_component.purl}")
 
 
 @app.task(base=Singleton, autoretry_for=RETRYABLE_ERRORS, retry_kwargs=RETRY_KWARGS)
@@ -158,15 +277,18 @@ def slow_handle_pnc_errata_released(erratum_id: int, erratum_status: str) -> Non
         build_relation = ProductComponentRelation.objects.get(
             type=ProductComponentRelation.Type.SBOMER, software_build=build
         )
-        ProductComponentRelation.objects.update_or_create(
-            external_system_id=erratum_id,
-            product_ref=build_relation.product_ref,
-            build_id=build.build_id,
-            build_type=build.build_type,
-            defaults={
-                "software_build": build,
-                "type": ProductComponentRelation.Type.ERRATA,
-            },
+        ProductComponentRelation.objects.upsert(
+            (
+                ProductComponentRelation(
+                    external_system_id=erratum_id,
+                    product_ref=build_relation.product_ref,
+                    build_id=build.build_id,
+                    build_type=build.build_type,
+                    software_build=build,
+                    type=ProductComponentRelation.Type.ERRATA,
+                ),
+            ),
+            update_fields=("type", "software_build"),
         )
         # Save product and component taxonomies
-        slow_save_taxonomy.delay(build.build_id, build.build_type)
+        queue_save_taxonomy(build.build_id, build.build_type)
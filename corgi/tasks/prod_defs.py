@@ -1,10 +1,15 @@
+import copy
+import csv
+import hashlib
+import io
 import re
+import time
 from collections import defaultdict
-from typing import Any
+from typing import Any, Optional
 
 from celery.utils.log import get_task_logger
 from celery_singleton import Singleton
-from django.db import transaction
+from django.db import connection, transaction
 from django.db.models import Q, QuerySet
 
 from config.celery import app
@@ -13,6 +18,7 @@ from corgi.collectors.models import (
     CollectorErrataProductVariant,
     CollectorErrataProductVersion,
     CollectorErrataRelease,
+    CollectorProductDefinition,
 )
 from corgi.collectors.prod_defs import ProdDefs
 from corgi.core.models import (
@@ -24,13 +30,15 @@ from corgi.core.models import (
     ProductVersion,
     SoftwareBuild,
 )
-from corgi.tasks.common import RETRY_KWARGS, RETRYABLE_ERRORS, slow_save_taxonomy
+from corgi.tasks.common import RETRY_KWARGS, RETRYABLE_ERRORS, queue_save_taxonomy
 from corgi.tasks.tagging import apply_stream_no_manifest_tags
 
 logger = get_task_logger(__name__)
 # Find a substring that looks like a version (e.g. "3", "3.5", "3-5", "1.2.z") at the end of a
 # searched string.
 RE_VERSION_LIKE_STRING = re.compile(r"\d[\dz.-]*$|$")
+# Temporary table used to find relations for external system IDs removed from a stream
+NEW_EXTERNAL_SYSTEM_IDS_TABLE = "prod_defs_new_external_system_ids"
 
 
 @app.task(base=Singleton, autoretry_for=RETRYABLE_ERRORS, retry_kwargs=RETRY_KWARGS)
@@ -39,8 +47,8 @@ def slow_reset_build_product_taxonomy(build_pk: str) -> None:
 
 
 @app.task(base=Singleton, autoretry_for=RETRYABLE_ERRORS, retry_kwargs=RETRY_KWARGS)
-def update_products() -> None:
-    """Fetch product definitions and update the entire product data and tree model.
+def update_products(full: bool = False) -> None:
+    """Fetch product definitions and update the product data and tree model.
 
     Data from prod-defs is stored into these models:
     "ps_product" -> Product
@@ -51,11 +59,30 @@ def update_products() -> None:
     Each of these models is then set up as a ProductNode with its child nodes in the same order
     as noted above.
 
+    Only definitions which changed since the last sync are applied, based on the snapshot in
+    CollectorProductDefinition, and only their products / versions have their taxonomies saved.
+    Definitions are also applied again if the Errata Tool data they use has changed.
+    Set full=True to apply every definition, regardless of what changed.
+
     TODO: investigate whether we need to delete removed definitions from prod-defs.
     """
     products = ProdDefs.load_product_definitions()
+    # The parse_* functions below change the definitions, so normalize them first
+    definitions = normalize_product_definitions(products)
+    errata_fingerprint = _get_errata_fingerprint()
+    applied_definitions = {} if full else _get_applied_definitions()
+    changes = diff_product_definitions(applied_definitions, definitions, errata_fingerprint)
+    affected = _get_affected_definitions(changes, definitions, applied_definitions)
+    for definition_type, definition_changes in changes.items():
+        logger.info(
+            f"Product definitions {definition_type} changes: "
+            + ", ".join(f"{change} {len(names)}" for change, names in definition_changes.items())
+        )
+
     with transaction.atomic():
         for pd_product in products:
+            if (CollectorProductDefinition.Type.PRODUCT, pd_product["id"]) not in affected:
+                continue
             pd_product_versions = pd_product.pop("product_versions", [])
 
             name = pd_product.pop("id")
@@ -76,9 +103,16 @@ def update_products() -> None:
             )
 
             for pd_product_version in pd_product_versions:
-                parse_product_version(pd_product_version, product, product_node)
+                if (
+                    CollectorProductDefinition.Type.VERSION,
+                    pd_product_version["id"],
+                ) not in affected:
+                    continue
+                parse_product_version(pd_product_version, product, product_node, affected)
             product.save_product_taxonomy()
 
+        _save_applied_definitions(definitions, changes, errata_fingerprint)
+
         # Tag all the streams we don't want to publish manifests for
         # inline, before the transaction is committed
         # This way there's never any window of time when the stream exists
@@ -86,6 +120,146 @@ def update_products() -> None:
         apply_stream_no_manifest_tags()
 
 
+# Key for each definition in a normalized snapshot of product-definitions
+DefinitionKey = tuple[str, str]
+PARENT_DEFINITION_TYPES: dict[str, str] = {
+    CollectorProductDefinition.Type.STREAM: CollectorProductDefinition.Type.VERSION,
+    CollectorProductDefinition.Type.VERSION: CollectorProductDefinition.Type.PRODUCT,
+}
+# The parent's name and the definition's own data, for each definition
+NormalizedDefinitions = dict[DefinitionKey, tuple[str, dict[str, Any]]]
+
+
+def normalize_product_definitions(products: list[dict[str, Any]]) -> NormalizedDefinitions:
+    """Flatten the nested products / versions / streams from product-definitions,
+    so each definition can be compared to its last applied version on its own"""
+    definitions: NormalizedDefinitions = {}
+    for pd_product in products:
+        product = copy.deepcopy(pd_product)
+        versions = product.pop("product_versions", [])
+        definitions[(CollectorProductDefinition.Type.PRODUCT, product["id"])] = ("", product)
+        for version in versions:
+            streams = version.pop("product_streams", [])
+            definitions[(CollectorProductDefinition.Type.VERSION, version["id"])] = (
+                product["id"],
+                version,
+            )
+            for stream in streams:
+                definitions[(CollectorProductDefinition.Type.STREAM, stream["id"])] = (
+                    version["id"],
+                    stream,
+                )
+    return definitions
+
+
+def diff_product_definitions(
+    applied: dict[DefinitionKey, tuple[str, dict[str, Any], str]],
+    current: NormalizedDefinitions,
+    errata_fingerprint: str,
+) -> dict[str, dict[str, set[str]]]:
+    """Compare the last applied product definitions to the current ones, and return the names of
+    the added, changed and removed definitions of each type. A definition has changed if its
+    parent, its own data or the Errata Tool data it was applied with is different"""
+    changes: dict[str, dict[str, set[str]]] = {
+        definition_type: {"added": set(), "changed": set(), "removed": set()}
+        for definition_type in CollectorProductDefinition.Type.values
+    }
+    for (definition_type, name), definition in current.items():
+        if (definition_type, name) not in applied:
+            changes[definition_type]["added"].add(name)
+        elif applied[(definition_type, name)] != (*definition, errata_fingerprint):
+            changes[definition_type]["changed"].add(name)
+    for definition_type, name in applied.keys() - current.keys():
+        changes[definition_type]["removed"].add(name)
+    return changes
+
+
+def _get_affected_definitions(
+    changes: dict[str, dict[str, set[str]]],
+    current: NormalizedDefinitions,
+    applied: dict[DefinitionKey, tuple[str, dict[str, Any], str]],
+) -> set[DefinitionKey]:
+    """Return the added or changed definitions, along with their current and previous parent
+    versions and products, which need their taxonomies saved again"""
+    affected: set[DefinitionKey] = set()
+
+    def add_with_parents(key: DefinitionKey) -> None:
+        while key in current and key not in affected:
+            affected.add(key)
+            parent, _ = current[key]
+            if not parent:
+                break
+            key = (PARENT_DEFINITION_TYPES[key[0]], parent)
+
+    for definition_type, definition_changes in changes.items():
+        for name in definition_changes["added"] | definition_changes["changed"]:
+            add_with_parents((definition_type, name))
+            previous_parent = applied.get((definition_type, name), ("",))[0]
+            if previous_parent:
+                # The definition may have moved, so its old parent has one less child
+                add_with_parents((PARENT_DEFINITION_TYPES[definition_type], previous_parent))
+    return affected
+
+
+def _get_applied_definitions() -> dict[DefinitionKey, tuple[str, dict[str, Any], str]]:
+    return {
+        (definition_type, name): (parent, data, errata_fingerprint)
+        for definition_type, name, parent, data, errata_fingerprint in (
+            CollectorProductDefinition.objects.values_list(
+                "type", "name", "parent", "data", "errata_fingerprint"
+            ).iterator()
+        )
+    }
+
+
+def _save_applied_definitions(
+    definitions: NormalizedDefinitions,
+    changes: dict[str, dict[str, set[str]]],
+    errata_fingerprint: str,
+) -> None:
+    """Update the snapshot with the definitions we just applied. Removed definitions are only
+    removed from the snapshot, so they're applied again if they're ever added back"""
+    for definition_type, definition_changes in changes.items():
+        for name in definition_changes["added"] | definition_changes["changed"]:
+            parent, data = definitions[(definition_type, name)]
+            CollectorProductDefinition.objects.update_or_create(
+                type=definition_type,
+                name=name,
+                defaults={
+                    "parent": parent,
+                    "data": data,
+                    "errata_fingerprint": errata_fingerprint,
+                },
+            )
+        if definition_changes["removed"]:
+            logger.warning(
+                f"Product definitions {definition_type} were removed, but not deleted: "
+                f"{sorted(definition_changes['removed'])}"
+            )
+            CollectorProductDefinition.objects.filter(
+                type=definition_type, name__in=definition_changes["removed"]
+            ).delete()
+
+
+def _get_errata_fingerprint() -> str:
+    """Hash the Errata Tool data which parsing product-definitions depends on, like the CPEs and
+    Brew tags of ET variants / versions / releases, so definitions are applied again if it changes
+    """
+    fingerprint = hashlib.sha256()
+    for errata_data in (
+        CollectorErrataProductVersion.objects.order_by("et_id").values_list(
+            "et_id", "name", "brew_tags", "product__short_name"
+        ),
+        CollectorErrataProductVariant.objects.order_by("et_id").values_list(
+            "et_id", "name", "cpe", "product_version__name", "product_version__product__short_name"
+        ),
+        CollectorErrataRelease.objects.order_by("et_id").values_list("et_id", "brew_tags"),
+    ):
+        for row in errata_data.iterator():
+            fingerprint.update(repr(row).encode())
+    return fingerprint.hexdigest()
+
+
 def _find_by_cpe(cpe_patterns: list[str]) -> list[str]:
     """Given a list of CPE patterns find all the CPEs from ET Variants which match it"""
     if not cpe_patterns:
@@ -173,9 +347,13 @@ def _match_and_save_stream_cpes(product_version: ProductVersion) -> None:
 
 
 def parse_product_version(
-    pd_product_version: dict[str, Any], product: Product, product_node: ProductNode
+    pd_product_version: dict[str, Any],
+    product: Product,
+    product_node: ProductNode,
+    affected: Optional[set[DefinitionKey]] = None,
 ):
-    """Parse the product versions from ps_modules in product-definitions.json"""
+    """Parse the product versions from ps_modules in product-definitions.json
+    If a set of affected definitions is given, only those streams are parsed"""
     pd_product_streams = pd_product_version.pop("product_streams", [])
 
     name = pd_product_version.pop("id")
@@ -211,12 +389,22 @@ def parse_product_version(
     )
 
     for pd_product_stream in pd_product_streams:
+        if (
+            affected is not None
+            and (CollectorProductDefinition.Type.STREAM, pd_product_stream["id"]) not in affected
+        ):
+            continue
         parse_product_stream(
             pd_product_stream, product, product_version, product_version_node, version
         )
 
     product_version.save_product_taxonomy()
 
+    # Streams which weren't parsed above still need their CPEs reset,
+    # in case this version's CPEs have changed
+    ProductStream.objects.filter(productversions=product_version).exclude(
+        cpes_matching_patterns=[]
+    ).update(cpes_matching_patterns=[])
     if cpes_matching_patterns:
         _match_and_save_stream_cpes(product_version)
 
@@ -365,30 +553,97 @@ def _clean_orphaned_relations_and_builds(
     product_stream: ProductStream,
     relation_type: ProductComponentRelation.Type,
 ) -> None:
-    relations_to_remove = (
-        ProductComponentRelation.objects.filter(type=relation_type, product_ref=product_stream.name)
-        .exclude(external_system_id__in=new_external_system_ids)
-        .iterator()
-    )
+    """Delete a stream's relations of some type whose external system ID (e.g. a Brew tag)
+    was removed from the stream, then reset the product taxonomy of any linked builds
+    which are no longer related to the stream or its direct child variants.
 
+    This uses a handful of set-based queries against a temporary table of the new IDs,
+    instead of a few queries for every relation, so the prod-defs sync holds locks for less time
+    """
     related_product_refs: set[str] = {product_stream.name}
     direct_variants = product_stream.get_related_names_of_type(ProductVariant)
     related_product_refs.update(direct_variants)
-    for relation_to_remove in relations_to_remove:
-        # Make sure there is no other relation linking this build to the stream or it's direct child
-        # variants before removing
-        existing_stream_relation = (
-            ProductComponentRelation.objects.filter(
-                build_id=relation_to_remove.build_id, product_ref__in=related_product_refs
+
+    relation_table = ProductComponentRelation._meta.db_table
+    with connection.cursor() as cursor:
+        started = time.monotonic()
+        cursor.execute(f"DROP TABLE IF EXISTS {NEW_EXTERNAL_SYSTEM_IDS_TABLE}")
+        cursor.execute(
+            f"CREATE TEMPORARY TABLE {NEW_EXTERNAL_SYSTEM_IDS_TABLE} "
+            "(external_system_id varchar(200) PRIMARY KEY)"
+        )
+        new_ids_csv = io.StringIO()
+        new_external_system_ids = set(new_external_system_ids)
+        csv.writer(new_ids_csv).writerows((external_id,) for external_id in new_external_system_ids)
+        new_ids_csv.seek(0)
+        cursor.copy_expert(
+            f"COPY {NEW_EXTERNAL_SYSTEM_IDS_TABLE} (external_system_id) FROM STDIN WITH CSV",
+            new_ids_csv,
+        )
+        _log_cleanup_stage(
+            "load", len(new_external_system_ids), started, product_stream, relation_type
+        )
+
+        started = time.monotonic()
+        cursor.execute(
+            f"DELETE FROM {relation_table} relation "
+            "WHERE relation.type = %s AND relation.product_ref = %s AND NOT EXISTS ("
+            f"  SELECT 1 FROM {NEW_EXTERNAL_SYSTEM_IDS_TABLE} new_ids "
+            "  WHERE new_ids.external_system_id = relation.external_system_id"
+            ") RETURNING relation.build_id, relation.software_build_id",
+            [relation_type, product_stream.name],
+        )
+        removed_relations = cursor.fetchall()
+        _log_cleanup_stage(
+            "delete relations", len(removed_relations), started, product_stream, relation_type
+        )
+
+        # We want to remove relations even if they don't have a software_build foreign key
+        # populated. However we only need to clear the product_ref from the build if we've linked
+        # a build, and there is no other relation linking this build to the stream or its direct
+        # child variants
+        started = time.monotonic()
+        removed_builds = {
+            (build_id, software_build_id)
+            for build_id, software_build_id in removed_relations
+            if software_build_id
+        }
+        still_related_build_ids = set()
+        if removed_builds:
+            cursor.execute(
+                f"SELECT DISTINCT build_id FROM {relation_table} "
+                "WHERE build_id = ANY(%s) AND product_ref = ANY(%s)",
+                [
+                    list({build_id for build_id, _ in removed_builds}),
+                    list(related_product_refs),
+                ],
             )
-            .exclude(pk=relation_to_remove.pk)
-            .exists()
+            still_related_build_ids = {build_id for (build_id,) in cursor.fetchall()}
+        builds_to_reset = {
+            software_build_id
+            for build_id, software_build_id in removed_builds
+            if build_id not in still_related_build_ids
+        }
+        for software_build_id in builds_to_reset:
+            slow_reset_build_product_taxonomy.delay(str(software_build_id))
+        _log_cleanup_stage(
+            "reset builds", len(builds_to_reset), started, product_stream, relation_type
         )
-        # We want to remove relations even if they don't have a software_build foreign key populated
-        # However we only need to clear the product_ref from the build if we've linked a build
-        if relation_to_remove.software_build_id and not existing_stream_relation:
-            slow_reset_build_product_taxonomy.delay(str(relation_to_remove.software_build_id))
-        relation_to_remove.delete()
+
+        cursor.execute(f"DROP TABLE {NEW_EXTERNAL_SYSTEM_IDS_TABLE}")
+
+
+def _log_cleanup_stage(
+    stage: str,
+    count: int,
+    started: float,
+    product_stream: ProductStream,
+    relation_type: ProductComponentRelation.Type,
+) -> None:
+    logger.info(
+        f"Orphaned {relation_type} relation cleanup for {product_stream.name}: "
+        f"{stage} affected {count} rows in {time.monotonic() - started:.3f}s"
+    )
 
 
 def _parse_cpes_from_brew_tags(
@@ -475,7 +730,7 @@ def parse_errata_info(
                         .distinct()
                     )
                     for build_id, build_type in builds_to_update:
-                        slow_save_taxonomy.delay(build_id, build_type)
+                        queue_save_taxonomy(build_id, build_type)
                 # This has the affect of adding the variant to product_stream.productvariants
                 # many-to-many field
                 product_variant.save_product_taxonomy()
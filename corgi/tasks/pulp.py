@@ -13,7 +13,7 @@ from corgi.tasks.common import (
     RETRY_KWARGS,
     RETRYABLE_ERRORS,
     create_relations,
-    get_last_success_for_task,
+    watermark,
 )
 from corgi.tasks.errata_tool import update_variant_repos
 
@@ -30,14 +30,18 @@ def fetch_unprocessed_cdn_relations(
     force_process: bool = False, days_created_since: int = 0
 ) -> int:
     if days_created_since:
-        created_dt = timezone.now() - timedelta(days=days_created_since)
-    else:
-        created_dt = get_last_success_for_task("corgi.tasks.pulp.fetch_unprocessed_cdn_relations")
-    return fetch_unprocessed_relations(
-        relation_type=ProductComponentRelation.Type.CDN_REPO,
-        force_process=force_process,
-        created_since=created_dt,
-    )
+        # Manual runs which look back a given number of days don't move the watermark
+        return fetch_unprocessed_relations(
+            relation_type=ProductComponentRelation.Type.CDN_REPO,
+            force_process=force_process,
+            created_since=timezone.now() - timedelta(days=days_created_since),
+        )
+    with watermark("corgi.tasks.pulp.fetch_unprocessed_cdn_relations") as created_dt:
+        return fetch_unprocessed_relations(
+            relation_type=ProductComponentRelation.Type.CDN_REPO,
+            force_process=force_process,
+            created_since=created_dt,
+        )
 
 
 @app.task(base=Singleton, autoretry_for=RETRYABLE_ERRORS, retry_kwargs=RETRY_KWARGS)
@@ -21,9 +21,9 @@ from corgi.core.models import (
 from corgi.tasks.common import (
     RETRY_KWARGS,
     RETRYABLE_ERRORS,
+    queue_save_taxonomy,
     save_node,
     set_license_declared_safely,
-    slow_save_taxonomy,
 )
 from corgi.tasks.sca import cpu_software_composition_analysis
 
@@ -159,7 +159,7 @@ def _slow_fetch_pyxis_manifest_for_repository(
     # Save product taxonomy
     if save_product:
         logger.info("Requesting persistance of node structure for %s", softwarebuild.pk)
-        slow_save_taxonomy.delay(softwarebuild.build_id, softwarebuild.build_type)
+        queue_save_taxonomy(softwarebuild.build_id, softwarebuild.build_type)
 
     # TODO: manifest["image"]["source"] is not always present
     if settings.SCA_ENABLED and softwarebuild.source:
@@ -0,0 +1,85 @@
+"""Record each run of a Celery task in the TaskRun table, using Celery's task signals
+
+Celery's result backend only holds results for a short time, so helpers which need to know about
+past runs, like same_contents and email_failed_tasks, use this table.
+This module is imported by every worker through corgi.tasks.tasks, so the handlers below are
+always connected wherever tasks run.
+"""
+
+import json
+from typing import Any, Optional
+
+from celery.signals import task_failure, task_postrun, task_prerun
+from celery.utils.log import get_task_logger
+from django.utils import timezone
+from kombu.utils.encoding import safe_repr
+
+from corgi.core.models import TaskRun
+
+logger = get_task_logger(__name__)
+
+
+def _get_key(args: Optional[tuple], kwargs: Optional[dict]) -> str:
+    """Return the first argument of a task, like a stream name or build ID, to look up its runs"""
+    if args:
+        value = args[0]
+    elif kwargs:
+        value = next(iter(kwargs.values()))
+    else:
+        return ""
+    return str(value)[:255] if isinstance(value, (str, int)) else ""
+
+
+def _get_summary(retval: Any) -> Any:
+    """Return a task's return value as JSON, or None if it can't be stored as JSON"""
+    try:
+        return json.loads(json.dumps(retval, default=str))
+    except (TypeError, ValueError):
+        return None
+
+
+@task_prerun.connect
+def record_task_started(
+    task_id: str = "",
+    task: Any = None,
+    args: Optional[tuple] = None,
+    kwargs: Optional[dict] = None,
+    **_: Any,
+) -> None:
+    if task is None:
+        return
+    # Retried tasks keep their task ID, so they update their existing run
+    TaskRun.objects.update_or_create(
+        task_id=task_id,
+        defaults={
+            "task_name": task.name,
+            "key": _get_key(args, kwargs),
+            "status": TaskRun.Status.STARTED,
+            "started_at": timezone.now(),
+            "finished_at": None,
+            "task_args": safe_repr(args),
+            "task_kwargs": safe_repr(kwargs),
+            "summary": None,
+            "traceback": "",
+        },
+    )
+
+
+@task_failure.connect
+def record_task_traceback(task_id: str = "", einfo: Any = None, **_: Any) -> None:
+    TaskRun.objects.filter(task_id=task_id).update(traceback=str(einfo or ""))
+
+
+@task_postrun.connect
+def record_task_finished(
+    task_id: str = "", task: Any = None, retval: Any = None, state: str = "", **_: Any
+) -> None:
+    if task is None or state not in TaskRun.Status.values:
+        return
+    fields: dict[str, Any] = {"status": state, "finished_at": timezone.now()}
+    if state == TaskRun.Status.SUCCESS:
+        fields["summary"] = _get_summary(retval)
+    elif state == TaskRun.Status.RETRY:
+        # The Retry exception says why the task is being retried
+        fields["traceback"] = str(retval)
+    TaskRun.objects.filter(task_id=task_id).update(**fields)
@@ -20,7 +20,7 @@ from corgi.collectors.go_list import GoList
 from corgi.collectors.syft import Syft
 from corgi.core.constants import ROOT_COMPONENTS_CONDITION
 from corgi.core.models import Component, ComponentNode, SoftwareBuild
-from corgi.tasks.common import RETRY_KWARGS, RETRYABLE_ERRORS
+from corgi.tasks.common import RETRY_KWARGS, RETRYABLE_ERRORS, queue_save_taxonomy
 
 LOOKASIDE_SCRATCH_SUBDIR = "lookaside"
 LOOKASIDE_REGEX_SOURCE_PATTERNS = [
@@ -244,10 +244,7 @@ def cpu_software_composition_analysis(build_uuid, force_process: bool = False):
                 f"Root component {root_component.purl} for build {build_uuid}"
                 "had child components that were not found in remote-sources.json!"
             )
-        app.send_task(
-            "corgi.tasks.common.slow_save_taxonomy",
-            args=(software_build.build_id, software_build.build_type),
-        )
+        queue_save_taxonomy(software_build.build_id, software_build.build_type)
 
     # clean up source code so that we don't have to deal with reuse and an ever growing disk
     for source in distgit_sources:
@@ -15,7 +15,7 @@ from corgi.tasks.common import (
     RETRY_KWARGS,
     RETRYABLE_ERRORS,
     create_relations,
-    get_last_success_for_task,
+    watermark,
 )
 
 logger = get_task_logger(__name__)
@@ -31,19 +31,23 @@ def fetch_unprocessed_yum_relations(
     force_process: bool = False, days_created_since: int = 0
 ) -> int:
     if days_created_since:
-        created_dt = timezone.now() - timedelta(days=days_created_since)
-    else:
-        created_dt = get_last_success_for_task("corgi.tasks.yum.fetch_unprocessed_yum_relations")
-    return fetch_unprocessed_relations(
-        relation_type=ProductComponentRelation.Type.YUM_REPO,
-        force_process=force_process,
-        created_since=created_dt,
-    )
+        # Manual runs which look back a given number of days don't move the watermark
+        return fetch_unprocessed_relations(
+            relation_type=ProductComponentRelation.Type.YUM_REPO,
+            force_process=force_process,
+            created_since=timezone.now() - timedelta(days=days_created_since),
+        )
+    with watermark("corgi.tasks.yum.fetch_unprocessed_yum_relations") as created_dt:
+        return fetch_unprocessed_relations(
+            relation_type=ProductComponentRelation.Type.YUM_REPO,
+            force_process=force_process,
+            created_since=created_dt,
+        )
 
 
 @app.task(base=Singleton, autoretry_for=RETRYABLE_ERRORS, retry_kwargs=RETRY_KWARGS)
 def load_yum_repositories() -> None:
-    """Use dnf repoquery commands to inspect and load all content in all Yum repos"""
+    """Read repodata to inspect and load all content in all Yum repos"""
     logger.info("Loading all Yum repository data for all ProductStreams")
     for stream, repos in ProductStream.objects.exclude(yum_repositories=[]).values_list(
         "name", "yum_repositories"
@@ -54,7 +58,7 @@ def load_yum_repositories() -> None:
 
 @app.task(base=Singleton, autoretry_for=RETRYABLE_ERRORS, retry_kwargs=RETRY_KWARGS)
 def slow_load_yum_repositories_for_stream(stream: str, repo: str) -> None:
-    """Use dnf repoquery commands to inspect and load all content in a particular Yum repo"""
+    """Read repodata to inspect and load all content in a particular Yum repo"""
     logger.info(f"Loading Yum repository {repo} for ProductStream {stream}")
 
     # Some "Yum repository" URLs in prod-defs are actually Pulp repo URLs
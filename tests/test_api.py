@@ -1,3 +1,4 @@
+import gzip
 from urllib.parse import quote
 
 import pytest
@@ -11,6 +12,7 @@ from corgi.core.models import (
     ComponentNode,
     ProductComponentRelation,
     ProductStream,
+    ProductStreamComponent,
     SoftwareBuild,
 )
 
@@ -246,6 +248,35 @@ def test_component_detail(client, api_path):
     assert response.status_code == 204
 
 
+@pytest.mark.django_db(databases=("default", "read_only"), transaction=True)
+def test_product_stream_manifest_content_encoding(client, api_path, settings, tmp_path):
+    settings.STATIC_ROOT = str(tmp_path)
+    stream = ProductStreamFactory(name="rhel-9.2.0")
+    ProductStreamNodeFactory(obj=stream)
+    content = b'{"spdxVersion": "SPDX-2.3"}'
+    (tmp_path / "rhel-9.2.0.json").write_bytes(content)
+    (tmp_path / "rhel-9.2.0.json.gz").write_bytes(gzip.compress(content))
+
+    response = client.get(
+        f"{api_path}/product_streams/{stream.uuid}/manifest", HTTP_ACCEPT_ENCODING="gzip, zstd"
+    )
+    assert response.status_code == 200
+    # Only the gzip copy exists, so it's preferred even though zstd was also accepted
+    assert response["Content-Encoding"] == "gzip"
+    assert response["Content-Type"] == "application/json"
+    assert "Accept-Encoding" in response["Vary"]
+    assert gzip.decompress(b"".join(response.streaming_content)) == content
+    response.close()
+
+    response = client.get(
+        f"{api_path}/product_streams/{stream.uuid}/manifest", HTTP_ACCEPT_ENCODING="identity"
+    )
+    assert response.status_code == 200
+    assert not response.has_header("Content-Encoding")
+    assert b"".join(response.streaming_content) == content
+    response.close()
+
+
 @pytest.mark.django_db(databases=("default", "read_only"), transaction=True)
 def test_latest_components_by_streams_filter(client, api_path, stored_proc):
     # Create many components so we have robust test data
@@ -568,6 +599,40 @@ def test_root_components_filter(client, api_path):
     assert response["results"][0]["name"] == "binary_rpm"
 
 
+@pytest.mark.django_db(databases=("default", "read_only"), transaction=True)
+def test_stream_aggregate_components_filter(client, api_path):
+    stream = ProductStreamFactory(name="rhel-9.2.0", ofuri="o:redhat:rhel:9.2.0")
+    root = SrpmComponentFactory(name="root")
+    provided = BinaryRpmComponentFactory(name="provided")
+    upstream = UpstreamComponentFactory(name="upstream")
+    ComponentFactory(name="unrelated")
+    for component, aggregate_type in (
+        (root, ProductStreamComponent.Type.ROOT),
+        (provided, ProductStreamComponent.Type.PROVIDES),
+        (upstream, ProductStreamComponent.Type.UPSTREAM),
+    ):
+        ProductStreamComponent.objects.create(
+            productstream=stream, root_component=root, component=component, type=aggregate_type
+        )
+
+    for value in (stream.ofuri, stream.name):
+        response = client.get(f"{api_path}/components?stream_provides={value}")
+        assert response.status_code == 200
+        response = response.json()
+        assert response["count"] == 1
+        assert response["results"][0]["name"] == "provided"
+
+        response = client.get(f"{api_path}/components?stream_upstreams={value}")
+        assert response.status_code == 200
+        response = response.json()
+        assert response["count"] == 1
+        assert response["results"][0]["name"] == "upstream"
+
+    response = client.get(f"{api_path}/components?stream_provides=rhel-8.8.0")
+    assert response.status_code == 200
+    assert response.json()["count"] == 0
+
+
 @pytest.mark.django_db(databases=("default", "read_only"), transaction=True)
 def test_component_detail_unscanned_filter(client, api_path):
     ComponentFactory(
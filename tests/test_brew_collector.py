@@ -1,11 +1,12 @@
 import copy
 import json
 from types import SimpleNamespace
-from unittest.mock import ANY, call, patch
+from unittest.mock import ANY, MagicMock, call, patch
 
 import koji
 import pytest
 from django.conf import settings
+from django.core.cache import caches
 from requests import RequestException
 from yaml import safe_load
 
@@ -14,7 +15,9 @@ from corgi.collectors.brew import (
     BrewBuildInvalidState,
     BrewBuildNotFound,
     BrewBuildTypeNotSupported,
+    KojiMultiCall,
 )
+from corgi.collectors.models import CollectorRhelModule, CollectorRPM, CollectorSRPM
 from corgi.core.models import (
     Component,
     ComponentNode,
@@ -23,12 +26,15 @@ from corgi.core.models import (
 )
 from corgi.tasks import errata_tool
 from corgi.tasks.brew import (
+    _check_and_save_type,
+    fetch_brew_build,
     fetch_unprocessed_relations,
     get_container_repo_from_pyxis,
     load_brew_tags,
     load_stream_brew_tags,
     save_component,
     slow_fetch_brew_build,
+    slow_fetch_brew_builds,
     slow_save_container_children,
 )
 from corgi.tasks.common import BUILD_TYPE, slow_save_taxonomy
@@ -169,6 +175,31 @@ class MockBrewResult(object):
     pass
 
 
+class MockMultiCall(object):
+    """Make each call in a multicall on the mocked koji session directly"""
+
+    def __init__(self, mock_koji_session):
+        self.mock_koji_session = mock_koji_session
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def __getattr__(self, method):
+        def call(*args, **kwargs):
+            result = MockBrewResult()
+            result.result = getattr(self.mock_koji_session, method)(*args, **kwargs)
+            return result
+
+        return call
+
+
+def mock_multicall(mock_koji_session):
+    mock_koji_session.multicall.side_effect = lambda **kwargs: MockMultiCall(mock_koji_session)
+
+
 @patch("koji.ClientSession")
 @patch("corgi.collectors.brew.Brew.brew_rpm_headers_lookup")
 @pytest.mark.parametrize(
@@ -201,6 +232,7 @@ def test_get_component_data(
             if function == "listRPMs":
                 mock_rpm_infos = pickled_data
 
+    mock_multicall(mock_koji)
     brew = Brew(BUILD_TYPE)
     monkeypatch.setattr(brew, "koji_session", mock_koji)
 
@@ -426,6 +458,7 @@ def test_get_container_build_data_remote_sources_in_archives(
                     text=remote_source_data.read(),
                 )
 
+    mock_multicall(mock_koji_session)
     brew = Brew(BUILD_TYPE)
     monkeypatch.setattr(brew, "koji_session", mock_koji_session)
     c = brew.get_container_build_data(1475846, build_info)
@@ -444,6 +477,26 @@ def test_get_container_build_data_remote_sources_in_archives(
         ]
 
 
+def test_get_remote_sources(requests_mock):
+    """Test downloading many remote-source / Cachito manifests at once"""
+    names = ("collector", "config-tool", "fluentd", "jwtproxy", "pushgateway")
+    json_urls = [f"https://tests/data/remote-source-{name}.json" for name in names]
+    for json_url in json_urls:
+        with open(json_url.replace("https://", "")) as remote_source_data:
+            requests_mock.get(json_url, text=remote_source_data.read())
+
+    remote_sources = Brew._get_remote_sources(json_urls)
+    # Each manifest is returned in the same order as its URL
+    assert [remote_source.repo for remote_source in remote_sources] == [
+        Brew._get_remote_source(json_url).repo for json_url in json_urls
+    ]
+
+    # Errors for any URL are raised, like when downloading them one at a time
+    requests_mock.get(json_urls[2], status_code=404)
+    with pytest.raises(RequestException):
+        Brew._get_remote_sources(json_urls)
+
+
 def test_extract_remote_sources(requests_mock):
     """Test processing a single remote-source / Cachito manifest"""
     # buildID=1475846
@@ -830,6 +883,7 @@ legacy_osbs_test_data = [
 @pytest.mark.parametrize("build_info, upstream_go_modules", legacy_osbs_test_data)
 def test_get_legacy_osbs_source(mock_koji_session, build_info, upstream_go_modules, monkeypatch):
     mock_koji_session.listArchives.return_value = []
+    mock_multicall(mock_koji_session)
     brew = Brew(BUILD_TYPE)
     monkeypatch.setattr(brew, "koji_session", mock_koji_session)
     result = brew.get_container_build_data(1890187, build_info)
@@ -1168,16 +1222,18 @@ def test_get_component_data_handles_errors():
     #  Let's split this method into multiple to make these tests simpler
 
 
-@patch("koji.ClientSession")
-def test_extract_image_components(mock_koji_session, monkeypatch):
-    mock_koji_session.listRPMs.return_value = KOJI_LIST_RPMS
+def test_extract_image_components():
     brew = Brew(BUILD_TYPE)
-    monkeypatch.setattr(brew, "koji_session", mock_koji_session)
     noarch_rpms_by_id = {}
     rpm_build_ids = set()
     archive = TEST_IMAGE_ARCHIVE
     noarch_rpms_by_id, result = brew._extract_image_components(
-        archive, 1781353, "subctl-container-v0.11.0-51", noarch_rpms_by_id, rpm_build_ids
+        archive,
+        KOJI_LIST_RPMS,
+        1781353,
+        "subctl-container-v0.11.0-51",
+        noarch_rpms_by_id,
+        rpm_build_ids,
     )
     assert list(rpm_build_ids) == RPM_BUILD_IDS
     assert result["meta"]["arch"] == "x86_64"
@@ -1189,6 +1245,211 @@ def test_extract_image_components(mock_koji_session, monkeypatch):
     assert set(noarch_rpms_by_id.keys()) == set(NOARCH_RPM_IDS)
 
 
+class MockVirtualCall(object):
+    """Like koji's VirtualCall, which raises the fault for the call when its result is accessed"""
+
+    def __init__(self, result):
+        self._result = result
+
+    @property
+    def result(self):
+        if isinstance(self._result, Exception):
+            raise self._result
+        return self._result
+
+
+@pytest.mark.django_db
+def test_persist_modules():
+    """Test that module RPMs and SRPMs are saved in bulk, and saving them again changes nothing"""
+    rhel_modules = {
+        "mod-1-1.a": ["foo-0:1-1.module.x86_64", "foo-0:1-1.module.src", "bar-0:2-1.module.noarch"],
+        "mod-1-2.b": ["foo-0:1-1.module.x86_64", "baz-1:3-1.module.x86_64"],
+        "missing-1-1.c": ["missing-0:1-1.x86_64"],
+    }
+    module_build_ids = {"mod-1-1.a": 100, "mod-1-2.b": 101, "missing-1-1.c": None}
+    srpm_build_ids = {
+        "foo-1-1.module.x86_64": 200,
+        "bar-2-1.module.noarch": 201,
+        "baz-3-1.module.x86_64": 200,
+    }
+
+    def mock_result(result):
+        brew_result = MockBrewResult()
+        brew_result.result = result
+        return brew_result
+
+    brew = Brew(BUILD_TYPE)
+    with patch.object(
+        brew,
+        "brew_srpm_lookup",
+        side_effect=lambda nvrs: [(nvr, mock_result(module_build_ids[nvr])) for nvr in nvrs],
+    ), patch.object(
+        brew,
+        "brew_rpm_lookup",
+        side_effect=lambda rpms: [
+            (rpm, mock_result({"build_id": srpm_build_ids[rpm]})) for rpm in rpms
+        ],
+    ), patch.object(
+        Brew, "PERSIST_MODULES_CHUNK_SIZE", 1
+    ):
+        for _ in range(2):
+            assert list(brew.persist_modules(rhel_modules)) == [100, 101]
+
+            assert set(CollectorRhelModule.objects.values_list("build_id", "nvr")) == {
+                (100, "mod-1-1.a"),
+                (101, "mod-1-2.b"),
+            }
+            assert set(CollectorSRPM.objects.values_list("build_id", flat=True)) == {200, 201}
+            assert set(
+                CollectorRPM.objects.values_list("nvra", "srpm_id", "rhel_module__build_id")
+            ) == {
+                ("foo-1-1.module.x86_64", 200, 100),
+                ("foo-1-1.module.x86_64", 200, 101),
+                ("bar-2-1.module.noarch", 201, 100),
+                ("baz-3-1.module.x86_64", 200, 101),
+            }
+            assert CollectorRPM.objects.count() == 3
+
+
+def test_koji_multicall_batches_calls():
+    caches["koji"].clear()
+    mock_koji_session = MagicMock()
+    batches = []
+
+    def multicall(**kwargs):
+        assert kwargs == {"strict": False}
+        batch = MagicMock()
+        batch.__enter__.return_value = batch
+        batch.listRPMs.side_effect = lambda imageID: MockVirtualCall([imageID])
+        batches.append(batch)
+        return batch
+
+    mock_koji_session.multicall.side_effect = multicall
+
+    with KojiMultiCall(mock_koji_session, batch_size=2) as m:
+        calls = [m.listRPMs(imageID=archive_id) for archive_id in range(5)]
+
+    assert [c.result for c in calls] == [[0], [1], [2], [3], [4]]
+    assert [batch.listRPMs.call_count for batch in batches] == [2, 2, 1]
+
+    # No calls means no multicall is sent at all
+    with KojiMultiCall(mock_koji_session) as m:
+        pass
+    assert len(batches) == 3
+
+
+def test_koji_multicall_caches_immutable_calls():
+    caches["koji"].clear()
+    mock_koji_session = MagicMock()
+    batch = MagicMock()
+    batch.__enter__.return_value = batch
+    batch.listRPMs.side_effect = lambda imageID: MockVirtualCall([{"id": imageID}])
+    batch.listTags.side_effect = lambda build_id: MockVirtualCall([{"name": "tag"}])
+    # Empty results aren't cached, the archive may just not have been imported yet
+    batch.listArchives.side_effect = lambda build_id: MockVirtualCall([])
+    mock_koji_session.multicall.return_value = batch
+
+    for _ in range(2):
+        with KojiMultiCall(mock_koji_session) as m:
+            rpms_call = m.listRPMs(imageID=1)
+            tags_call = m.listTags(1)
+            archives_call = m.listArchives(1)
+        assert rpms_call.result == [{"id": 1}]
+        assert tags_call.result == [{"name": "tag"}]
+        assert archives_call.result == []
+
+    # listRPMs was only fetched the first time, the mutable listTags call was fetched both times
+    assert batch.listRPMs.call_count == 1
+    assert batch.listTags.call_count == 2
+    assert batch.listArchives.call_count == 2
+
+    # Different arguments are cached separately
+    with KojiMultiCall(mock_koji_session) as m:
+        rpms_call = m.listRPMs(imageID=2)
+    assert rpms_call.result == [{"id": 2}]
+    assert batch.listRPMs.call_count == 2
+
+    # When every call is cached, no multicall is sent at all
+    mock_koji_session.multicall.reset_mock()
+    with KojiMultiCall(mock_koji_session) as m:
+        m.listRPMs(imageID=1)
+        m.listRPMs(imageID=2)
+    mock_koji_session.multicall.assert_not_called()
+
+
+@patch("corgi.collectors.brew.time.sleep")
+def test_koji_multicall_retries_partial_failure(mock_sleep):
+    mock_koji_session = MagicMock()
+    # Each call fails transiently once, except the build that doesn't exist, which always fails
+    attempts = {}
+
+    def get_build(build_id):
+        attempts[build_id] = attempts.get(build_id, 0) + 1
+        if build_id == 2:
+            return MockVirtualCall(koji.GenericError("No such build: 2"))
+        elif build_id == 3 and attempts[build_id] == 1:
+            return MockVirtualCall(koji.ServerOffline("Server is offline"))
+        return MockVirtualCall({"id": build_id})
+
+    batch = MagicMock()
+    batch.__enter__.return_value = batch
+    batch.getBuild.side_effect = get_build
+    mock_koji_session.multicall.return_value = batch
+
+    with KojiMultiCall(mock_koji_session) as m:
+        calls = [m.getBuild(build_id) for build_id in (1, 2, 3)]
+
+    # Only the call that failed transiently was retried
+    assert attempts == {1: 1, 2: 1, 3: 2}
+    mock_sleep.assert_called_once()
+    assert calls[0].result == {"id": 1}
+    with pytest.raises(koji.GenericError):
+        calls[1].result
+    assert calls[2].result == {"id": 3}
+
+    # Calls which keep failing raise the last error once retries are exhausted
+    batch.getBuild.side_effect = lambda build_id: MockVirtualCall(koji.ServerOffline("Offline"))
+    with KojiMultiCall(mock_koji_session) as m:
+        offline_call = m.getBuild(4)
+    with pytest.raises(koji.ServerOffline):
+        offline_call.result
+    assert mock_sleep.call_count == 1 + KojiMultiCall.MAX_RETRIES
+
+
+def test_get_builds():
+    """Test that builds are looked up in one multicall, leaving out builds which weren't found"""
+    batch = MagicMock()
+    batch.__enter__.return_value = batch
+    batch.getBuild.side_effect = lambda build_id: MockVirtualCall(
+        koji.GenericError("No such build") if build_id == 2 else {"id": build_id}
+    )
+    brew = Brew(BUILD_TYPE)
+    with patch.object(brew, "koji_session") as mock_koji_session:
+        mock_koji_session.multicall.return_value = batch
+        assert brew.get_builds((1, 2, 3)) == {1: {"id": 1}, 3: {"id": 3}}
+    mock_koji_session.multicall.assert_called_once_with(strict=False)
+
+
+def test_get_builds_with_tags(settings):
+    """Test that tags are listed in multicalls of the configured size,
+    leaving out tags which couldn't be listed"""
+    settings.BREW_TAG_MULTICALL_BATCH_SIZE = 1
+    batch = MagicMock()
+    batch.__enter__.return_value = batch
+    batch.listTagged.side_effect = lambda tag, inherit, latest: MockVirtualCall(
+        koji.GenericError("No such tag") if tag == "missing" else [{"build_id": len(tag)}]
+    )
+    brew = Brew(BUILD_TYPE)
+    with patch.object(brew, "koji_session") as mock_koji_session:
+        mock_koji_session.multicall.return_value = batch
+        builds_by_tag = brew.get_builds_with_tags(
+            (("tag", True), ("missing", False), ("other-tag", False)), latest=False
+        )
+    assert builds_by_tag == {("tag", True): (3,), ("other-tag", False): (9,)}
+    assert mock_koji_session.multicall.call_count == 3
+    batch.listTagged.assert_any_call("tag", inherit=True, latest=False)
+
+
 @pytest.mark.django_db
 @patch("corgi.tasks.brew.Brew")
 @patch("corgi.tasks.sca.cpu_software_composition_analysis.delay")
@@ -1285,6 +1546,52 @@ def test_fetch_rpm_build(mock_load_brew_tags, mock_sca, mock_brew_constructor):
     mock_sca.assert_called_once_with(str(software_build.uuid), force_process=False)
 
 
+@pytest.mark.django_db
+@patch("corgi.tasks.brew.Brew")
+@patch("corgi.tasks.brew.cpu_software_composition_analysis.delay")
+@patch("corgi.tasks.brew.queue_save_taxonomy")
+@patch("corgi.tasks.brew.load_brew_tags")
+def test_fetch_brew_build_skips_unchanged(
+    mock_load_brew_tags, mock_save_taxonomy, mock_sca, mock_brew_constructor
+):
+    """Test that reprocessing a build which didn't change in Brew only updates its tags,
+    unless the build's fingerprint changed or a full rewrite is forced"""
+    with open("tests/data/brew/1705913/component_data.json", "r") as component_data_file:
+        component_data = json.load(component_data_file)
+    mock_brew_obj = mock_brew_constructor.return_value
+    mock_brew_obj.get_component_data.side_effect = lambda *args: copy.deepcopy(component_data)
+    build_id = "1705913"
+
+    with patch("corgi.tasks.brew._check_and_save_type", wraps=_check_and_save_type) as mock_save:
+        assert fetch_brew_build(build_id)
+        software_build = SoftwareBuild.objects.get(build_id=build_id)
+        fingerprint = software_build.fingerprint
+        assert fingerprint
+        assert mock_save.call_count == 1
+
+        # Tags don't change the fingerprint, so only the tags and relations are saved
+        component_data["build_meta"]["build_info"]["tags"] = ["rhel-8.5.0-released"]
+        assert not fetch_brew_build(build_id, force_process=True)
+        assert mock_save.call_count == 1
+        mock_load_brew_tags.assert_called_with(software_build, ["rhel-8.5.0-released"])
+        mock_save_taxonomy.assert_called_with(build_id, SoftwareBuild.Type.BREW)
+        software_build.refresh_from_db()
+        assert software_build.meta_attr["tags"] == ["rhel-8.5.0-released"]
+        assert software_build.fingerprint == fingerprint
+
+        # A full rewrite can be forced
+        fetch_brew_build(build_id, force_rewrite=True)
+        assert mock_save.call_count == 2
+
+        # Changed RPM checksums or build data change the fingerprint
+        component_data["build_meta"]["checksums"] = {"cockpit-251-1.el8.src": "new-payloadhash"}
+        fetch_brew_build(build_id, force_process=True)
+        assert mock_save.call_count == 3
+        software_build.refresh_from_db()
+        assert software_build.fingerprint != fingerprint
+    assert mock_sca.call_count == 3
+
+
 @pytest.mark.django_db
 @patch("corgi.tasks.brew.Brew")
 @patch("corgi.tasks.brew.cpu_software_composition_analysis.delay")
@@ -1295,7 +1602,7 @@ def test_fetch_rpm_build(mock_load_brew_tags, mock_sca, mock_brew_constructor):
     return_value="rhacm2-tech-preview/subctl-rhel8-test",
 )
 def test_fetch_container_build_rpms(
-    mock_pyxis, mock_fetch_brew_build, mock_load_errata, mock_sca, mock_brew
+    mock_pyxis, mock_fetch_brew_build, mock_load_errata, mock_sca, mock_brew, stored_proc
 ):
     with open("tests/data/brew/1781353/component_data.json", "r") as component_data_file:
         mock_brew.return_value.get_component_data.return_value = json.load(component_data_file)
@@ -1380,8 +1687,13 @@ def test_fetch_container_build_rpms(
 @patch("corgi.tasks.brew.slow_fetch_modular_build.apply_async")
 def test_load_stream_brew_tags(mock_fetch_modular_build, mock_brew):
     stream = ProductStreamFactory(brew_tags={"rhacm-2.4-rhel-8-container-released": True})
-    mock_brew.return_value.get_builds_with_tag.return_value = ["1"]
+    mock_brew.return_value.get_builds_with_tags.return_value = {
+        ("rhacm-2.4-rhel-8-container-released", True): (1,)
+    }
     load_stream_brew_tags()
+    mock_brew.return_value.get_builds_with_tags.assert_called_once_with(
+        {("rhacm-2.4-rhel-8-container-released", True)}, latest=False
+    )
     new_brew_tag_relation = ProductComponentRelation.objects.get(
         build_id="1",
         build_type=SoftwareBuild.Type.BREW,
@@ -1391,6 +1703,59 @@ def test_load_stream_brew_tags(mock_fetch_modular_build, mock_brew):
     mock_fetch_modular_build.assert_called_once_with(kwargs={"build_id": "1"}, priority=0)
 
 
+@pytest.mark.django_db
+@patch("corgi.tasks.brew.Brew")
+@patch("corgi.tasks.brew.slow_reset_build_product_taxonomy.delay")
+@patch("corgi.tasks.brew.slow_fetch_modular_build.apply_async")
+def test_load_stream_brew_tags_only_processes_changes(mock_fetch, mock_reset, mock_brew):
+    """Test that tags shared by streams are listed once, and that only builds which were added
+    to or removed from a tag are processed"""
+    stream = ProductStreamFactory(brew_tags={"tag-a": True, "tag-b": False})
+    other_stream = ProductStreamFactory(brew_tags={"tag-a": True})
+    untagged_build = SoftwareBuildFactory(build_id="2")
+    for build_id, software_build in (("1", None), ("2", untagged_build)):
+        ProductComponentRelationFactory(
+            type=ProductComponentRelation.Type.BREW_TAG,
+            product_ref=stream.name,
+            external_system_id="tag-a",
+            build_id=build_id,
+            build_type=SoftwareBuild.Type.BREW,
+            software_build=software_build,
+        )
+    # tag-b couldn't be listed, so its relations are left alone
+    ProductComponentRelationFactory(
+        type=ProductComponentRelation.Type.BREW_TAG,
+        product_ref=stream.name,
+        external_system_id="tag-b",
+        build_id="4",
+        build_type=SoftwareBuild.Type.BREW,
+    )
+    mock_brew.return_value.get_builds_with_tags.return_value = {("tag-a", True): (1, 3)}
+
+    load_stream_brew_tags()
+
+    mock_brew.return_value.get_builds_with_tags.assert_called_once_with(
+        {("tag-a", True), ("tag-b", False)}, latest=False
+    )
+    relations = ProductComponentRelation.objects.filter(type=ProductComponentRelation.Type.BREW_TAG)
+    assert set(
+        relations.filter(product_ref=stream.name).values_list("external_system_id", "build_id")
+    ) == {("tag-a", "1"), ("tag-a", "3"), ("tag-b", "4")}
+    assert set(
+        relations.filter(product_ref=other_stream.name).values_list("build_id", flat=True)
+    ) == {
+        "1",
+        "3",
+    }
+    # Only new relations are processed: build 3 is new to both streams, build 1 to the other stream
+    assert sorted(c.kwargs["kwargs"]["build_id"] for c in mock_fetch.call_args_list) == [
+        "1",
+        "3",
+        "3",
+    ]
+    mock_reset.assert_called_once_with(str(untagged_build.pk))
+
+
 @pytest.mark.django_db
 @patch("corgi.tasks.brew.slow_fetch_brew_build.apply_async")
 @patch("corgi.tasks.brew.slow_fetch_modular_build.apply_async")
@@ -1425,14 +1790,14 @@ def test_new_software_build_relation(mock_save_prod_tax):
 
 
 @pytest.mark.django_db(databases=("default", "read_only"), transaction=True)
-@patch("corgi.tasks.brew.slow_fetch_modular_build.apply_async")
-@patch("corgi.tasks.brew.slow_fetch_brew_build.apply_async")
-def test_load_unprocessed_relations(mock_fetch_brew_task, mock_fetch_modular_task):
+@patch("config.celery.app.send_task")
+def test_load_unprocessed_relations(mock_send):
     # We don't attempt to fetch relations where software_build is set
     sb = SoftwareBuildFactory()
     relation = ProductComponentRelationFactory(software_build=sb)
     assert not relation.build_id
     assert not fetch_unprocessed_relations()
+    mock_send.assert_not_called()
 
     # We call the correct task based on the build_type
     ProductComponentRelationFactory(
@@ -1442,23 +1807,30 @@ def test_load_unprocessed_relations(mock_fetch_brew_task, mock_fetch_modular_tas
     )
     no_processed = fetch_unprocessed_relations()
     assert no_processed == 1
-    mock_fetch_brew_task.assert_called_once_with(
-        args=("1", SoftwareBuild.Type.CENTOS), kwargs={"force_process": False}, priority=0
+    mock_send.assert_called_once_with(
+        "corgi.tasks.brew.slow_fetch_brew_builds",
+        args=(["1"], SoftwareBuild.Type.CENTOS),
+        kwargs={"modular": False, "force_process": False},
+        priority=0,
     )
 
     # test fetch by relation_type
+    mock_send.reset_mock()
     ProductComponentRelationFactory(
         build_type=SoftwareBuild.Type.BREW, build_id=2, type=ProductComponentRelation.Type.COMPOSE
     )
     assert fetch_unprocessed_relations(relation_type=ProductComponentRelation.Type.COMPOSE) == 1
-    mock_fetch_brew_task.assert_called_once_with(
-        args=("1", SoftwareBuild.Type.CENTOS), kwargs={"force_process": False}, priority=0
+    mock_send.assert_called_once_with(
+        "corgi.tasks.brew.slow_fetch_brew_builds",
+        args=(["2"], BUILD_TYPE),
+        kwargs={"modular": True, "force_process": False},
+        priority=0,
     )
 
 
 @pytest.mark.django_db(databases=("default", "read_only"), transaction=True)
-@patch("corgi.tasks.brew.slow_fetch_modular_build.apply_async")
-def test_load_unprocessed_relations_filters(mock_fetch_modular_task):
+@patch("config.celery.app.send_task")
+def test_load_unprocessed_relations_filters(mock_send):
     ProductComponentRelationFactory(
         type=ProductComponentRelation.Type.BREW_TAG,
         build_type=SoftwareBuild.Type.BREW,
@@ -1473,9 +1845,9 @@ def test_load_unprocessed_relations_filters(mock_fetch_modular_task):
     )
 
     assert fetch_unprocessed_relations(relation_type=ProductComponentRelation.Type.BREW_TAG) == 1
-    assert mock_fetch_modular_task.called_with(1)
-    assert fetch_unprocessed_relations(product_ref="a") == 1
-    assert mock_fetch_modular_task.called_with(2)
+    assert mock_send.call_args.kwargs["args"][0] == ["1"]
+    assert fetch_unprocessed_relations(product_ref="b") == 1
+    assert mock_send.call_args.kwargs["args"][0] == ["2"]
     assert (
         fetch_unprocessed_relations(
             product_ref="a", relation_type=ProductComponentRelation.Type.COMPOSE
@@ -1484,6 +1856,59 @@ def test_load_unprocessed_relations_filters(mock_fetch_modular_task):
     )
 
 
+@pytest.mark.django_db
+@patch("corgi.tasks.brew.fetch_brew_build")
+@patch("corgi.tasks.brew.slow_fetch_modular_build")
+@patch("corgi.tasks.brew.queue_save_taxonomy")
+@patch("corgi.tasks.brew.slow_fetch_brew_build.apply_async")
+@patch("corgi.tasks.brew.Brew")
+def test_fetch_brew_builds_chunk(
+    mock_brew, mock_retry, mock_save_taxonomy, mock_fetch_modular, mock_fetch
+):
+    """Test that a chunk of builds is processed in one task, with one lookup for all the builds"""
+    existing_build = SoftwareBuildFactory(build_id="1", build_type=BUILD_TYPE)
+    relation = ProductComponentRelationFactory(build_id="1", build_type=BUILD_TYPE)
+    CollectorRhelModule.objects.create(build_id=2, nvr="module-1-2")
+    build_infos = {3: {"id": 3}, 4: {"id": 4}}
+    mock_brew.return_value.get_builds.return_value = build_infos
+
+    def fetch(build_id, *args, **kwargs):
+        if build_id == "4":
+            raise RequestException("Brew is down")
+        if build_id == "5":
+            raise ValueError("Bad build")
+        return True
+
+    mock_fetch.side_effect = fetch
+    with pytest.raises(ValueError, match="Failed to fetch some builds in chunk"):
+        slow_fetch_brew_builds(["1", "2", "3", "3", "4", "5"], modular=True)
+
+    # Relations for builds which were already processed are linked to them, without a fetch
+    relation.refresh_from_db()
+    assert relation.software_build == existing_build
+    mock_save_taxonomy.assert_called_once_with("1", BUILD_TYPE)
+    # Modules are fetched like slow_fetch_modular_build, other builds like slow_fetch_brew_build
+    mock_fetch_modular.assert_called_once_with("2", save_product=True, force_process=False)
+    assert [c.args[0] for c in mock_fetch.call_args_list] == ["3", "4", "5"]
+    assert list(mock_brew.return_value.get_builds.call_args.args[0]) == [3, 4, 5]
+    assert mock_fetch.call_args_list[0].kwargs["build_info"] == build_infos[3]
+    # Builds with retryable errors are retried on their own
+    mock_retry.assert_called_once_with(args=("4", BUILD_TYPE), kwargs={"force_process": False})
+
+    mock_fetch.side_effect = None
+    summary = slow_fetch_brew_builds(["3"], force_process=True)
+    assert summary["builds"] == summary["fetched"] == 1
+    assert not summary["retried"] and not summary["failed"]
+    mock_fetch.assert_called_with(
+        "3",
+        BUILD_TYPE,
+        brew=mock_brew.return_value,
+        build_info=build_infos[3],
+        save_product=True,
+        force_process=True,
+    )
+
+
 @patch("corgi.tasks.brew.slow_update_name_for_container_from_pyxis.delay")
 @patch("corgi.tasks.brew.get_repo_for_label")
 @patch("corgi.tasks.brew.slow_fetch_pyxis_image_by_nvr")
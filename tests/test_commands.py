@@ -1,3 +1,4 @@
+from datetime import timedelta
 from io import StringIO
 
 import pytest
@@ -5,8 +6,11 @@ from django.contrib.auth import get_user_model
 from django.core.management import call_command
 from django.core.management.base import CommandError
 from django.test import TestCase
+from django.utils import timezone
 from rest_framework.authtoken.models import Token
 
+from corgi.core.models import JobWatermark
+
 pytestmark = pytest.mark.unit
 
 User = get_user_model()
@@ -112,3 +116,27 @@ class CreateUserTokenTest(TestCase):
         token = Token.objects.get(user=ash)
         self.assertEqual(ash.email, "aexample@example.com")
         self.assertEqual(token.key, "654321")
+
+
+@pytest.mark.django_db
+def test_rewind_watermark():
+    job = "corgi.tasks.brew.fetch_unprocessed_brew_tag_relations"
+    value = timezone.now()
+    JobWatermark.objects.create(name=job, value=value)
+
+    call_command("rewindwatermark", job, "--days", "2", stdout=StringIO())
+    assert JobWatermark.objects.get(name=job).value == value - timedelta(days=2)
+    call_command("rewindwatermark", job, "--to", "2024-01-31T00:00:00", stdout=StringIO())
+    assert JobWatermark.objects.get(name=job).value.isoformat() == "2024-01-31T00:00:00+00:00"
+
+    # Watermarks can't be moved forwards, or rewound for jobs that don't have one
+    with pytest.raises(CommandError):
+        call_command("rewindwatermark", job, "--to", value.isoformat())
+    with pytest.raises(CommandError):
+        call_command("rewindwatermark", "missing-job", "--days", "1")
+    with pytest.raises(CommandError):
+        call_command("rewindwatermark", job)
+
+    out = StringIO()
+    call_command("rewindwatermark", stdout=out)
+    assert out.getvalue() == f"{job}: 2024-01-31T00:00:00+00:00\n"
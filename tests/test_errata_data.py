@@ -311,7 +311,16 @@ def test_save_product_component_for_errata(
     slow_load_errata(erratum_id)
     pcrs = ProductComponentRelation.objects.filter(external_system_id=erratum_id)
     assert len(pcrs) == no_of_objs
-    assert mock_send.call_count == no_of_objs
+    # All the erratum's builds are fetched together in a single chunk
+    mock_send.assert_called_once()
+    assert mock_send.call_args.args[0] == "corgi.tasks.brew.slow_fetch_brew_builds"
+    chunk, build_type = mock_send.call_args.kwargs["args"]
+    assert sorted(chunk) == sorted(pcr.build_id for pcr in pcrs)
+    assert mock_send.call_args.kwargs["kwargs"] == {
+        "modular": True,
+        "save_product": False,
+        "force_process": False,
+    }
     for pcr in pcrs:
         # If the relation uses this build's ID
         if pcr.build_id == sb.build_id:
@@ -337,8 +346,8 @@ def test_update_product_component_relation():
     assert ProductComponentRelation.objects.all().count() == 1
 
 
-@patch("corgi.tasks.errata_tool.app")
-def test_slow_save_errata_product_taxonomy(mock_app):
+@patch("corgi.tasks.errata_tool.queue_save_taxonomy")
+def test_slow_save_errata_product_taxonomy(mock_queue_save_taxonomy):
     sb = SoftwareBuildFactory()
     sb2 = SoftwareBuildFactory()
     ProductComponentRelationFactory(
@@ -356,12 +365,9 @@ def test_slow_save_errata_product_taxonomy(mock_app):
         build_type=sb2.build_type,
     )
     slow_save_errata_product_taxonomy(1)
-    send_task_calls = [
-        call("corgi.tasks.common.slow_save_taxonomy", args=(sb.build_id, sb.build_type)),
-        call("corgi.tasks.common.slow_save_taxonomy", args=(sb2.build_id, sb2.build_type)),
-    ]
+    queue_calls = [call(sb.build_id, sb.build_type), call(sb2.build_id, sb2.build_type)]
     # Calls happen based on build ID / UUID ordering, which is random
-    mock_app.send_task.assert_has_calls(send_task_calls, any_order=True)
+    mock_queue_save_taxonomy.assert_has_calls(queue_calls, any_order=True)
 
 
 @patch("corgi.collectors.brew.Brew.persist_modules")
@@ -1,22 +1,38 @@
+import gzip
 import json
 import logging
 import uuid
+from datetime import datetime
 from json import JSONDecodeError
+from unittest.mock import patch
 
 import jsonschema
 import pytest
+import zstandard
 from django.conf import settings
-from django_celery_results.models import TaskResult
-
-from corgi.core.files import ComponentManifestFile, ProductManifestFile
+from django.utils import timezone
+
+from corgi.core.files import (
+    ComponentManifestFile,
+    PackageCache,
+    ProductManifestFile,
+    get_accepted_manifest_encoding,
+    get_spdx_content_errors,
+)
 from corgi.core.fixups import cpe_lookup
 from corgi.core.models import (
     Component,
     ComponentNode,
     ProductComponentRelation,
     ProductNode,
+    TaskRun,
+)
+from corgi.tasks.manifest import (
+    _write_content,
+    cpu_validate_ps_manifest,
+    report_manifest_package_cache,
+    same_contents,
 )
-from corgi.tasks.manifest import same_contents
 from corgi.web.templatetags.base_extras import provided_relationship
 
 from .conftest import setup_product
@@ -107,6 +123,7 @@ def test_manifests_exclude_bad_golang_components(stored_proc):
     )
     # Link the bad_golang component to its parent container
     containers[0].save_component_taxonomy()
+    stream.refresh_aggregate_components(changed_root_pks=[containers[0].pk])
     assert containers[0].provides.filter(name=bad_golang.name).exists()
 
     manifest = ProductManifestFile(stream).render_content()
@@ -133,6 +150,7 @@ def test_manifests_exclude_bad_dot_dot_golang_components(stored_proc):
     )
     # Link the bad_golang component to its parent container
     containers[0].save_component_taxonomy()
+    stream.refresh_aggregate_components(changed_root_pks=[containers[0].pk])
     assert containers[0].provides.filter(name=bad_golang.name).exists()
 
     manifest = ProductManifestFile(stream).render_content()
@@ -674,6 +692,30 @@ def test_component_manifest_properties():
     assert expected_extracted_licensing_info == extracted_licensing_info
 
 
+def test_component_manifest_cache():
+    """Test that component manifests are only rendered again when the fingerprint changes"""
+    component, _, provided, _ = setup_products_and_components_provides()
+    fingerprint = component.get_manifest_fingerprint()
+
+    with patch.object(ComponentManifestFile, "validate_content", autospec=True) as mock_validate:
+        manifest_json = ComponentManifestFile(component).render_cached_json()
+        assert ComponentManifestFile(component).render_cached_json() == manifest_json
+        # Validation only happens once, when the cache is filled
+        mock_validate.assert_called_once()
+
+        # Changing a provided component changes the fingerprint, so the manifest is re-rendered
+        provided.license_declared_raw = "MIT"
+        provided.save()
+        assert component.get_manifest_fingerprint() != fingerprint
+        new_manifest_json = ComponentManifestFile(component).render_cached_json()
+        assert mock_validate.call_count == 2
+
+    new_packages = {
+        package["name"]: package for package in json.loads(new_manifest_json)["packages"]
+    }
+    assert new_packages[provided.name]["licenseDeclared"] == "MIT"
+
+
 def setup_products_and_components_upstreams():
     stream, variant = setup_product()
     meta_attr = {"released_errata_tags": ["RHBA-2023:1234"]}
@@ -734,6 +776,7 @@ def setup_products_and_components_upstreams():
     # Link the components to the ProductModel instances
     build.save_product_taxonomy()
     other_build.save_product_taxonomy()
+    stream.refresh_aggregate_components()
 
     return stream, component, other_component, upstream
 
@@ -788,6 +831,7 @@ def setup_products_and_components_provides(released=True, internal_component=Fal
     )
     # Link the components to the ProductModel instances
     build.save_product_taxonomy()
+    stream.refresh_aggregate_components()
     return component, stream, provided, dev_provided
 
 
@@ -810,6 +854,7 @@ def setup_products_and_rpm_in_containers():
         # Link the components to the ProductModel instances
         build.save_product_taxonomy()
         containers.append(container)
+    stream.refresh_aggregate_components()
     return containers, stream, rpm_in_container
 
 
@@ -873,11 +918,13 @@ def test_same_contents(stored_proc):
     cpe = "cpe:/a:redhat:external_name:1.0::el8"
     external_name = "external-name-1.0"
     stream = ProductStreamFactory(name=external_name, version="1.0")
-    TaskResult.objects.create(
+    TaskRun.objects.create(
+        task_id="update-manifest",
         task_name="corgi.tasks.manifest.cpu_update_ps_manifest",
-        task_args=f"\"('{external_name}')\"",
-        status="SUCCESS",
-        result='[true, "2024-01-31T00:22:29Z", "SPDXRef-303ea2fd-1a48-4590-90b4-4fd901272ca3"]',
+        key=external_name,
+        status=TaskRun.Status.SUCCESS,
+        started_at=timezone.now(),
+        summary=[True, "2024-01-31T00:22:29Z", "SPDXRef-303ea2fd-1a48-4590-90b4-4fd901272ca3"],
     )
     stream_node = ProductStreamNodeFactory(obj=stream)
     variant = ProductVariantFactory(cpe=cpe)
@@ -907,11 +954,13 @@ def test_different_contents(stored_proc):
 
     # test different content
     existing_file = "tests/data/manifest/sbom.json"
-    TaskResult.objects.create(
+    TaskRun.objects.create(
+        task_id="update-manifest",
         task_name="corgi.tasks.manifest.cpu_update_ps_manifest",
-        task_args=f"\"('{external_name}')\"",
-        status="SUCCESS",
-        result=f'[true, "{last_successful_created_at_date}", "{last_successful_document_id}"]',
+        key=external_name,
+        status=TaskRun.Status.SUCCESS,
+        started_at=timezone.now(),
+        summary=[True, last_successful_created_at_date, last_successful_document_id],
     )
     # This allows the ofuri value to work during manifest creation
     ProductStreamNodeFactory(obj=stream)
@@ -924,3 +973,184 @@ def test_different_contents(stored_proc):
     # document_uuid is populated
     assert new_content["packages"][0]["SPDXID"] != last_successful_document_id
     assert new_content["relationships"][0]["relatedSpdxElement"] != last_successful_document_id
+
+
+@pytest.mark.parametrize("compact", (False, True))
+@patch("corgi.tasks.manifest.cpu_validate_ps_manifest.delay")
+def test_write_content_compressed_copies(mock_validate, compact, settings, tmp_path):
+    settings.MANIFEST_COMPACT_JSON = compact
+    document_uuid = f"SPDXRef-{uuid.uuid4()}"
+    content = {
+        "creationInfo": {"created": "2024-01-31T00:22:29Z"},
+        "packages": [{"SPDXID": document_uuid, "name": "Ⓡ" * 70000}],
+        "relationships": [
+            {
+                "spdxElementId": "SPDXRef-DOCUMENT",
+                "relationshipType": "DESCRIBES",
+                "relatedSpdxElement": document_uuid,
+            }
+        ],
+    }
+    output_file = tmp_path / "stream.json"
+
+    created_at, result_uuid = _write_content(content, str(output_file), "stream")
+    assert created_at == "2024-01-31T00:22:29Z"
+    assert result_uuid == document_uuid
+    mock_validate.assert_called_once_with("stream")
+
+    plain_content = output_file.read_bytes()
+    assert json.loads(plain_content) == content
+    assert (b"\n" not in plain_content) == compact
+    with gzip.open(tmp_path / "stream.json.gz") as gz_fh:
+        assert gz_fh.read() == plain_content
+    with zstandard.open(tmp_path / "stream.json.zst", "rb") as zst_fh:
+        assert zst_fh.read() == plain_content
+    # Temporary files are all renamed once written
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "stream.json",
+        "stream.json.gz",
+        "stream.json.zst",
+    ]
+
+
+@pytest.mark.parametrize(
+    "accept_encoding,expected",
+    (
+        ("", ""),
+        ("gzip, deflate", "gzip"),
+        ("gzip, deflate, br, zstd", "zstd"),
+        ("zstd;q=0, gzip;q=0.5", "gzip"),
+        ("GZIP", "gzip"),
+        ("br, identity", ""),
+    ),
+)
+def test_get_accepted_manifest_encoding(accept_encoding, expected):
+    assert get_accepted_manifest_encoding(accept_encoding) == expected
+
+
+def test_fast_spdx_validation(stored_proc):
+    """Test that rendered manifests pass the fast SPDX checks, and broken ones fail them"""
+    component, stream, _, _ = setup_products_and_components_provides()
+    content = ProductManifestFile(stream).render_content()
+    assert list(get_spdx_content_errors(content)) == []
+    assert list(get_spdx_content_errors(ComponentManifestFile(component).render_content())) == []
+
+    broken_content = json.loads(json.dumps(content))
+    broken_content["packages"].append(dict(broken_content["packages"][0]))
+    broken_content["relationships"].append(
+        {
+            "spdxElementId": "SPDXRef-missing",
+            "relationshipType": "CONTAINS",
+            "relatedSpdxElement": broken_content["packages"][0]["SPDXID"],
+        }
+    )
+    broken_content["packages"][0]["licenseDeclared"] = "MIT AND LicenseRef-missing"
+    del broken_content["creationInfo"]["creators"]
+    errors = list(get_spdx_content_errors(broken_content))
+    assert errors == [
+        "document creationInfo is missing required field creators",
+        f"package SPDXID {content['packages'][0]['SPDXID']} is not unique",
+        "relationship spdxElementId SPDXRef-missing does not exist in the document",
+        "LicenseRef-missing is used by a package, but is not declared in the document",
+    ]
+
+
+@patch("corgi.tasks.manifest.slow_ensure_root_upstreams.delay")
+@patch("corgi.tasks.manifest.slow_ensure_root_provides.delay")
+@pytest.mark.parametrize("full", (False, True))
+def test_cpu_validate_ps_manifest(
+    mock_provides, mock_upstreams, full, stored_proc, settings, tmp_path
+):
+    settings.STATIC_ROOT = str(tmp_path)
+    _, stream, _, _ = setup_products_and_components_provides()
+    content = ProductManifestFile(stream).render_content()
+    manifest_path = tmp_path / f"{stream.external_name}.json"
+    manifest_path.write_text(json.dumps(content))
+
+    cpu_validate_ps_manifest(stream.name, full=full)
+    mock_provides.assert_not_called()
+    mock_upstreams.assert_not_called()
+
+    # A relationship to a package which is missing from the manifest is a validation error
+    content["relationships"].append(
+        {
+            "spdxElementId": content["packages"][0]["SPDXID"],
+            "relationshipType": "CONTAINS",
+            "relatedSpdxElement": "SPDXRef-missing",
+        }
+    )
+    manifest_path.write_text(json.dumps(content))
+    cpu_validate_ps_manifest(stream.name, full=full)
+    mock_provides.assert_called_once_with(stream.name)
+    mock_upstreams.assert_called_once_with(stream.name)
+
+
+def test_refresh_aggregate_components(stored_proc):
+    """Test that stream provides / upstreams are only updated for changed root components"""
+    component, stream, provided, dev_provided = setup_products_and_components_provides()
+    assert set(stream.provides_queryset) == {provided, dev_provided}
+    # Nothing changed, so no roots are updated
+    assert stream.refresh_aggregate_components() == 0
+
+    # Saving the taxonomy alone doesn't change anything, until the root is refreshed
+    new_provided = BinaryRpmComponentFactory()
+    ComponentNode.objects.create(
+        type=ComponentNode.ComponentNodeType.PROVIDES,
+        parent=component.cnodes.get(),
+        obj=new_provided,
+    )
+    component.save_component_taxonomy()
+    assert new_provided not in stream.provides_queryset
+    assert stream.refresh_aggregate_components(changed_root_pks=[str(component.pk)]) == 1
+    assert set(stream.provides_queryset) == {provided, dev_provided, new_provided}
+
+    # Removing the root from the stream removes its provides
+    component.productstreams.remove(stream)
+    assert stream.refresh_aggregate_components() == 1
+    assert not stream.provides_queryset.exists()
+    assert not stream.aggregate_components.exists()
+
+
+def test_package_cache(stored_proc):
+    """Test that cached packages render the same manifest as uncached packages"""
+    component, stream, provided, dev_provided = setup_products_and_components_provides()
+    # License refs named after the license can be reused in other manifests
+    provided.license_declared_raw = "BSD and LGPLv2"
+    provided.save()
+    # License refs using a counter are different in each manifest, so can't be cached
+    dev_provided.license_declared_raw = "BSD or (GPLv3+ with exceptions)"
+    dev_provided.save()
+    created_at = datetime(2024, 1, 31)
+    document_uuid = f"SPDXRef-{uuid.uuid4()}"
+    expected_content = ProductManifestFile(stream).render_content(created_at, document_uuid)
+
+    package_cache = PackageCache()
+    for _ in range(2):
+        content = ProductManifestFile(stream, package_cache).render_content(
+            created_at, document_uuid
+        )
+        assert content == expected_content
+    assert list(package_cache.packages) == [(provided.pk, provided.last_changed)]
+    # Both provided components were rendered the first time, only dev_provided the second time
+    assert package_cache.hits == 1
+    assert package_cache.misses == 3
+    assert package_cache.build_seconds > 0
+
+    # A changed component is rendered again
+    provided.license_declared_raw = "MIT"
+    provided.save()
+    ProductManifestFile(stream, package_cache).render_content(created_at, document_uuid)
+    assert package_cache.hits == 1
+    assert package_cache.misses == 5
+
+
+def test_report_manifest_package_cache():
+    results = [
+        [True, "2024-01-31T00:22:29Z", "SPDXRef-1", {"hits": 0, "misses": 4, "build_seconds": 2.0}],
+        [False, "", "", {"hits": 6, "misses": 0, "build_seconds": 0.0}],
+    ]
+    stats = report_manifest_package_cache(results, "run-id")
+    assert stats == {"hits": 6, "misses": 4, "build_seconds": 2.0}
+    assert PackageCache.summarize_stats(stats) == (
+        "6 hits / 10 lookups (60.0% hit rate), saved about 3.0s of 2.0s spent building"
+    )
@@ -74,6 +74,8 @@ def test_umb_receiver_setup():
     mock_umb_event = MagicMock()
     mock_connection_constructor = mock_umb_event.container.connect
     mock_connection_instance = mock_connection_constructor.return_value
+    mock_receiver = mock_umb_event.container.create_receiver.return_value
+    mock_receiver.credit = 0
     with patch("corgi.monitor.consumer.Selector") as mock_selector:
         handler.on_start(mock_umb_event)
         mock_selector.assert_called_once_with("errata_status = 'SHIPPED_LIVE'")
@@ -95,6 +97,9 @@ def test_umb_receiver_setup():
     ]
     assert len(handler.virtual_topic_addresses) == 5
     mock_umb_event.container.create_receiver.assert_has_calls(create_receiver_calls)
+    # Each receiver asks for messages itself, instead of proton granting credit automatically
+    assert handler.receivers == [mock_receiver] * 5
+    mock_receiver.flow.assert_called_with(settings.UMB_PREFETCH)
 
 
 def test_umb_receiver_():
@@ -116,6 +121,12 @@ def test_umb_receiver_():
     with pytest.raises(ValueError):
         handler.on_message(mock_umb_event)
 
+    # Messages which can't be parsed are released back into the queue
+    mock_umb_event.message.address = "topic://VirtualTopic.eng.brew.build.tag"
+    with patch.object(handler, "release") as mock_release:
+        handler.on_message(mock_umb_event)
+    mock_release.assert_called_once_with(mock_umb_event.delivery, delivered=True)
+
     mock_umb_event.message.address = None
     with pytest.raises(ValueError):
         handler.on_message(mock_umb_event)
@@ -265,9 +276,9 @@ def test_umb_receiver_handles_shipped_errata():
     # with an erratum_id and erratum_status arg
     slow_handle_shipped_errata_mock.assert_has_calls(
         (
-            call(args=(mock_id, "SHIPPED_LIVE")),
-            call(args=(mock_id, "DROPPED_NO_SHIP")),
-            call(args=(mock_id, "SHIPPED_LIVE")),
+            call(args=(mock_id, "SHIPPED_LIVE"), kwargs={}),
+            call(args=(mock_id, "DROPPED_NO_SHIP"), kwargs={}),
+            call(args=(mock_id, "SHIPPED_LIVE"), kwargs={}),
         )
     )
 
@@ -301,9 +312,9 @@ def test_umb_receiver_handles_shipped_errata():
     # slow_handle_pnc_released_errata takes erratum_id, erratum_status as arguments
     slow_handle_pnc_errata_released_mock.assert_has_calls(
         (
-            call(args=(mock_id, "SHIPPED_LIVE")),
-            call(args=(mock_id, "DROPPED_NO_SHIP")),
-            call(args=(mock_id, "SHIPPED_LIVE")),
+            call(args=(mock_id, "SHIPPED_LIVE"), kwargs={}),
+            call(args=(mock_id, "DROPPED_NO_SHIP"), kwargs={}),
+            call(args=(mock_id, "SHIPPED_LIVE"), kwargs={}),
         )
     )
 
@@ -327,15 +338,19 @@ def test_sbomer_handles_sbom_available():
     fetch_sbom_exceptions = (None, Exception("Bad SBOM URL"))
 
     with patch(
-        "corgi.monitor.consumer.slow_fetch_pnc_sbom.delay", side_effect=fetch_sbom_exceptions
+        "corgi.monitor.consumer.slow_fetch_pnc_sbom.apply_async",
+        side_effect=fetch_sbom_exceptions,
     ) as mock_fetch_sbom:
         with patch.object(receiver, "accept") as mock_accept:
             receiver.on_message(mock_event)
             mock_accept.assert_called_once_with(mock_event.delivery)
             mock_fetch_sbom.assert_called_once_with(
-                test_data["msg"]["purl"],
-                test_data["msg"]["productConfig"]["errataTool"],
-                test_data["msg"]["sbom"],
+                args=(
+                    test_data["msg"]["purl"],
+                    test_data["msg"]["productConfig"]["errataTool"],
+                    test_data["msg"]["sbom"],
+                ),
+                kwargs={},
             )
 
         with patch.object(receiver, "release") as mock_release:
@@ -362,14 +377,14 @@ def test_handle_pyxis_available():
     fetch_manifest_exceptions = (None, Exception("Bad contentmanifest URL"))
 
     with patch(
-        "corgi.monitor.consumer.slow_fetch_pyxis_manifest.delay",
+        "corgi.monitor.consumer.slow_fetch_pyxis_manifest.apply_async",
         side_effect=fetch_manifest_exceptions,
     ) as mock_fetch_manifest:
         with patch.object(receiver, "accept") as mock_accept:
             receiver.on_message(mock_event)
             mock_accept.assert_called_once_with(mock_event.delivery)
             mock_fetch_manifest.assert_called_once_with(
-                test_data["msg"]["entityData"]["_id"]["$oid"],
+                args=(test_data["msg"]["entityData"]["_id"]["$oid"],), kwargs={}
             )
         mock_fetch_manifest.reset_mock()
 
@@ -377,7 +392,7 @@ def test_handle_pyxis_available():
             receiver.on_message(mock_event)
             mock_release.assert_called_once_with(mock_event.delivery, delivered=True)
             mock_fetch_manifest.assert_called_once_with(
-                test_data["msg"]["entityData"]["_id"]["$oid"],
+                args=(test_data["msg"]["entityData"]["_id"]["$oid"],), kwargs={}
             )
 
 
@@ -397,8 +412,166 @@ def test_ignore_pyxis_brew_manifests():
     mock_event.message.address = test_data["topic"].replace("/topic/", VIRTUAL_TOPIC_ADDRESS_PREFIX)
     mock_event.message.body = json.dumps(test_data["msg"])
 
-    with patch("corgi.monitor.consumer.slow_fetch_pyxis_manifest.delay") as mock_fetch_manifest:
+    with patch(
+        "corgi.monitor.consumer.slow_fetch_pyxis_manifest.apply_async"
+    ) as mock_fetch_manifest:
         with patch.object(receiver, "accept") as mock_accept:
             receiver.on_message(mock_event)
             mock_accept.assert_called_once_with(mock_event.delivery)
             mock_fetch_manifest.assert_not_called()
+
+
+def test_umb_receiver_batches_messages(settings):
+    """Test that messages about the same build or erratum are coalesced into one task,
+    and only accepted after the batch of tasks is sent"""
+    settings.UMB_BATCH_WINDOW = 5
+    settings.UMB_BATCH_MAX_SIZE = 10
+    listener = UMBListener()
+    with patch("corgi.monitor.consumer.SSLDomain"):
+        handler = UMBReceiverHandler(
+            virtual_topic_addresses=listener.virtual_topic_addresses, selectors=listener.selectors
+        )
+
+    def make_event(address, body):
+        event = MagicMock()
+        event.message.address = f"topic://VirtualTopic.eng.{address}"
+        event.message.body = json.dumps(body)
+        return event
+
+    tag_events = [
+        make_event("brew.build.tag", {"build": {"build_id": 1}, "tag": {"name": "tag-1"}}),
+        make_event("brew.build.untag", {"build": {"build_id": 1}, "tag": {"name": "tag-2"}}),
+        make_event("brew.build.tag", {"build": {"build_id": 2}, "tag": {"name": "tag-1"}}),
+    ]
+    errata_body = {
+        "errata_status": "SHIPPED_LIVE",
+        "errata_id": 1234,
+        "product": "Product",
+        "release": "Red Hat release of Product",
+    }
+    errata_events = [make_event("errata.activity.status", errata_body) for _ in range(2)]
+
+    with patch("corgi.monitor.consumer.slow_update_brew_tags.apply_async") as mock_update, patch(
+        "corgi.monitor.consumer.slow_refresh_brew_build_tags.apply_async"
+    ) as mock_refresh, patch(
+        "corgi.monitor.consumer.slow_handle_shipped_errata.apply_async",
+        side_effect=Exception("Broker is down"),
+    ) as mock_errata, patch.object(
+        handler, "accept"
+    ) as mock_accept, patch.object(
+        handler, "release"
+    ) as mock_release:
+        for event in (*tag_events, *errata_events):
+            handler.on_message(event)
+        # Nothing is sent or accepted until the batch window ends
+        tag_events[0].container.schedule.assert_called_once_with(5, handler)
+        for event in errata_events:
+            event.container.schedule.assert_not_called()
+        mock_update.assert_not_called()
+        mock_accept.assert_not_called()
+
+        handler.on_timer_task(MagicMock())
+
+    # Both tag events for build 1 refresh all its tags, build 2 only gets its one new tag
+    mock_refresh.assert_called_once_with(args=(1,), kwargs={})
+    mock_update.assert_called_once_with(args=(2,), kwargs={"tag_added": "tag-1"})
+    mock_accept.assert_has_calls([call(event.delivery) for event in tag_events], any_order=True)
+    # Messages for tasks that couldn't be sent are released, to be delivered again
+    mock_errata.assert_called_once_with(args=(1234, "SHIPPED_LIVE"), kwargs={})
+    mock_release.assert_has_calls(
+        [call(event.delivery, delivered=True) for event in errata_events], any_order=True
+    )
+    assert handler.stats == {"received": 5, "coalesced": 2, "dispatched": 2, "failed": 1}
+    assert not handler.pending_tasks
+
+    # The batch is sent early when it's too big
+    settings.UMB_BATCH_MAX_SIZE = 3
+    with patch("corgi.monitor.consumer.slow_update_brew_tags.apply_async") as mock_update, patch(
+        "corgi.monitor.consumer.slow_handle_shipped_errata.apply_async"
+    ), patch.object(handler, "accept") as mock_accept:
+        handler.on_message(tag_events[0])
+        handler.on_message(tag_events[2])
+        mock_accept.assert_not_called()
+        handler.on_message(errata_events[0])
+    assert mock_update.call_count == 2
+    assert mock_accept.call_count == 3
+
+
+def test_umb_receiver_spools_messages(settings, tmp_path):
+    """Test that messages are accepted once their tasks are spooled, that spooled tasks are sent
+    after the broker comes back or the consumer restarts, and that we stop asking for more messages
+    while the spool is backed up"""
+    settings.UMB_SPOOL_PATH = str(tmp_path / "spool.sqlite3")
+    settings.UMB_SPOOL_MAX_DEPTH = 2
+    settings.UMB_PREFETCH = 10
+    listener = UMBListener()
+
+    def start_handler():
+        with patch("corgi.monitor.consumer.SSLDomain"):
+            handler = UMBReceiverHandler(
+                virtual_topic_addresses=listener.virtual_topic_addresses,
+                selectors=listener.selectors,
+            )
+        receiver = MagicMock(credit=0)
+        start_event = MagicMock()
+        start_event.container.create_receiver.return_value = receiver
+        handler.on_start(start_event)
+        return handler, receiver
+
+    def make_event(address, build_id, tag):
+        event = MagicMock()
+        event.message.address = f"topic://VirtualTopic.eng.brew.build.{address}"
+        event.message.body = json.dumps({"build": {"build_id": build_id}, "tag": {"name": tag}})
+        return event
+
+    handler, receiver = start_handler()
+    assert receiver.flow.call_count == len(listener.virtual_topic_addresses)
+    receiver.flow.assert_called_with(10)
+    receiver.flow.reset_mock()
+    receiver.credit = 10
+
+    tag_events = [
+        make_event("tag", 1, "tag-1"),
+        make_event("untag", 1, "tag-2"),
+        make_event("tag", 2, "tag-1"),
+    ]
+    with patch(
+        "corgi.monitor.consumer.slow_update_brew_tags.apply_async",
+        side_effect=Exception("Broker is down"),
+    ) as mock_update, patch(
+        "corgi.monitor.consumer.slow_refresh_brew_build_tags.apply_async",
+        side_effect=Exception("Broker is down"),
+    ) as mock_refresh, patch.object(
+        handler, "accept"
+    ) as mock_accept, patch.object(
+        handler, "release"
+    ) as mock_release:
+        handler.on_message(tag_events[0])
+        # The task couldn't be sent, so it's retried later
+        tag_events[0].container.schedule.assert_called_once_with(30, handler)
+        handler.on_message(tag_events[1])
+        handler.on_message(tag_events[2])
+
+    # Messages are accepted even though their tasks couldn't be sent yet
+    mock_accept.assert_has_calls([call(event.delivery) for event in tag_events])
+    mock_release.assert_not_called()
+    # Spooled tasks for the same build are coalesced
+    mock_update.assert_called_once_with(args=(1,), kwargs={"tag_added": "tag-1"})
+    mock_refresh.assert_called_with(args=(1,), kwargs={})
+    assert len(handler.spool) == 2
+    # Once the spool is full, we stop asking for more messages
+    assert handler.paused
+    receiver.flow.assert_not_called()
+    assert handler.stats["paused"] == 1
+
+    # After a restart, the spooled tasks are sent and we ask for more messages again
+    handler, receiver = start_handler()
+    with patch("corgi.monitor.consumer.slow_update_brew_tags.apply_async") as mock_update, patch(
+        "corgi.monitor.consumer.slow_refresh_brew_build_tags.apply_async"
+    ) as mock_refresh:
+        handler.on_timer_task(MagicMock())
+    mock_refresh.assert_called_once_with(args=(1,), kwargs={})
+    mock_update.assert_called_once_with(args=(2,), kwargs={"tag_added": "tag-1"})
+    assert len(handler.spool) == 0
+    assert not handler.paused
+    receiver.flow.assert_called_with(10)
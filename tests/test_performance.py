@@ -1,4 +1,8 @@
+import threading
+import time
 import timeit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
 from urllib.parse import quote_plus
 
 import pytest
@@ -9,6 +13,7 @@ from django.conf import settings
 # to detect slow queries, missing indexes, and other issues that need large data volumes
 # To run tests against a local development environment, make sure that CORGI_DOMAIN is unset
 from corgi.api.constants import CORGI_API_VERSION
+from corgi.collectors.brew import Brew
 
 if settings.CORGI_DOMAIN:
     CORGI_API_URL = f"https://{settings.CORGI_DOMAIN}/api/{CORGI_API_VERSION}"
@@ -200,3 +205,52 @@ def test_re_provides_name_performance() -> None:
     assert len(test_results) == 3
     median_time_taken = test_results[1]
     assert median_time_taken < 5.0
+
+
+class RecordedResponseHandler(BaseHTTPRequestHandler):
+    """Serve recorded remote-source / Cachito manifests from tests/data,
+    waiting 0.2 seconds before each response to simulate the network latency of Brew"""
+
+    def do_GET(self) -> None:
+        time.sleep(0.2)
+        body = Path(f"tests/data/{self.path.rsplit('/', 1)[-1]}").read_bytes()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+def test_concurrent_remote_source_fetching() -> None:
+    """Test that downloading many remote-source / Cachito manifests at once is faster than
+    downloading them one at a time. This uses recorded responses instead of a live environment"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RecordedResponseHandler)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    try:
+        base_url = f"http://127.0.0.1:{server.server_port}"
+        urls = [
+            f"{base_url}/{i}/{path.name}"
+            for i in range(2)
+            for path in sorted(Path("tests/data").glob("remote-source-*.json"))
+        ]
+
+        start = time.perf_counter()
+        serial_results = [Brew._get_remote_source(url) for url in urls]
+        serial_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        concurrent_results = Brew._get_remote_sources(urls)
+        concurrent_time = time.perf_counter() - start
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert [result.repo for result in concurrent_results] == [
+        result.repo for result in serial_results
+    ]
+    # 18 manifests from one host, with 4 connections per host, should take about 5 rounds
+    assert concurrent_time < serial_time / 2
@@ -8,6 +8,7 @@ from corgi.collectors.models import (
     CollectorErrataProduct,
     CollectorErrataProductVariant,
     CollectorErrataProductVersion,
+    CollectorProductDefinition,
 )
 from corgi.core.models import (
     Product,
@@ -18,9 +19,11 @@ from corgi.core.models import (
     ProductVersion,
 )
 from corgi.tasks.prod_defs import (
+    _clean_orphaned_relations_and_builds,
     _find_by_cpe,
     _match_and_save_stream_cpes,
     _parse_variants_from_brew_tags,
+    parse_product_stream,
     update_products,
 )
 from tests.factories import (
@@ -701,7 +704,7 @@ def test_parse_variants_from_brew_tags():
 
 @pytest.mark.django_db
 @patch("corgi.tasks.prod_defs.slow_reset_build_product_taxonomy.delay")
-@patch("corgi.tasks.prod_defs.slow_save_taxonomy.delay")
+@patch("corgi.tasks.prod_defs.queue_save_taxonomy")
 def test_multi_variant_streams(mock_save, mock_remove, requests_mock):
     """Test that errata_info variants are attached to both active stream and inactive streams"""
     with open("tests/data/prod_defs/proddefs-update-multi-stream-variant.json") as prod_defs:
@@ -770,3 +773,103 @@ def test_multi_variant_active_streams(requests_mock):
     assert ga_stream.productvariants.get_queryset().count() == 1
     z_stream = ProductStream.objects.get(name="z_stream")
     assert z_stream.productvariants.get_queryset().count() == 1
+
+
+@pytest.mark.django_db
+@patch("corgi.tasks.prod_defs.slow_reset_build_product_taxonomy.delay")
+def test_clean_orphaned_relations_and_builds(mock_reset, caplog):
+    """Test that relations for removed tags are deleted in bulk, and builds are only reset
+    once they have no relations left to the stream"""
+    stream = ProductStreamFactory(name="stream")
+    kept_build = SoftwareBuildFactory()
+    removed_build = SoftwareBuildFactory()
+    for tag in ("kept_tag", "removed_tag", "other_removed_tag"):
+        ProductComponentRelation.objects.create(
+            external_system_id=tag,
+            product_ref=stream.name,
+            software_build=removed_build if tag != "kept_tag" else kept_build,
+            build_id=removed_build.build_id if tag != "kept_tag" else kept_build.build_id,
+            type=ProductComponentRelation.Type.BREW_TAG,
+        )
+    # A relation for the kept build's removed tag, which shouldn't reset the build
+    ProductComponentRelation.objects.create(
+        external_system_id="removed_tag",
+        product_ref=stream.name,
+        software_build=kept_build,
+        build_id=kept_build.build_id,
+        build_type=kept_build.build_type,
+        type=ProductComponentRelation.Type.BREW_TAG,
+    )
+    # Relations with other types or for other streams are left alone
+    ProductComponentRelation.objects.create(
+        external_system_id="removed_tag",
+        product_ref="other_stream",
+        software_build=removed_build,
+        build_id=removed_build.build_id,
+        type=ProductComponentRelation.Type.BREW_TAG,
+    )
+
+    _clean_orphaned_relations_and_builds(
+        {"kept_tag", "new_tag"}, stream, ProductComponentRelation.Type.BREW_TAG
+    )
+
+    assert set(
+        ProductComponentRelation.objects.values_list("external_system_id", "product_ref")
+    ) == {("kept_tag", stream.name), ("removed_tag", "other_stream")}
+    mock_reset.assert_called_once_with(str(removed_build.pk))
+    assert "delete relations affected 3 rows" in caplog.text
+    assert "reset builds affected 1 rows" in caplog.text
+
+
+@pytest.mark.django_db
+@patch("corgi.tasks.prod_defs.slow_reset_build_product_taxonomy.delay")
+def test_update_products_applies_only_changes(mock_reset, requests_mock):
+    """Test that update_products only parses definitions which changed since the last sync"""
+    with open("tests/data/prod_defs/proddefs-update.json") as prod_defs:
+        requests_mock.get(settings.PRODDEFS_DATA_URL, text=prod_defs.read())
+
+    # Stream definitions are changed while they're parsed, so record their names first
+    parsed_streams = []
+
+    def _parse_product_stream(pd_product_stream, *args):
+        parsed_streams.append(pd_product_stream["id"])
+        return parse_product_stream(pd_product_stream, *args)
+
+    with patch("corgi.tasks.prod_defs.parse_product_stream", side_effect=_parse_product_stream):
+        update_products()
+        assert sorted(parsed_streams) == ["stream", "yum_stream"]
+        assert set(CollectorProductDefinition.objects.values_list("type", "name", "parent")) == {
+            (CollectorProductDefinition.Type.PRODUCT, "product", ""),
+            (CollectorProductDefinition.Type.VERSION, "version", "product"),
+            (CollectorProductDefinition.Type.STREAM, "stream", "version"),
+            (CollectorProductDefinition.Type.STREAM, "yum_stream", "version"),
+        }
+
+        # Nothing changed, so nothing is parsed
+        parsed_streams.clear()
+        with patch("corgi.core.models.Product.save_product_taxonomy") as mock_taxonomy:
+            update_products()
+        assert not parsed_streams
+        assert not mock_taxonomy.called
+
+        # Only the changed stream is parsed, and the removed stream is left alone
+        with open("tests/data/prod_defs/proddefs-update-tag-removed.json") as prod_defs:
+            requests_mock.get(settings.PRODDEFS_DATA_URL, text=prod_defs.read())
+        update_products()
+        assert parsed_streams == ["stream"]
+        assert ProductStream.objects.get(name="stream").brew_tags == {}
+        assert ProductStream.objects.filter(name="yum_stream").exists()
+        assert not CollectorProductDefinition.objects.filter(name="yum_stream").exists()
+
+        # Everything is parsed again when the Errata Tool data changes, or when forced
+        parsed_streams.clear()
+        CollectorErrataProduct.objects.create(et_id=1, name="product", short_name="product")
+        CollectorErrataProductVersion.objects.create(
+            et_id=10, name="version", product=CollectorErrataProduct.objects.get()
+        )
+        update_products()
+        assert parsed_streams == ["stream"]
+
+        parsed_streams.clear()
+        update_products(full=True)
+        assert parsed_streams == ["stream"]
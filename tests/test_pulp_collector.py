@@ -2,10 +2,11 @@ import os
 
 import pytest
 
-from corgi.collectors.pulp import Pulp
+from corgi.collectors.pulp import PAGE_SIZE, Pulp
 
 TEST_REPO = "rhel-8-for-aarch64-appstream-rpms__8"
-TEST_URL = f"{os.getenv('CORGI_PULP_URL')}/api/v2/repositories/{TEST_REPO}/search/units/"
+TEST_REPO_URL = f"{os.getenv('CORGI_PULP_URL')}/api/v2/repositories/{TEST_REPO}/"
+TEST_URL = f"{TEST_REPO_URL}search/units/"
 
 pytestmark = pytest.mark.unit
 
@@ -50,6 +51,7 @@ def test_fetch_repo_module_data(requests_mock):
 
 
 def test_get_repo_rpm_data(requests_mock):
+    requests_mock.get(TEST_REPO_URL, json={"content_unit_counts": {"rpm": 3}})
     with open(f"tests/data/pulp/{TEST_REPO}-rpms.json") as rpm_data:
         requests_mock.post(TEST_URL, text=rpm_data.read())
     result = Pulp()._get_rpm_data(TEST_REPO)
@@ -59,3 +61,34 @@ def test_get_repo_rpm_data(requests_mock):
             "platform-python-devel-3.6.8-37.el8.aarch64.rpm",
         ]
     }
+
+
+def _rpm_page(request, context):
+    """Return a page of RPM units in a repo with 1234 RPMs, based on the request's skip"""
+    skip = request.json()["criteria"]["skip"]
+    return [
+        {
+            "metadata": {
+                "filename": f"foo-{i}-1.el8.x86_64.rpm",
+                "sourcerpm": f"foo-{i // 100}-1.el8.src.rpm",
+            }
+        }
+        for i in range(skip, min(skip + PAGE_SIZE, 1234))
+    ]
+
+
+@pytest.mark.parametrize("rpm_count", (1234, 0, 400))
+def test_get_repo_rpm_data_pages(requests_mock, rpm_count):
+    """Test that all pages are fetched, even when the repo's RPM count is missing or outdated"""
+    requests_mock.get(TEST_REPO_URL, json={"content_unit_counts": {"rpm": rpm_count}})
+    unit_search = requests_mock.post(TEST_URL, json=_rpm_page)
+
+    result = Pulp()._get_rpm_data(TEST_REPO)
+
+    skips = sorted(request.json()["criteria"]["skip"] for request in unit_search.request_history)
+    assert skips == [0, PAGE_SIZE, PAGE_SIZE * 2]
+    assert len(result) == 13
+    assert sum(len(rpms) for rpms in result.values()) == 1234
+    assert sorted(result["foo-12-1.el8"]) == sorted(
+        f"foo-{i}-1.el8.x86_64.rpm" for i in range(1200, 1234)
+    )
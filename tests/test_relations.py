@@ -53,3 +53,97 @@ def test_update_products_after_relation_creation(fetch_modular_build_task, fetch
     fetch_brew_build_task.assert_called_once_with(
         kwargs={"build_id": sb.build_id, "build_type": SoftwareBuild.Type.CENTOS}, priority=0
     )
+
+
+@patch("corgi.tasks.brew.slow_fetch_modular_build.apply_async")
+def test_create_relations_only_refreshes_new_builds(fetch_modular_build_task):
+    """Test that relations are saved in bulk, and only builds which are new to some product
+    are processed again, even if the same build is given more than once"""
+    stream = ProductStreamFactory()
+    existing_build = SoftwareBuildFactory(build_type=SoftwareBuild.Type.BREW)
+    new_build = SoftwareBuildFactory(build_type=SoftwareBuild.Type.BREW)
+    ProductComponentRelation.objects.create(
+        external_system_id="mock-brew-tag",
+        product_ref=stream.name,
+        build_id=existing_build.build_id,
+        build_type=SoftwareBuild.Type.BREW,
+        type=ProductComponentRelation.Type.BREW_TAG,
+    )
+
+    no_of_relations = create_relations(
+        (existing_build.build_id, new_build.build_id, new_build.build_id),
+        SoftwareBuild.Type.BREW,
+        "mock-brew-tag",
+        stream.name,
+        ProductComponentRelation.Type.BREW_TAG,
+        slow_fetch_modular_build,
+    )
+
+    assert no_of_relations == 1
+    fetch_modular_build_task.assert_called_once_with(
+        kwargs={"build_id": new_build.build_id}, priority=0
+    )
+    assert ProductComponentRelation.objects.filter(product_ref=stream.name).count() == 2
+
+
+def test_upsert_relations():
+    """Test that upserting relations updates only the given fields of existing relations,
+    and never unlinks a build from an existing relation"""
+    build = SoftwareBuildFactory(build_type=SoftwareBuild.Type.BREW)
+    relation = ProductComponentRelation.objects.create(
+        external_system_id="1",
+        product_ref="variant",
+        build_id=build.build_id,
+        build_type=build.build_type,
+        type=ProductComponentRelation.Type.ERRATA,
+        software_build=build,
+    )
+
+    created_build_ids = ProductComponentRelation.objects.upsert(
+        (
+            ProductComponentRelation(
+                external_system_id="1",
+                product_ref="variant",
+                build_id=build.build_id,
+                build_type=build.build_type,
+                type=ProductComponentRelation.Type.ERRATA,
+                meta_attr={"components": ["foo"]},
+            ),
+            ProductComponentRelation(
+                external_system_id="1",
+                product_ref="other-variant",
+                build_id=build.build_id,
+                build_type=build.build_type,
+                type=ProductComponentRelation.Type.ERRATA,
+            ),
+        ),
+        update_fields=("type", "meta_attr", "software_build"),
+        batch_size=1,
+    )
+
+    assert created_build_ids == [build.build_id]
+    relation.refresh_from_db()
+    assert relation.meta_attr == {"components": ["foo"]}
+    assert relation.software_build == build
+    assert relation.last_changed > relation.created_at
+    new_relation = ProductComponentRelation.objects.get(product_ref="other-variant")
+    assert new_relation.software_build is None
+    assert new_relation.meta_attr == {}
+
+    # Without update_fields, existing relations are left alone
+    assert (
+        ProductComponentRelation.objects.upsert(
+            (
+                ProductComponentRelation(
+                    external_system_id="1",
+                    product_ref="variant",
+                    build_id=build.build_id,
+                    build_type=build.build_type,
+                    type=ProductComponentRelation.Type.BREW_TAG,
+                ),
+            )
+        )
+        == []
+    )
+    relation.refresh_from_db()
+    assert relation.type == ProductComponentRelation.Type.ERRATA
@@ -1,10 +1,11 @@
+import json
 from unittest.mock import patch
 
 import pytest
 
 from corgi.collectors.brew import Brew
 from corgi.collectors.models import CollectorRhelModule, CollectorRPM, CollectorSRPM
-from corgi.collectors.rhel_compose import RhelCompose
+from corgi.collectors.rhel_compose import RhelCompose, iter_compose_entries
 from corgi.core.models import Component, ProductComponentRelation, ProductStream
 from corgi.tasks.brew import slow_fetch_modular_build
 from corgi.tasks.rhel_compose import get_builds, save_compose
@@ -189,6 +190,36 @@ class MockBrewResult(object):
     pass
 
 
+@pytest.mark.parametrize(
+    "filename,section",
+    (
+        ("RHEL-8.4.0-RC-1.2/rpms.json", "rpms"),
+        ("RHEL-8.6.0-20220420.3/modules.json", "modules"),
+    ),
+)
+def test_iter_compose_entries(filename, section):
+    """Test that incrementally parsing compose metadata gives the same data as loading it all"""
+    with open(f"tests/data/compose/{filename}") as metadata_file:
+        metadata = json.load(metadata_file)
+    expected = [
+        (variant, arch, key, value)
+        for variant, variant_data in metadata["payload"][section].items()
+        for arch, arch_data in variant_data.items()
+        for key, value in arch_data.items()
+    ]
+    assert expected
+
+    with open(f"tests/data/compose/{filename}", "rb") as metadata_file:
+        assert list(iter_compose_entries(metadata_file, section)) == expected
+
+    # Entries for other variants are skipped without being built
+    variant = expected[-1][0]
+    with open(f"tests/data/compose/{filename}", "rb") as metadata_file:
+        assert list(iter_compose_entries(metadata_file, section, {variant})) == [
+            entry for entry in expected if entry[0] == variant
+        ]
+
+
 def mock_fetch_rpm_data(compose_url, variants):
     yield "1533085"
 
@@ -617,11 +617,9 @@ def test_slow_software_composition_analysis(
     with open(syft_results, "r") as mock_scan_results:
         mock_syft.return_value = mock_scan_results.read()
 
-    with patch("corgi.tasks.sca.app") as mock_app:
+    with patch("corgi.tasks.sca.queue_save_taxonomy") as mock_queue_save_taxonomy:
         cpu_software_composition_analysis(str(sb.pk))
-        mock_app.send_task.assert_called_once_with(
-            "corgi.tasks.common.slow_save_taxonomy", args=(str(sb.build_id), sb.build_type)
-        )
+        mock_queue_save_taxonomy.assert_called_once_with(str(sb.build_id), sb.build_type)
 
     mock_clone_source.assert_called_once_with(package_name, str(sb.pk))
     expected_syft_call_arg_list = [
@@ -1,9 +1,12 @@
 import json
-from unittest.mock import Mock, call, patch
+from datetime import timedelta
+from unittest.mock import ANY, Mock, call, patch
 
 import koji
 import pytest
+from django.utils import timezone
 from packageurl import PackageURL
+from requests import RequestException
 
 from corgi.collectors.brew import ADVISORY_REGEX, Brew
 from corgi.core.constants import RED_HAT_MAVEN_REPOSITORY
@@ -11,23 +14,46 @@ from corgi.core.models import (
     Component,
     ComponentNode,
     ComponentTag,
+    JobWatermark,
     ProductComponentRelation,
+    ProductStream,
     SoftwareBuild,
     SoftwareBuildTag,
+    TaskRun,
+    TaxonomyQueueEntry,
 )
 from corgi.tasks.brew import (
     slow_delete_brew_build,
     slow_refresh_brew_build_tags,
     slow_update_brew_tags,
 )
-from corgi.tasks.common import slow_save_taxonomy
+from corgi.tasks.common import (
+    queue_refresh_stream_components,
+    queue_save_taxonomy,
+    slow_drain_taxonomy_queue,
+    slow_save_taxonomy,
+    watermark,
+)
 from corgi.tasks.errata_tool import slow_handle_shipped_errata
+from corgi.tasks.fairshare import (
+    TaskSource,
+    get_fair_share_stats,
+    release_task_slot,
+    tag_task_source,
+    task_source,
+)
 from corgi.tasks.pnc import slow_fetch_pnc_sbom, slow_handle_pnc_errata_released
+from corgi.tasks.runs import (
+    record_task_finished,
+    record_task_started,
+    record_task_traceback,
+)
 
 from .factories import (
     BinaryRpmComponentFactory,
     ContainerImageComponentFactory,
     ProductComponentRelationFactory,
+    ProductStreamFactory,
     ProductVariantFactory,
     SoftwareBuildFactory,
     SrpmComponentFactory,
@@ -140,6 +166,10 @@ def test_slow_update_brew_tags_errors():
     build_id = "123"
     warning = slow_update_brew_tags(build_id, tag_added=build_id)
     assert warning == f"Brew build with matching ID not ingested (yet?): {build_id}"
+    # Refreshing all tags for a missing build doesn't call Brew
+    with patch("corgi.tasks.brew.Brew") as mock_brew_constructor:
+        slow_refresh_brew_build_tags(int(build_id))
+    mock_brew_constructor.assert_not_called()
 
     # meta_attr field for all builds always has tags key set to a list (on ingestion)
     # no need to test missing tags key or values other than lists
@@ -576,6 +606,51 @@ def test_slow_fetch_pnc_sbom():
                 assert declared_purl.to_string() == derived_purl.to_string()
 
 
+def test_slow_fetch_pnc_sbom_bulk_ingestion():
+    """Test that SBOM components and nodes saved in bulk match what save() would create,
+    and that the root's tree stays valid when the same SBOM is fetched again"""
+    with open("tests/data/pnc/sbom_complete.json") as complete_file:
+        complete_data = json.load(complete_file)["msg"]
+    with open("tests/data/pnc/pnc_sbom.json") as sbom_file:
+        sbom_contents = sbom_file.read()
+    ProductVariantFactory(name="8Base-RHBQ-2.13")
+
+    # Parsing the SBOM changes its data, so each fetch needs a new copy
+    response = Mock()
+    response.status_code = 200
+    response.json.side_effect = lambda: json.loads(sbom_contents)
+    with patch("corgi.tasks.pnc.queue_save_taxonomy"), patch("requests.get", return_value=response):
+        for _ in range(2):
+            slow_fetch_pnc_sbom(
+                complete_data["purl"],
+                complete_data["productConfig"]["errataTool"],
+                complete_data["sbom"],
+            )
+
+    assert Component.objects.count() == 6
+    root_node = ComponentNode.objects.get(parent=None)
+    assert root_node.obj.software_build.build_id == complete_data["build"]["id"]
+    assert root_node.get_descendant_count() == 5
+    assert set(root_node.get_descendants().values_list("purl", flat=True)) == set(
+        Component.objects.exclude(pk=root_node.object_id).values_list("purl", flat=True)
+    )
+
+    # The bulk insert left the tree exactly as a full rebuild would
+    tree_fields = ("pk", "lft", "rght", "level", "tree_id")
+    tree = set(ComponentNode.objects.values_list(*tree_fields))
+    ComponentNode.objects.partial_rebuild(root_node.tree_id)
+    assert set(ComponentNode.objects.values_list(*tree_fields)) == tree
+
+    assert Component.objects.exclude(license_declared_raw="").count() == 5
+
+    # Saving each component again doesn't change anything
+    for component in Component.objects.all():
+        computed = [getattr(component, field) for field in Component.COMPUTED_FIELDS]
+        component.save()
+        component.refresh_from_db()
+        assert [getattr(component, field) for field in Component.COMPUTED_FIELDS] == computed
+
+
 def test_slow_handle_pnc_errata_released():
     """Test extracting the released root component from an SBOMer product erratum's
     Notes field"""
@@ -608,3 +683,194 @@ def test_slow_handle_pnc_errata_released():
             slow_handle_pnc_errata_released(120325, "SHIPPED_LIVE")
 
             get_notes_mock.assert_not_called()
+
+
+@patch("corgi.tasks.common.slow_save_taxonomy")
+def test_taxonomy_queue(mock_save_taxonomy, settings):
+    """Test that builds queued many times are coalesced, and only processed when they're quiet"""
+    settings.TAXONOMY_QUEUE_QUIET_PERIOD = 300
+    sb = SoftwareBuildFactory()
+    for _ in range(3):
+        queue_save_taxonomy(sb.build_id, sb.build_type)
+    entry = TaxonomyQueueEntry.objects.get()
+    assert entry.type == TaxonomyQueueEntry.Type.BUILD
+    assert (entry.build_id, entry.build_type) == (sb.build_id, sb.build_type)
+    assert entry.times_queued == 3
+    mock_save_taxonomy.delay.assert_not_called()
+
+    # The build was queued just now, so it isn't processed yet
+    assert slow_drain_taxonomy_queue() == {"Build": 0, "Stream": 0}
+    mock_save_taxonomy.assert_not_called()
+
+    # Once the build is quiet, it's processed once and removed from the queue
+    TaxonomyQueueEntry.objects.update(last_queued_at=timezone.now() - timedelta(seconds=301))
+    assert slow_drain_taxonomy_queue() == {"Build": 1, "Stream": 0}
+    mock_save_taxonomy.assert_called_once_with(sb.build_id, sb.build_type)
+    assert not TaxonomyQueueEntry.objects.exists()
+
+    # Builds which keep being queued are still processed after the max delay
+    queue_save_taxonomy(sb.build_id, sb.build_type)
+    TaxonomyQueueEntry.objects.update(first_queued_at=timezone.now() - timedelta(hours=2))
+    assert slow_drain_taxonomy_queue() == {"Build": 1, "Stream": 0}
+
+    # Builds which fail with a retryable error stay in the queue
+    queue_save_taxonomy(sb.build_id, sb.build_type)
+    TaxonomyQueueEntry.objects.update(last_queued_at=timezone.now() - timedelta(seconds=301))
+    mock_save_taxonomy.side_effect = RequestException("Connection reset")
+    with pytest.raises(RequestException):
+        slow_drain_taxonomy_queue()
+    assert TaxonomyQueueEntry.objects.filter(build_id=sb.build_id).exists()
+
+    # When the queue is disabled, taxonomies are saved right away
+    settings.TAXONOMY_QUEUE_QUIET_PERIOD = 0
+    queue_save_taxonomy(sb.build_id, sb.build_type)
+    mock_save_taxonomy.delay.assert_called_once_with(sb.build_id, sb.build_type)
+
+
+@patch("corgi.core.models.ProductStream.refresh_aggregate_components")
+def test_taxonomy_queue_streams(mock_refresh, settings):
+    """Test that streams queued by different builds are refreshed once, for all changed roots"""
+    settings.TAXONOMY_QUEUE_QUIET_PERIOD = 300
+    stream = ProductStreamFactory()
+    streams = ProductStream.objects.filter(pk=stream.pk)
+    queue_refresh_stream_components(streams, ["b", "a"])
+    queue_refresh_stream_components(streams, ["c", "a"])
+    entry = TaxonomyQueueEntry.objects.get()
+    assert entry.product_stream == stream.name
+    assert sorted(entry.changed_root_pks) == ["a", "b", "c"]
+
+    # Streams which were deleted are skipped
+    TaxonomyQueueEntry.objects.enqueue(
+        (TaxonomyQueueEntry(type=TaxonomyQueueEntry.Type.STREAM, product_stream="deleted"),)
+    )
+    TaxonomyQueueEntry.objects.update(last_queued_at=timezone.now() - timedelta(seconds=301))
+    assert slow_drain_taxonomy_queue() == {"Build": 0, "Stream": 1}
+    mock_refresh.assert_called_once()
+    assert sorted(mock_refresh.call_args.kwargs["changed_root_pks"]) == ["a", "b", "c"]
+    assert not TaxonomyQueueEntry.objects.exists()
+
+
+@patch("corgi.tasks.fairshare._redis")
+def test_fair_share_scheduling(mock_redis, settings):
+    """Test that tasks are tagged with their source, and demoted when it's over budget"""
+    settings.FAIR_SHARE_QUEUES = ("slow",)
+    settings.FAIR_SHARE_BUDGETS = {TaskSource.BACKFILL: 20}
+    pipe = mock_redis.return_value.pipeline.return_value
+    # Result of ZREMRANGEBYSCORE, ZADD, ZCARD and EXPIRE
+    pipe.execute.return_value = [0, 1, 21, True]
+
+    headers, properties = {"id": "backfill-task"}, {"priority": 6}
+    with task_source(TaskSource.BACKFILL):
+        tag_task_source("task", headers=headers, properties=properties, routing_key="slow")
+    assert headers["corgi_source"] == TaskSource.BACKFILL
+    assert properties["priority"] == settings.FAIR_SHARE_OVERFLOW_PRIORITY
+    pipe.zadd.assert_called_once_with(
+        "corgi:fairshare:slow:backfill:in_flight", {"backfill-task": ANY}
+    )
+
+    # Sources without a budget keep their priority, and retried tasks keep their source
+    headers, properties = {"id": "umb-task", "corgi_source": TaskSource.UMB}, {"priority": 6}
+    with task_source(TaskSource.BACKFILL):
+        tag_task_source("task", headers=headers, properties=properties, routing_key="slow")
+    assert headers["corgi_source"] == TaskSource.UMB
+    assert properties["priority"] == 6
+
+    # Tasks in other queues are only tagged
+    pipe.reset_mock()
+    headers, properties = {"id": "fast-task"}, {}
+    tag_task_source("task", headers=headers, properties=properties, routing_key="fast")
+    assert headers["corgi_source"] == TaskSource.MANUAL
+    assert "priority" not in properties
+    pipe.execute.assert_not_called()
+
+    # Finished tasks stop counting as in flight, but retried tasks don't
+    task = Mock()
+    task.request.delivery_info = {"routing_key": "slow"}
+    task.request.corgi_source = TaskSource.UMB
+    release_task_slot(task=task, task_id="umb-task", state="RETRY")
+    mock_redis.return_value.zrem.assert_not_called()
+    release_task_slot(task=task, task_id="umb-task", state="SUCCESS")
+    mock_redis.return_value.zrem.assert_called_once_with(
+        "corgi:fairshare:slow:umb:in_flight", "umb-task"
+    )
+
+    # In-flight counts and queue wait times are reported per source
+    pipe.execute.return_value = [
+        3,
+        {b"total_seconds": b"30", b"count": b"2", b"last_seconds": b"10"},
+        0,
+        {},
+        0,
+        {},
+        0,
+        {},
+    ]
+    stats = get_fair_share_stats()["slow"]
+    assert stats[TaskSource.UMB] == {
+        "in_flight": 3,
+        "budget": 0,
+        "tasks_started": 2,
+        "avg_wait_seconds": 15,
+        "last_wait_seconds": 10,
+    }
+    assert stats[TaskSource.BACKFILL]["budget"] == 20
+    assert stats[TaskSource.BACKFILL]["avg_wait_seconds"] == 0
+
+
+def test_task_runs():
+    """Test that task runs are recorded from Celery's signals"""
+    task_name = "corgi.tasks.manifest.cpu_update_ps_manifest"
+    task = Mock()
+    task.name = task_name
+
+    record_task_started(task_id="1", task=task, args=("stream-1",), kwargs={"run_id": "run"})
+    run = TaskRun.objects.get(task_id="1")
+    assert run.task_name == task_name
+    assert run.key == "stream-1"
+    assert run.status == TaskRun.Status.STARTED
+    assert run.task_kwargs == "{'run_id': 'run'}"
+
+    record_task_finished(
+        task_id="1", task=task, retval=(True, "2024-01-31T00:22:29Z", "uuid"), state="SUCCESS"
+    )
+    run.refresh_from_db()
+    assert run.status == TaskRun.Status.SUCCESS
+    assert run.summary == [True, "2024-01-31T00:22:29Z", "uuid"]
+    assert run.finished_at
+
+    # Failed runs keep their traceback, and retried runs update the same row
+    record_task_started(task_id="2", task=task, args=(), kwargs={"product_stream": "stream-2"})
+    record_task_traceback(task_id="2", einfo="Traceback: ValueError")
+    record_task_finished(task_id="2", task=task, retval=ValueError(), state="FAILURE")
+    run = TaskRun.objects.get(task_id="2")
+    assert (run.key, run.status, run.traceback) == (
+        "stream-2",
+        TaskRun.Status.FAILURE,
+        "Traceback: ValueError",
+    )
+    record_task_started(task_id="2", task=task, args=("stream-2",), kwargs={})
+    run.refresh_from_db()
+    assert (run.status, run.traceback) == (TaskRun.Status.STARTED, "")
+    assert TaskRun.objects.count() == 2
+
+
+def test_watermark():
+    """Test that job watermarks only advance when the work they cover succeeds"""
+    job = "corgi.tasks.brew.fetch_unprocessed_brew_tag_relations"
+    before = timezone.now()
+    with watermark(job) as since:
+        # Jobs without a watermark look back 3 days, plus some overlap
+        assert since < before - timedelta(days=3)
+        ProductStreamFactory(name="covered")
+    value = JobWatermark.objects.get(name=job).value
+    assert value >= before
+
+    with pytest.raises(ValueError):
+        with watermark(job) as since:
+            assert since == value - timedelta(minutes=30)
+            ProductStreamFactory(name="rolled-back")
+            raise ValueError("Failed")
+    # The watermark and the work it covers are rolled back together
+    assert JobWatermark.objects.get(name=job).value == value
+    assert ProductStream.objects.filter(name="covered").exists()
+    assert not ProductStream.objects.filter(name="rolled-back").exists()
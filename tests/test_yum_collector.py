@@ -1,120 +1,127 @@
-from unittest.mock import call, patch
+from pathlib import Path
+from unittest.mock import patch
 
 import pytest
+from django.core.cache import caches
 
-from corgi.collectors.yum import DNF_BASE_COMMAND, Yum
+from corgi.collectors.yum import Yum
 from corgi.tasks.common import BUILD_TYPE
-from tests.test_pulp_collector import TEST_REPO
 
 pytestmark = pytest.mark.unit
 
-FIND_MODULES_OUTPUT = [
-    "Red Hat Enterprise Linux 8 for aarch64 - AppStream (RPMs)",
-    "Name           Stream          Profiles              Summary",
-    "python27       2.7 [d][e]      common [d]            Python programming language, version 2.7",
-    "python36       3.6 [d][e]      build, common [d]     Python programming language, version 3.6",
-    "",
-    "rhel8-latest-appstream",
-    "Name           Stream          Profiles              Summary",
-    "python27       2.7 [d][e]      common [d]            Python programming language, version 2.7",
-    "python36       3.6 [d][e]      build, common [d]     Python programming language, version 3.6",
-    "",
-    "Hint: [d]efault, [e]nabled, [x]disabled, [i]nstalled",
-    "",
-]
+TEST_REPO = "https://cdn.example.com/content/dist/rhel8/8/aarch64/appstream/os"
 
-GET_MODULE_OUTPUT = [
-    "Name             : python27",
-    "Stream           : 2.7 [d][e][a]",
-    "Version          : 820190212161047",
-    "Context          : 43711c95",
-    "Architecture     : aarch64",
-    "Profiles         : common [d]",
-    "Default profiles : common",
-    "Repo             : rhel-8-latest-appstream",
-    "Summary          : Python programming language, version 2.7",
-    "Description      : This module provides the Python 2.7 interpreter and additional Python",
-    "                 : packages the users might need.",
-    "Requires         : platform:[el8]",
-    "Artifacts        : python-nose-docs-0:1.3.7-29.module+el8+2540+b19c9b35.noarch",
-    "                 : python2-0:2.7.15-21.module+el8+2540+b19c9b35.aarch64",
-    "                 : python2-idna-0:2.5-6.module+el8+2540+b19c9b35.noarch",
-    "                 : python2-py-0:1.5.3-5.module+el8+2540+b19c9b35.noarch",
-    "",
-    "Name             : python36",
-    "Stream           : 3.6 [d][e][a]",
-    "Version          : 820190123171828",
-    "Context          : 17efdbc7",
-    "Architecture     : aarch64",
-    "Profiles         : build, common [d]",
-    "Default profiles : common",
-    "Repo             : rhel-8-for-aarch64-appstream-rpms",
-    "Summary          : Python programming language, version 3.6",
-    "Description      : This module gives users access to the internal Python 3.6 in RHEL8, as",
-    "                 : well as provides some additional Python packages the users might need.",
-    "                 : In addition to these you can install any python3-* package available",
-    "                 : in RHEL and use it with Python from this module.",
-    "Requires         : platform:[el8]",
-    "Artifacts        : python-nose-docs-0:1.3.7-29.module+el8+2339+1a6691f8.noarch",
-    "                 : python3-docs-0:3.6.7-1.module+el8+2339+1a6691f8.noarch",
-    "                 : python36-0:3.6.8-1.module+el8+2710+846623d6.aarch64",
-    "",
-    "Hint: [d]efault, [e]nabled, [x]disabled, [i]nstalled, [a]ctive",
+EXPECTED_MODULES = [
+    {
+        "metadata": {
+            "name": "python27",
+            "stream": "2.7",
+            "version": "820190212161047",
+            "context": "43711c95",
+            "artifacts": [
+                "python-nose-docs-0:1.3.7-29.module+el8+2540+b19c9b35.noarch",
+                "python2-0:2.7.15-21.module+el8+2540+b19c9b35.aarch64",
+                "python2-idna-0:2.5-6.module+el8+2540+b19c9b35.noarch",
+                "python2-py-0:1.5.3-5.module+el8+2540+b19c9b35.noarch",
+            ],
+        }
+    },
+    {
+        "metadata": {
+            "name": "python36",
+            "stream": "3.6",
+            "version": "820190123171828",
+            "context": "17efdbc7",
+            "artifacts": [
+                "python-nose-docs-0:1.3.7-29.module+el8+2339+1a6691f8.noarch",
+                "python3-docs-0:3.6.7-1.module+el8+2339+1a6691f8.noarch",
+                "python36-0:3.6.8-1.module+el8+2710+846623d6.aarch64",
+            ],
+        }
+    },
 ]
 
-GET_NEVRAS_OUTPUT = [
-    "(none) telegram-desktop:0-2.4.4-1.el7.src",
-    "python3-3.6.8-47.el8_6.src.rpm platform-python:0-3.6.8-47.el8_6.x86_64",
-]
 
+@pytest.fixture
+def yum_repo(requests_mock):
+    """Serve the repodata in tests/data/yum as if it were a real Yum repo"""
+    caches["yum"].clear()
+    for path in Path("tests/data/yum/repodata").iterdir():
+        requests_mock.get(f"{TEST_REPO}/repodata/{path.name}", content=path.read_bytes())
+    return requests_mock
 
-def test_get_modules_from_yum_repos():
+
+def test_get_modules_from_yum_repos(yum_repo):
     """Test that the Yum repo collector can get a list of module build IDs
     for all modules shipped to a particular repo"""
-    mock_find_modules_call = call(
-        DNF_BASE_COMMAND + ["module", "list", f"--repofrompath=1,{TEST_REPO}", "--repoid=1"]
-    )
-    mock_get_module_call = call(
-        DNF_BASE_COMMAND
-        + [
-            "module",
-            "info",
-            f"--repofrompath=1,{TEST_REPO}",
-            "--repoid=1",
-            "python27",
-            "python36",
-        ]
-    )
-
     # Python2.7 and 3.6
     module_build_ids = (834215, 844493)
 
     with patch(
-        "corgi.collectors.yum.run_external",
-        side_effect=((None, FIND_MODULES_OUTPUT), (None, GET_MODULE_OUTPUT)),
-    ) as mock_runner:
-        with patch(
-            "corgi.collectors.brew.Brew.persist_modules", return_value=module_build_ids
-        ) as mock_saver:
-            result_build_ids = Yum(BUILD_TYPE).get_modules_from_yum_repos((TEST_REPO,))
-            mock_runner.assert_has_calls(
-                calls=(mock_find_modules_call, mock_get_module_call), any_order=False
-            )
-            mock_saver.assert_called_once()
+        "corgi.collectors.brew.Brew.persist_modules", return_value=module_build_ids
+    ) as mock_saver:
+        result_build_ids = Yum(BUILD_TYPE).get_modules_from_yum_repos((TEST_REPO,))
+        mock_saver.assert_called_once_with(
+            {
+                "python27-2.7-820190212161047.43711c95": EXPECTED_MODULES[0]["metadata"][
+                    "artifacts"
+                ],
+                "python36-3.6-820190123171828.17efdbc7": EXPECTED_MODULES[1]["metadata"][
+                    "artifacts"
+                ],
+            }
+        )
     assert result_build_ids == module_build_ids
 
 
-def test_get_srpms_from_yum_repos():
+def test_get_srpms_from_yum_repos(yum_repo):
     """Test that the Yum repo collector can get a list of SRPM build IDs
     for all RPMs shipped to a particular repo"""
     srpm_build_ids = (2050029,)
     with patch(
-        "corgi.collectors.yum.run_external", return_value=(None, GET_NEVRAS_OUTPUT)
-    ) as mock_runner:
-        with patch(
-            "corgi.collectors.brew.Brew.lookup_build_ids", return_value=srpm_build_ids
-        ) as mock_lookup:
-            result_build_ids = Yum(BUILD_TYPE).get_srpms_from_yum_repos(TEST_REPO)
-            mock_runner.assert_called_once()
-            mock_lookup.assert_called_once()
+        "corgi.collectors.brew.Brew.lookup_build_ids", return_value=srpm_build_ids
+    ) as mock_lookup:
+        result_build_ids = Yum(BUILD_TYPE).get_srpms_from_yum_repos((TEST_REPO,))
+        mock_lookup.assert_called_once_with(
+            {
+                "python3-3.6.8-47.el8_6": [
+                    "platform-python:0-3.6.8-47.el8_6.x86_64",
+                    "python3-libs:0-3.6.8-47.el8_6.x86_64",
+                ]
+            }
+        )
     assert result_build_ids == srpm_build_ids
+
+    # Source RPMs are kept when asked for
+    nvr_nevra_mapping = Yum(BUILD_TYPE).get_nevras_from_yum_repos((TEST_REPO,), ignore_source=False)
+    assert nvr_nevra_mapping["telegram-desktop:0-2.4.4-1.el7"] == [""]
+
+
+def test_yum_repodata_cache(yum_repo):
+    """Test that repodata is only downloaded again when its checksum in repomd.xml changes"""
+    yum = Yum(BUILD_TYPE)
+    assert yum.find_modules_from_yum_repos((TEST_REPO,)) == EXPECTED_MODULES
+    assert yum.find_modules_from_yum_repos((TEST_REPO,)) == EXPECTED_MODULES
+    downloaded = [request.url.rsplit("/", 1)[-1] for request in yum_repo.request_history]
+    assert downloaded.count("repomd.xml") == 2
+    assert sum(filename.endswith("modules.yaml.xz") for filename in downloaded) == 1
+
+    # Repos are processed in parallel, and their results combined
+    other_repo = TEST_REPO.replace("aarch64", "x86_64")
+    for path in Path("tests/data/yum/repodata").iterdir():
+        yum_repo.get(f"{other_repo}/repodata/{path.name}", content=path.read_bytes())
+    assert yum.find_modules_from_yum_repos((TEST_REPO, other_repo)) == EXPECTED_MODULES * 2
+
+
+def test_yum_repodata_checksum_mismatch(yum_repo):
+    """Test that corrupted repodata raises an error, instead of being cached"""
+    repomd = Path("tests/data/yum/repodata/repomd.xml").read_text()
+    primary_path = next(Path("tests/data/yum/repodata").glob("*-primary.xml.gz"))
+    checksum = primary_path.name.split("-", 1)[0]
+    yum_repo.get(
+        f"{TEST_REPO}/repodata/repomd.xml",
+        text=repomd.replace(f">{checksum}<", f">{'0' * len(checksum)}<"),
+    )
+    with pytest.raises(ValueError):
+        Yum(BUILD_TYPE).get_packages_from_yum_repos((TEST_REPO,))
+    assert not caches["yum"].get(f"yum:primary:sha256:{'0' * len(checksum)}")